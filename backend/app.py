@@ -1,14 +1,21 @@
 import os
-from flask import Flask, request
+import time
+import click
+from flask import Flask, Response, g, request
 from flask_cors import CORS
-from flask_migrate import Migrate
 from flask_jwt_extended import JWTManager
 from models import db
 from routes import api_bp
+from jobs import WorkerPool
+from ingest import IngestRequest
+from logs import configure_logging
+import metrics
 from datetime import timedelta
 
 def create_app():
     app = Flask(__name__)
+    # Uploads are written to disk and hashed as they stream in
+    app.request_class = IngestRequest
     
     # Configuration
     app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL', 'postgresql://localhost/karaoke_db')
@@ -16,9 +23,115 @@ def create_app():
     app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'dev_secret_key')
     app.config['JWT_SECRET_KEY'] = os.getenv('JWT_SECRET_KEY', 'jwt_dev_key')
     app.config['JWT_ACCESS_TOKEN_EXPIRES'] = timedelta(days=30)  # Session lasts 30 days
-    app.config['UPLOAD_FOLDER'] = os.path.join(os.getcwd(), 'media')
+    app.config['JWT_TOKEN_LOCATION'] = ['headers']
+    # Lifetime of the per-route ?token= for EventSource and <audio>, which can't send headers (see route_tokens.py)
+    app.config['ROUTE_TOKEN_SECONDS'] = int(os.getenv('ROUTE_TOKEN_SECONDS', '3600'))
+    # Shared between web and worker nodes (e.g. an NFS mount at the same path on each)
+    app.config['UPLOAD_FOLDER'] = os.path.abspath(os.getenv('MEDIA_FOLDER', os.path.join(os.getcwd(), 'media')))
     app.config['MAX_CONTENT_LENGTH'] = 100 * 1024 * 1024  # 100MB max upload
 
+    # Whisper: use 'base' or 'small' on CPU-only nodes
+    app.config['WHISPER_MODEL'] = os.getenv('WHISPER_MODEL', 'medium')
+    app.config['WHISPER_POOL_SIZE'] = int(os.getenv('WHISPER_POOL_SIZE', '1'))  # Max live model copies per process
+    app.config['WHISPER_IDLE_TTL'] = int(os.getenv('WHISPER_IDLE_TTL', '900'))  # Seconds before an idle model is evicted
+    # Transcription: 'auto' uses faster-whisper (int8 CTranslate2 on CPU) when installed, else openai-whisper
+    app.config['TRANSCRIPTION_BACKEND'] = os.getenv('TRANSCRIPTION_BACKEND', 'auto')
+    app.config['WHISPER_COMPUTE_TYPE'] = os.getenv('WHISPER_COMPUTE_TYPE', 'int8')  # faster-whisper weights: int8, float16, float32
+    app.config['WHISPER_CPU_THREADS'] = int(os.getenv('WHISPER_CPU_THREADS', '0'))  # 0 lets CTranslate2 decide
+    app.config['WHISPER_DEVICE'] = os.getenv('WHISPER_DEVICE', 'auto')  # faster-whisper device: auto, cpu, cuda
+    # 'whisper-batched': one service process per node decodes 30 s windows from all running songs in
+    # batches of up to TRANSCRIPTION_BATCH_SIZE, waiting at most TRANSCRIPTION_BATCH_WAIT_MS to fill one
+    app.config['TRANSCRIPTION_BATCH_SIZE'] = int(os.getenv('TRANSCRIPTION_BATCH_SIZE', '8'))
+    app.config['TRANSCRIPTION_BATCH_WAIT_MS'] = int(os.getenv('TRANSCRIPTION_BATCH_WAIT_MS', '200'))
+    app.config['TRANSCRIPTION_SERVICE_THREADS'] = int(os.getenv('TRANSCRIPTION_SERVICE_THREADS', '0'))  # 0 = half the cores
+    # Skip silent stretches (voice activity detection) before transcribing
+    app.config['TRANSCRIPTION_VAD'] = os.getenv('TRANSCRIPTION_VAD', '1') == '1'
+    # Transcribe the separated vocals stem ('vocals', after Demucs) or the original upload ('mix', alongside it)
+    app.config['TRANSCRIBE_SOURCE'] = os.getenv('TRANSCRIBE_SOURCE', 'vocals')
+    # Word-level lyric timings, stored packed in Song.lyrics_words
+    app.config['WORD_TIMESTAMPS'] = os.getenv('WORD_TIMESTAMPS', '1') == '1'
+
+    # Processing workers: 0 sizes the pool from available cores and RAM
+    app.config['WORKER_COUNT'] = int(os.getenv('WORKER_COUNT', '0'))
+    app.config['JOB_MAX_ATTEMPTS'] = int(os.getenv('JOB_MAX_ATTEMPTS', '3'))
+    # Set to 0 on web nodes when processing runs on separate worker nodes (python worker.py)
+    app.config['EMBEDDED_WORKERS'] = os.getenv('EMBEDDED_WORKERS', '1') == '1'
+    # A claimed job is re-queued if its worker misses heartbeats for JOB_LEASE_SECONDS
+    app.config['JOB_LEASE_SECONDS'] = float(os.getenv('JOB_LEASE_SECONDS', '60'))
+    app.config['JOB_HEARTBEAT_INTERVAL'] = float(os.getenv('JOB_HEARTBEAT_INTERVAL', '15'))
+    # Scheduling: weighted shortest-job-first with aging; long streaming jobs can yield to short ones
+    app.config['JOB_COST_FACTOR'] = float(os.getenv('JOB_COST_FACTOR', '1.0'))  # Processing s per audio s until measured
+    app.config['JOB_COST_OVERHEAD'] = float(os.getenv('JOB_COST_OVERHEAD', '20'))  # Fixed seconds per song job
+    app.config['JOB_AGING_RATE'] = float(os.getenv('JOB_AGING_RATE', '1.0'))  # Score credit per second waited
+    app.config['JOB_PREEMPT_AFTER'] = float(os.getenv('JOB_PREEMPT_AFTER', '30'))  # Wait before a short job preempts
+    app.config['JOB_PREEMPT_RATIO'] = float(os.getenv('JOB_PREEMPT_RATIO', '4'))  # Preempt only for jobs this much shorter
+    app.config['JOB_PREEMPT_MIN_RUN'] = float(os.getenv('JOB_PREEMPT_MIN_RUN', '60'))
+    app.config['JOB_MAX_PREEMPTIONS'] = int(os.getenv('JOB_MAX_PREEMPTIONS', '3'))  # 0 disables preemption
+    # Demucs: 'auto' runs in-process when the demucs package is importable, 'cli' forces the subprocess
+    app.config['SEPARATION_BACKEND'] = os.getenv('SEPARATION_BACKEND', 'auto')
+    app.config['DEMUCS_MODEL'] = os.getenv('DEMUCS_MODEL', 'htdemucs')
+    app.config['DEMUCS_CHUNK_SECONDS'] = float(os.getenv('DEMUCS_CHUNK_SECONDS', '30'))
+    # Disk budget for the result cache; stems no song references are evicted LRU first (0 = unbounded)
+    app.config['RESULT_CACHE_MAX_BYTES'] = int(os.getenv('RESULT_CACHE_MAX_BYTES', str(20 * 1024 ** 3)))
+    # Storage collector: finishes deletions and compresses instrumentals unplayed for
+    # STORAGE_COLD_AFTER_DAYS to FLAC (0 disables either)
+    app.config['STORAGE_GC_INTERVAL'] = int(os.getenv('STORAGE_GC_INTERVAL', '3600'))
+    app.config['STORAGE_COLD_AFTER_DAYS'] = int(os.getenv('STORAGE_COLD_AFTER_DAYS', '30'))
+    # Per-user disk quota in bytes; uploads and recordings are refused above it (0 = unlimited)
+    app.config['STORAGE_QUOTA_BYTES'] = int(os.getenv('STORAGE_QUOTA_BYTES', '0'))
+    # Keep the separated vocals stem after processing (only transcription reads it)
+    app.config['KEEP_VOCALS_STEM'] = os.getenv('KEEP_VOCALS_STEM', '0') == '1'
+    # 'numpy' aligns, loudness-matches and mixes takes in one pass (see mix_engine.py); 'ffmpeg' uses amix
+    app.config['MIX_ENGINE'] = os.getenv('MIX_ENGINE', 'numpy')
+    # Mix loudness in LUFS, and how far the vocal sits above the instrumental in LU
+    app.config['MIX_TARGET_LUFS'] = float(os.getenv('MIX_TARGET_LUFS', '-14'))
+    app.config['MIX_VOCAL_LU'] = float(os.getenv('MIX_VOCAL_LU', '1'))
+    # Queued mix jobs of the same song rendered together by one worker
+    app.config['MIX_BATCH_SIZE'] = int(os.getenv('MIX_BATCH_SIZE', '8'))
+    # Offset assumed when alignment fails and the browser didn't report its latency (unset = none)
+    app.config['MIX_DEFAULT_LATENCY_MS'] = float(os.environ['MIX_DEFAULT_LATENCY_MS']) \
+        if os.getenv('MIX_DEFAULT_LATENCY_MS') else None
+    # 'auto' streams tracks longer than STREAMING_MIN_SECONDS in overlapping windows; 'streaming'/'batch' force a mode
+    app.config['PROCESSING_MODE'] = os.getenv('PROCESSING_MODE', 'auto')
+    app.config['STREAMING_MIN_SECONDS'] = float(os.getenv('STREAMING_MIN_SECONDS', '300'))
+    app.config['STREAMING_WINDOW_SECONDS'] = float(os.getenv('STREAMING_WINDOW_SECONDS', '60'))
+    app.config['STREAMING_OVERLAP_SECONDS'] = float(os.getenv('STREAMING_OVERLAP_SECONDS', '5'))
+    # Progress is pushed to subscribers live but written to the DB at most this often (seconds)
+    app.config['PROGRESS_COMMIT_INTERVAL'] = float(os.getenv('PROGRESS_COMMIT_INTERVAL', '10'))
+    # Streamable instrumental encodings made after separation (the WAV is kept for mixing)
+    app.config['INSTRUMENTAL_FORMATS'] = os.getenv('INSTRUMENTAL_FORMATS', 'opus,aac')
+    app.config['INSTRUMENTAL_DEFAULT_FORMAT'] = os.getenv('INSTRUMENTAL_DEFAULT_FORMAT', 'aac')
+    app.config['OPUS_BITRATE'] = os.getenv('OPUS_BITRATE', '96k')
+    app.config['AAC_BITRATE'] = os.getenv('AAC_BITRATE', '160k')
+    # Score recordings against the melody of the song's vocals stem (tracked once per song while separating)
+    app.config['SCORING'] = os.getenv('SCORING', '1') == '1'
+    # Key/tempo-shifted instrumentals: request limits, filter (auto, rubberband or resample) and cache size
+    app.config['VARIANT_MAX_SEMITONES'] = int(os.getenv('VARIANT_MAX_SEMITONES', '6'))
+    app.config['VARIANT_MIN_TEMPO'] = float(os.getenv('VARIANT_MIN_TEMPO', '0.8'))
+    app.config['VARIANT_MAX_TEMPO'] = float(os.getenv('VARIANT_MAX_TEMPO', '1.2'))
+    app.config['VARIANT_FILTER'] = os.getenv('VARIANT_FILTER', 'auto')
+    app.config['VARIANT_CACHE_BYTES'] = int(os.getenv('VARIANT_CACHE_BYTES', str(5 * 1024 ** 3)))
+    # Renders running at once in each web or worker process; requests past it get 503
+    app.config['VARIANT_MAX_RUNNING'] = int(os.getenv('VARIANT_MAX_RUNNING', '4'))
+    # Most requested shifts rendered in the background when a song finishes processing; 0 disables
+    app.config['VARIANT_PRERENDER_COUNT'] = int(os.getenv('VARIANT_PRERENDER_COUNT', '2'))
+    app.config['VARIANT_PRERENDER_MAX_RUNNING'] = int(os.getenv('VARIANT_PRERENDER_MAX_RUNNING', '2'))
+    # Waveform peak levels (samples per pixel at 22.05 kHz), multiples of the smallest
+    app.config['PEAKS_RESOLUTIONS'] = os.getenv('PEAKS_RESOLUTIONS', '256,1024,4096')
+    # Browser cache lifetime of finished media (ready songs' stems, final mixes); files still being written get no-cache
+    app.config['MEDIA_CACHE_MAX_AGE'] = int(os.getenv('MEDIA_CACHE_MAX_AGE', str(365 * 24 * 3600)))
+    # Each upload is decoded once per job; above this size the samples are memory-mapped from local scratch disk
+    app.config['AUDIO_MEMMAP_MIN_BYTES'] = int(os.getenv('AUDIO_MEMMAP_MIN_BYTES', str(256 * 1024 ** 2)))
+    app.config['AUDIO_SCRATCH_DIR'] = os.getenv('AUDIO_SCRATCH_DIR') or None  # Default: the system temp dir
+
+    # Logging: level of the service loggers; repeats of one message are capped per interval
+    app.config['LOG_LEVEL'] = os.getenv('LOG_LEVEL', 'INFO')
+    app.config['LOG_RATE_LIMIT_BURST'] = int(os.getenv('LOG_RATE_LIMIT_BURST', '10'))
+    app.config['LOG_RATE_LIMIT_INTERVAL'] = float(os.getenv('LOG_RATE_LIMIT_INTERVAL', '60'))
+    # If set, /metrics requires "Authorization: Bearer <token>"
+    app.config['METRICS_TOKEN'] = os.getenv('METRICS_TOKEN')
+    configure_logging(app)
+
     # Ensure media directories exist
     os.makedirs(os.path.join(app.config['UPLOAD_FOLDER'], 'uploads'), exist_ok=True)
     os.makedirs(os.path.join(app.config['UPLOAD_FOLDER'], 'instrumentals'), exist_ok=True)
@@ -27,16 +140,31 @@ def create_app():
     # Extensions
     CORS(app)
     db.init_app(app)
-    Migrate(app, db)
+    # Flask-Migrate loads Alembic, Mako and Pygments (~0.3 s); only the `flask db` commands need it
+    if click.get_current_context(silent=True) is not None:
+        from flask_migrate import Migrate
+        Migrate(app, db)
     JWTManager(app)
 
-    # Debug Logging
+    # Request timing (to the response being built; streamed bodies aren't included)
     @app.before_request
-    def log_request_info():
-        if request.path == '/api/upload':
-            print('--- Incoming Upload Request ---')
-            print(f'Headers: {request.headers}')
-            print(f'Body Preview: {request.get_data(as_text=False)[:100]}')
+    def start_timer():
+        g.request_started = time.perf_counter()
+
+    @app.after_request
+    def record_timing(response):
+        started = g.get('request_started')
+        if started is not None and request.url_rule is not None:
+            metrics.observe('http_request_duration_seconds', time.perf_counter() - started,
+                            endpoint=request.url_rule.rule, method=request.method, status=response.status_code)
+        return response
+
+    @app.route('/metrics')
+    def prometheus_metrics():
+        token = app.config.get('METRICS_TOKEN')
+        if token and request.headers.get('Authorization') != f'Bearer {token}':
+            return Response('Forbidden\n', status=403, mimetype='text/plain')
+        return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
     # Blueprints
     app.register_blueprint(api_bp, url_prefix='/api')
@@ -47,4 +175,7 @@ if __name__ == '__main__':
     app = create_app()
     with app.app_context():
         db.create_all()
+    # With the debug reloader, only the serving child process runs workers
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true' and app.config['EMBEDDED_WORKERS']:
+        WorkerPool(app).start()
     app.run(debug=True, port=5000)
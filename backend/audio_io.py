@@ -0,0 +1,263 @@
+import os
+import json
+import struct
+import subprocess
+import tempfile
+import numpy as np
+
+
+def probe_duration(filepath):
+    """
+    Return the duration of a media file in seconds using ffprobe, or None.
+    """
+    cmd = ["ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "json", filepath]
+    try:
+        out = subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout
+        return float(json.loads(out)['format']['duration'])
+    except (subprocess.CalledProcessError, FileNotFoundError, KeyError, ValueError):
+        return None
+
+
+def probe_audio(filepath):
+    """
+    Validate an upload with ffprobe. Returns {'format', 'codec', 'duration'}
+    for a file with a decodable audio stream and a positive duration, or None
+    if it isn't audio. Raises FileNotFoundError if ffprobe isn't installed.
+    """
+    cmd = ["ffprobe", "-v", "error", "-select_streams", "a:0",
+           "-show_entries", "format=format_name,duration:stream=codec_name,duration", "-of", "json", filepath]
+    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    if result.returncode != 0:
+        return None
+    try:
+        info = json.loads(result.stdout)
+        stream = info['streams'][0]
+        duration = float(info['format'].get('duration') or stream.get('duration'))
+    except (KeyError, IndexError, TypeError, ValueError):
+        return None
+    if duration <= 0:
+        return None
+    return {'format': info['format'].get('format_name'), 'codec': stream.get('codec_name'), 'duration': duration}
+
+
+def iter_pcm_windows(filepath, samplerate, channels, window_seconds, overlap_seconds, start_sample=0):
+    """
+    Decode a file once through an ffmpeg pipe and yield overlapping windows
+    as (start_sample, float32 array of shape (channels, n), is_last).
+
+    Consecutive windows share ``overlap_seconds`` of audio. Only one window
+    (plus a one-chunk read-ahead used to detect the end) is held in memory,
+    so memory use does not depend on track length. ``start_sample`` resumes
+    from a window boundary of an earlier pass, sample-exactly.
+    """
+    chunk = max(1, int(window_seconds * samplerate))
+    overlap = int(overlap_seconds * samplerate)
+    frame_bytes = 4 * channels
+    cmd = ["ffmpeg", "-v", "error", "-i", filepath]
+    if start_sample:
+        cmd += ["-af", f"aresample={samplerate},atrim=start_sample={int(start_sample)}"]
+    cmd += ["-ac", str(channels), "-ar", str(samplerate), "-f", "f32le", "-"]
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def read(frames):
+        data = process.stdout.read(frames * frame_bytes)
+        data = data[:len(data) - len(data) % frame_bytes]
+        return np.frombuffer(data, dtype=np.float32).reshape(-1, channels).T
+
+    try:
+        start = start_sample
+        current = read(chunk + overlap)
+        ahead = read(chunk)
+        while True:
+            last = ahead.shape[1] == 0
+            yield start, current, last
+            if last:
+                break
+            tail = current[:, current.shape[1] - overlap:] if overlap else current[:, :0]
+            start += current.shape[1] - tail.shape[1]
+            current = np.concatenate([tail, ahead], axis=1)
+            ahead = read(chunk)
+    finally:
+        process.stdout.close()
+        stderr = process.stderr.read().decode(errors='replace')
+        process.wait()
+    if process.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed to decode {filepath}: {stderr.strip()}")
+
+
+def resample_mono(audio, from_rate, to_rate):
+    """
+    Downmix a (channels, n) array and resample it, e.g. to Whisper's 16 kHz.
+    """
+    mono = audio.mean(axis=0) if audio.ndim == 2 else audio
+    if from_rate == to_rate:
+        return np.ascontiguousarray(mono, dtype=np.float32)
+    try:
+        import torch
+        import julius  # Installed with demucs; proper band-limited resampling
+        return julius.resample_frac(torch.from_numpy(np.ascontiguousarray(mono)), from_rate, to_rate).numpy()
+    except ImportError:
+        n_out = int(round(len(mono) * to_rate / from_rate))
+        positions = np.arange(n_out) * (from_rate / to_rate)
+        return np.interp(positions, np.arange(len(mono)), mono).astype(np.float32)
+
+
+class AudioBuffer:
+    """
+    Decoded float32 audio of shape (channels, n) shared by every stage of a
+    job, so each input is decoded once. ``path`` is the file it was decoded
+    from or written to, if any. Resampled mono copies (Whisper, peaks) are
+    derived from it on demand and cached.
+    """
+
+    def __init__(self, samples, samplerate, path=None):
+        self.samples = samples
+        self.samplerate = samplerate
+        self.path = path
+        self._mono = {}
+
+    @property
+    def channels(self):
+        return self.samples.shape[0]
+
+    @property
+    def duration(self):
+        return self.samples.shape[1] / self.samplerate
+
+    def mono(self, rate):
+        if rate not in self._mono:
+            self._mono[rate] = resample_mono(self.samples, self.samplerate, rate)
+        return self._mono[rate]
+
+
+def decode_audio(filepath, samplerate, channels, duration=None, memmap_min_bytes=None, scratch_dir=None):
+    """
+    Decode a file once through ffmpeg into an AudioBuffer.
+
+    When the decoded size (estimated from ``duration``) reaches
+    ``memmap_min_bytes``, the samples go to a raw file on local scratch disk
+    and are memory-mapped instead of held in RAM. The file is unlinked right
+    away; the mapping keeps it alive until the buffer is dropped.
+    """
+    frame_bytes = 4 * channels
+    cmd = ["ffmpeg", "-v", "error", "-i", filepath, "-ac", str(channels), "-ar", str(samplerate),
+           "-f", "f32le"]
+
+    estimated = duration * samplerate * frame_bytes if duration else 0
+    if memmap_min_bytes and estimated >= memmap_min_bytes:
+        fd, raw_path = tempfile.mkstemp(suffix='.f32', dir=scratch_dir)
+        os.close(fd)
+        try:
+            result = subprocess.run(cmd + ["-y", raw_path], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            if result.returncode != 0:
+                raise RuntimeError(f"ffmpeg failed to decode {filepath}: "
+                                   f"{result.stderr.decode(errors='replace').strip()}")
+            frames = os.path.getsize(raw_path) // frame_bytes
+            if frames == 0:
+                raise RuntimeError(f"No audio decoded from {filepath}")
+            samples = np.memmap(raw_path, dtype=np.float32, mode='r+', shape=(frames, channels)).T
+        finally:
+            os.remove(raw_path)
+        return AudioBuffer(samples, samplerate, path=filepath)
+
+    process = subprocess.Popen(cmd + ["-"], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    blocks = []
+    # Read whole frames at a time; concatenating gives one writable array
+    block_bytes = frame_bytes * samplerate * 10
+    while True:
+        data = process.stdout.read(block_bytes)
+        if not data:
+            break
+        blocks.append(np.frombuffer(data[:len(data) - len(data) % frame_bytes], dtype=np.float32))
+    stderr = process.stderr.read().decode(errors='replace')
+    process.wait()
+    if process.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed to decode {filepath}: {stderr.strip()}")
+    samples = np.concatenate(blocks) if blocks else np.zeros(0, dtype=np.float32)
+    return AudioBuffer(samples.reshape(-1, channels).T, samplerate, path=filepath)
+
+
+def decode_for_app(app, filepath, samplerate, channels, duration=None):
+    """
+    decode_audio with the app's memory-map threshold and scratch directory.
+    """
+    return decode_audio(filepath, samplerate, channels, duration=duration,
+                        memmap_min_bytes=app.config.get('AUDIO_MEMMAP_MIN_BYTES'),
+                        scratch_dir=app.config.get('AUDIO_SCRATCH_DIR'))
+
+
+def pipe_to_ffmpeg(audio, output_args, block_seconds=10):
+    """
+    Run ffmpeg with an AudioBuffer fed as raw float32 on stdin, so encoders
+    read the samples already in memory instead of decoding a file again.
+    """
+    cmd = ["ffmpeg", "-v", "error", "-f", "f32le", "-ar", str(audio.samplerate), "-ac", str(audio.channels),
+           "-i", "pipe:0"] + list(output_args)
+    # stderr goes to a file so a chatty ffmpeg can't block while we write
+    with tempfile.TemporaryFile() as stderr:
+        process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=stderr)
+        block = max(1, int(block_seconds * audio.samplerate))
+        try:
+            for start in range(0, audio.samples.shape[1], block):
+                # (n, channels) frames are what f32le expects
+                frames = np.ascontiguousarray(audio.samples[:, start:start + block].T, dtype='<f4')
+                process.stdin.write(frames.tobytes())
+        except BrokenPipeError:
+            pass  # ffmpeg exited early, its return code says why
+        finally:
+            process.stdin.close()
+            process.wait()
+        if process.returncode != 0:
+            stderr.seek(0)
+            raise RuntimeError(f"ffmpeg failed: {stderr.read().decode(errors='replace').strip()}")
+
+
+class PartialWavWriter:
+    """
+    16-bit WAV file that stays valid after every append: the header is
+    rewritten with the current length each time, so players can open the file
+    while it is still growing. ``resume_frames`` reopens a file written
+    earlier and continues after that many frames.
+    """
+
+    HEADER = struct.Struct('<4sI4s4sIHHIIHH4sI')
+
+    def __init__(self, path, samplerate, channels, resume_frames=None):
+        self.samplerate = samplerate
+        self.channels = channels
+        self.frames = 0
+        if resume_frames:
+            self._file = open(path, 'r+b')
+            end = self.HEADER.size + resume_frames * 2 * channels
+            if self._file.seek(0, os.SEEK_END) < end:
+                self._file.close()
+                raise ValueError(f"{path} is shorter than {resume_frames} frames")
+            self._file.truncate(end)
+            self._file.seek(end)
+            self.frames = resume_frames
+        else:
+            self._file = open(path, 'wb')
+        self._write_header()
+
+    def _write_header(self):
+        block_align = 2 * self.channels
+        data_bytes = self.frames * block_align
+        position = self._file.tell()
+        self._file.seek(0)
+        self._file.write(self.HEADER.pack(b'RIFF', 36 + data_bytes, b'WAVE', b'fmt ', 16, 1, self.channels,
+                                          self.samplerate, self.samplerate * block_align, block_align, 16,
+                                          b'data', data_bytes))
+        self._file.seek(max(position, self.HEADER.size))
+
+    def append(self, audio):
+        """
+        Append a float (channels, n) block.
+        """
+        pcm = (np.clip(audio, -1.0, 1.0) * 32767).astype('<i2').T.tobytes()
+        self._file.write(pcm)
+        self.frames += audio.shape[1]
+        self._write_header()
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
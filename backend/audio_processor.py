@@ -1,119 +1,384 @@
 import os
 import json
-import whisper
-from spleeter.separator import Separator
+import shutil
+import time
+import logging
 from models import db, Song
-
-# Initialize models globally to avoid reloading (optional, can be lazy loaded)
-# separator = Separator('spleeter:2stems')
-# whisper_model = whisper.load_model("base")
+from separation import get_separation_engine, vocals_path, Stems
+import result_cache
+import storage
+from encoding import transcode_instrumental
+from peaks import generate_peaks
+import events
+import metrics
+from audio_io import probe_duration, decode_for_app
+from mix_engine import buffer_loudness
+from scoring import extract_reference
+from streaming import should_stream, process_song_streaming
+from transcription import WHISPER_RATE, transcribe
+from lyrics_timeline import split_lyrics
+from scheduling import Preempted
+from pipeline import Stage, StageProgress, run_stages, job_thread_budget
 
 import subprocess
 
-def process_song_task(song_id, filepath, app):
+log = logging.getLogger(__name__)
+
+
+def inprocess_engine(app):
+    if app.config.get('SEPARATION_BACKEND', 'auto') == 'cli':
+        return None
+    return get_separation_engine(app)
+
+
+def transcribe_from_vocals(app):
+    return app.config.get('TRANSCRIBE_SOURCE', 'vocals') == 'vocals'
+
+
+def needs_vocals(app):
+    return transcribe_from_vocals(app) or app.config.get('SCORING', True)
+
+
+def separate_vocals(app, filepath, output_dir, threads=None, on_progress=None, audio=None):
+    """
+    Remove vocals using Demucs (High Quality). Returns Stems of AudioBuffers
+    (paths are the WAVs on disk); the vocals stem is only kept when lyrics
+    are transcribed from it (TRANSCRIBE_SOURCE=vocals) or recordings are
+    scored against it (SCORING).
+
+    Uses the in-process engine unless SEPARATION_BACKEND is 'cli' or the
+    demucs package can't be imported, in which case it shells out to the CLI
+    with ``threads`` CPU threads (in-process, torch uses the worker's pool).
+    """
+    keep_vocals = needs_vocals(app)
+    engine = inprocess_engine(app)
+    if engine is None:
+        instrumental_path = separate_vocals_cli(filepath, output_dir, threads, on_progress)
+        # Decoded once here so encoding and peaks don't each decode the WAV
+        vocals = decode_for_app(app, vocals_path(instrumental_path), WHISPER_RATE, 1) if keep_vocals else None
+        return Stems(decode_for_app(app, instrumental_path, 44100, 2), vocals)
+
+    os.makedirs(output_dir, exist_ok=True)
+    log.info("Separating %s with in-process Demucs", filepath)
+    return engine.separate(filepath, output_dir, on_progress=on_progress, audio=audio, keep_vocals=keep_vocals)
+
+
+def separate_vocals_cli(filepath, output_dir, threads=None, on_progress=None):
+    """
+    Fallback: run the Demucs CLI in a subprocess and scrape its progress bar.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+
+    # Check if demucs is installed (without starting it just to print --help)
+    if shutil.which("demucs") is None:
+        raise RuntimeError("Demucs is not installed or not in PATH")
+
+    # Run Demucs command
+    # -n htdemucs: High quality model
+    # --two-stems=vocals: Separate into vocals and non-vocals (instrumental)
+    cmd = [
+        "demucs", 
+        "-n", "htdemucs", 
+        "--two-stems=vocals", 
+        filepath, 
+        "-o", output_dir
+    ]
+    
+    log.info("Running Demucs: %s", ' '.join(cmd))
+
+    env = os.environ.copy()
+    if threads:
+        # Keep Demucs within its share of the job's CPU budget
+        env['OMP_NUM_THREADS'] = str(threads)
+        env['MKL_NUM_THREADS'] = str(threads)
+    
+    # Use Popen to capture output in real-time
+    process = subprocess.Popen(
+        cmd, 
+        stdout=subprocess.PIPE, 
+        stderr=subprocess.STDOUT, 
+        text=True, 
+        bufsize=1, 
+        universal_newlines=True,
+        env=env
+    )
+    
+    # Parse progress
+    for line in process.stdout:
+        log.debug("Demucs output: %s", line.strip())
+        if "%" in line and on_progress:
+            try:
+                # Example line:  16%|█▌        | 12.6M/80.2M [00:00<00:02, 25.2MB/s]
+                # Extract percentage
+                parts = line.split('%')
+                if parts:
+                    on_progress(int(parts[0].strip().split()[-1]))
+            except Exception as e:
+                log.debug("Error parsing Demucs progress: %s", e)
+    
+    process.wait()
+    
+    if process.returncode != 0:
+        log.error("Demucs failed with return code %s", process.returncode)
+        raise RuntimeError(f"Demucs failed with return code {process.returncode}")
+    
+    # Construct expected path
+    # Demucs output structure: output_dir/htdemucs/filename_no_ext/no_vocals.wav
+    base_name = os.path.splitext(os.path.basename(filepath))[0]
+    
+    # Handle potential spaces or special chars in filename that Demucs might sanitize
+    # But for now, let's try the standard path first
+    instrumental_path = os.path.join(output_dir, 'htdemucs', base_name, 'no_vocals.wav')
+    
+    if not os.path.exists(instrumental_path):
+        # Fallback: look for any .wav file in the expected folder if exact match fails
+        expected_folder = os.path.join(output_dir, 'htdemucs', base_name)
+        if os.path.exists(expected_folder):
+            wavs = [f for f in os.listdir(expected_folder) if f.endswith('no_vocals.wav')]
+            if wavs:
+                instrumental_path = os.path.join(expected_folder, wavs[0])
+            else:
+                 raise FileNotFoundError(f"No instrumental output found in {expected_folder}")
+        else:
+            raise FileNotFoundError(f"Demucs output folder not found at {expected_folder}")
+
+    return instrumental_path
+
+
+def transcribe_lyrics(app, filepath, on_progress=None, audio=None):
+    """
+    Extract timestamped lyrics segments (with word timings, if enabled) with
+    the configured transcription backend (see transcription.py). ``audio``
+    is what to transcribe as an AudioBuffer, the vocals stem or the job's
+    decoded upload; the 16 kHz samples then come from it instead of another
+    decode of the file.
+    """
+    if audio is not None:
+        samples = audio.mono(WHISPER_RATE)
+    else:
+        samples = decode_for_app(app, filepath, WHISPER_RATE, 1).samples[0]
+    return transcribe(app, samples, on_progress=on_progress)
+
+
+def encode_instrumental(app, instrumental, on_progress=None):
+    """
+    Make the streamable encodings from the instrumental AudioBuffer. Failure
+    only costs bandwidth (the WAV is served instead), so it doesn't fail the job.
+    """
+    try:
+        outputs = transcode_instrumental(app, instrumental.path, audio=instrumental)
+    except Exception as e:
+        log.warning("Error encoding instrumental %s: %s", instrumental.path, e)
+        metrics.inc('errors_total', where='encode')
+        outputs = {}
+    if on_progress:
+        on_progress(100)
+    return outputs
+
+
+def compute_waveform_peaks(app, instrumental, on_progress=None):
+    """
+    Precompute waveform peaks for the player. Optional like the encodings:
+    without them the player decodes the audio itself.
+    """
+    try:
+        paths = generate_peaks(app, instrumental.path, audio=instrumental)
+    except Exception as e:
+        log.warning("Error computing peaks for %s: %s", instrumental.path, e)
+        metrics.inc('errors_total', where='peaks')
+        paths = {}
+    if on_progress:
+        on_progress(100)
+    return paths
+
+
+def measure_instrumental_loudness(instrumental):
     """
-    Background task to remove vocals using Demucs (High Quality) and extract lyrics.
+    Integrated loudness of the instrumental, kept for gain staging recordings.
+    Optional too: mixing measures it itself if it's missing.
+    """
+    try:
+        return buffer_loudness(instrumental)
+    except Exception as e:
+        log.warning("Error measuring loudness of %s: %s", instrumental.path, e)
+        metrics.inc('errors_total', where='loudness')
+        return None
+
+
+def extract_melody(app, instrumental_path, vocals=None):
+    """
+    Track the melody of the vocals stem for scoring recordings, before the
+    stem is deleted. Optional: without it recordings just aren't scored.
+    """
+    if not app.config.get('SCORING', True):
+        return None
+    try:
+        return extract_reference(app, vocals if vocals is not None else vocals_path(instrumental_path),
+                                 instrumental_path)
+    except Exception as e:
+        log.warning("Error extracting the melody of %s: %s", instrumental_path, e)
+        metrics.inc('errors_total', where='melody')
+        return None
+
+
+def finalize_song(instrumental_path, lyrics_data, on_progress=None):
+    if not os.path.exists(instrumental_path):
+        raise FileNotFoundError(f"Instrumental missing at {instrumental_path}")
+    lyrics_json, lyrics_words = split_lyrics(lyrics_data)
+    if on_progress:
+        on_progress(100)
+    return {'instrumental_path': instrumental_path, 'lyrics_json': lyrics_json, 'lyrics_words': lyrics_words}
+
+
+def reuse_cached_result(app, song, audio=None):
+    """
+    Key a new upload by its decoded audio (``audio``, the job's decoded
+    upload) and, if identical audio was processed before, take that result
+    instead of separating again. Returns True if the song is done. Jobs that
+    never hold the whole upload in memory (streaming, the Demucs CLI) key it
+    by its bytes, which only matches byte-identical uploads.
+    """
+    if song.cache_key is None:
+        song.cache_key = result_cache.audio_cache_key(app, audio) if audio is not None else song.upload_hash
+    cached = result_cache.lookup(song.cache_key) if song.cache_key else None
+    if cached is None:
+        return False
+    song.instrumental_path = cached.instrumental_path
+    song.lyrics_json = cached.lyrics_json
+    song.lyrics_words = cached.lyrics_words
+    song.status = 'ready'
+    song.progress = 100
+    db.session.commit()
+    events.publish_song(song)
+    log.info("Song %s matches a cached result, skipping processing", song.id)
+    return True
+
+
+def process_song_task(song_id, filepath, app, checkpoint=None, should_yield=None):
+    """
+    Background task to remove vocals and extract lyrics.
+
+    By default lyrics are transcribed from the separated vocals stem, so
+    Whisper runs after Demucs, overlapping the instrumental's encoding. With
+    TRANSCRIBE_SOURCE=mix both read the original upload and run in
+    parallel, sharing the worker's thread pool. The upload is decoded once; the stems are kept in memory for
+    encoding, peaks and transcription. Long tracks are instead
+    streamed window by window (see streaming.py); those can be preempted
+    between windows (Preempted propagates to the caller with the
+    checkpoint to resume from). Audio already processed under another
+    upload is reused instead, keyed from the same decode (see
+    reuse_cached_result).
     """
     with app.app_context():
         song = Song.query.get(song_id)
+        output_dir = os.path.join(app.config['UPLOAD_FOLDER'], 'instrumentals')
+        from_vocals = transcribe_from_vocals(app)
+
+        progress = StageProgress({'separate': 3, 'transcribe': 2, 'encode': 0.2, 'peaks': 0.1, 'finalize': 0.1})
+        source = None  # The decoded upload, set before the stages run
+        stages = [
+            Stage('separate', lambda deps: separate_vocals(
+                app, filepath, output_dir, job_thread_budget(), progress.callback('separate'), audio=source)),
+            Stage('transcribe', lambda deps: transcribe_lyrics(
+                app, filepath, progress.callback('transcribe'),
+                audio=deps['separate'].vocals if from_vocals else source),
+                deps=('separate',) if from_vocals else ()),
+            # Encoding only needs the instrumental, so it overlaps with Whisper
+            Stage('encode', lambda deps: encode_instrumental(
+                app, deps['separate'].instrumental, progress.callback('encode')), deps=('separate',)),
+            Stage('peaks', lambda deps: compute_waveform_peaks(
+                app, deps['separate'].instrumental, progress.callback('peaks')), deps=('separate',)),
+            Stage('loudness', lambda deps: measure_instrumental_loudness(deps['separate'].instrumental),
+                  deps=('separate',)),
+            Stage('melody', lambda deps: extract_melody(
+                app, deps['separate'].instrumental.path, deps['separate'].vocals), deps=('separate',)),
+            Stage('finalize', lambda deps: finalize_song(
+                deps['separate'].instrumental.path, deps['transcribe'], progress.callback('finalize')),
+                deps=('separate', 'transcribe', 'encode', 'peaks', 'loudness', 'melody')),
+        ]
+
+        last_commit = time.monotonic()
+
+        def save_progress():
+            nonlocal last_commit
+            # Subscribers get every change; the DB only every PROGRESS_COMMIT_INTERVAL seconds
+            overall = progress.overall()
+            stage_progress = json.dumps(progress.snapshot())
+            if overall == song.progress and stage_progress == song.stage_progress:
+                return
+            song.progress = overall
+            song.stage_progress = stage_progress
+            events.publish_song(song)
+            now = time.monotonic()
+            if now - last_commit >= app.config.get('PROGRESS_COMMIT_INTERVAL', 10):
+                with metrics.span('db_commit_seconds', site='progress'):
+                    db.session.commit()
+                last_commit = now
+
         try:
-            # 1. Vocal Separation using Demucs
-            output_dir = os.path.join(app.config['UPLOAD_FOLDER'], 'instrumentals')
-            os.makedirs(output_dir, exist_ok=True)
-            
-            # Check if demucs is installed
-            try:
-                subprocess.run(["demucs", "--help"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
-            except (subprocess.CalledProcessError, FileNotFoundError):
-                raise RuntimeError("Demucs is not installed or not in PATH")
-
-            # Run Demucs command
-            # -n htdemucs: High quality model
-            # --two-stems=vocals: Separate into vocals and non-vocals (instrumental)
-            cmd = [
-                "demucs", 
-                "-n", "htdemucs", 
-                "--two-stems=vocals", 
-                filepath, 
-                "-o", output_dir
-            ]
-            
-            print(f"Running Demucs: {' '.join(cmd)}")
-            
-            # Use Popen to capture output in real-time
-            process = subprocess.Popen(
-                cmd, 
-                stdout=subprocess.PIPE, 
-                stderr=subprocess.STDOUT, 
-                text=True, 
-                bufsize=1, 
-                universal_newlines=True
-            )
-            
-            # Parse progress
-            for line in process.stdout:
-                print(f"Demucs Output: {line.strip()}") # Log for debugging
-                if "%" in line:
-                    try:
-                        # Example line:  16%|█▌        | 12.6M/80.2M [00:00<00:02, 25.2MB/s]
-                        # Extract percentage
-                        parts = line.split('%')
-                        if parts:
-                            percentage = int(parts[0].strip().split()[-1])
-                            # Update DB only if changed significantly to avoid too many writes
-                            if percentage > song.progress:
-                                song.progress = percentage
-                                db.session.commit()
-                    except Exception as e:
-                        print(f"Error parsing progress: {e}")
-            
-            process.wait()
-            
-            if process.returncode != 0:
-                print(f"Demucs failed with return code {process.returncode}")
-                raise RuntimeError(f"Demucs failed with return code {process.returncode}")
-            
-            # Construct expected path
-            # Demucs output structure: output_dir/htdemucs/filename_no_ext/no_vocals.wav
-            base_name = os.path.splitext(os.path.basename(filepath))[0]
-            
-            # Handle potential spaces or special chars in filename that Demucs might sanitize
-            # But for now, let's try the standard path first
-            instrumental_path = os.path.join(output_dir, 'htdemucs', base_name, 'no_vocals.wav')
-            
-            if not os.path.exists(instrumental_path):
-                # Fallback: look for any .wav file in the expected folder if exact match fails
-                expected_folder = os.path.join(output_dir, 'htdemucs', base_name)
-                if os.path.exists(expected_folder):
-                    wavs = [f for f in os.listdir(expected_folder) if f.endswith('no_vocals.wav')]
-                    if wavs:
-                        instrumental_path = os.path.join(expected_folder, wavs[0])
-                    else:
-                         raise FileNotFoundError(f"No instrumental output found in {expected_folder}")
-                else:
-                    raise FileNotFoundError(f"Demucs output folder not found at {expected_folder}")
-            
-            # 2. Lyrics Extraction
-            # Using Whisper (medium model for better multilingual support)
-            model = whisper.load_model("medium")
-            result = model.transcribe(filepath)
-            
-            lyrics_data = []
-            for segment in result['segments']:
-                lyrics_data.append({
-                    'start': segment['start'],
-                    'end': segment['end'],
-                    'text': segment['text'].strip()
-                })
+            # Normally probed at upload time
+            duration = song.duration or probe_duration(filepath)
+            if duration and not song.duration:
+                song.duration = duration
+            engine = inprocess_engine(app)
+
+            if engine is not None and should_stream(app, duration):
+                # Long track: chunked pass with incremental lyrics and instrumental
+                if checkpoint is None and reuse_cached_result(app, song):
+                    return
+                log.info("Streaming song %s (%.0fs)", song_id, duration or 0)
+                results = {'finalize': process_song_streaming(
+                    app, song, filepath, engine, engine.instrumental_path(filepath, output_dir),
+                    duration, progress,
+                    checkpoint=checkpoint, should_yield=should_yield)}
+                instrumental = decode_for_app(app, results['finalize']['instrumental_path'],
+                                              engine.samplerate, engine.model.audio_channels, duration)
+                encode_instrumental(app, instrumental, progress.callback('encode'))
+                compute_waveform_peaks(app, instrumental, progress.callback('peaks'))
+                results['loudness'] = measure_instrumental_loudness(instrumental)
+                # The streamed vocals stem is on disk only
+                extract_melody(app, instrumental.path)
+            else:
+                # Demucs wants its own rate and layout; the CLI reads the file
+                # itself, so then only Whisper's 16 kHz mono is decoded (if
+                # Whisper reads the upload at all)
+                if engine is not None:
+                    source = decode_for_app(app, filepath, engine.samplerate, engine.model.audio_channels, duration)
+                elif not from_vocals:
+                    source = decode_for_app(app, filepath, WHISPER_RATE, 1, duration)
+                if reuse_cached_result(app, song, source):
+                    return
+                results = run_stages(stages, on_tick=save_progress)
             
             # Update DB
-            song.instrumental_path = instrumental_path
-            song.lyrics_json = json.dumps(lyrics_data)
+            song.instrumental_path = results['finalize']['instrumental_path']
+            song.instrumental_lufs = results['loudness']
+            song.lyrics_json = results['finalize']['lyrics_json']
+            song.lyrics_words = results['finalize']['lyrics_words']
             song.status = 'ready'
-            db.session.commit()
-            print(f"Processing complete for song {song_id}")
+            song.progress = 100
+            song.stage_progress = json.dumps(progress.snapshot())
+            result_cache.store(song)
+            with metrics.span('db_commit_seconds', site='result'):
+                db.session.commit()
+            events.publish_song(song)
+            log.info("Processing complete for song %s", song_id)
+            result_cache.evict(app)
+            try:
+                storage.drop_intermediates(app, song)
+            except Exception as e:
+                # The song is done; the collector retries leftover deletions
+                log.warning("Could not clean up after song %s: %s", song_id, e)
+                db.session.rollback()
             
+        except Preempted:
+            # Progress so far is committed; the job goes back in the queue
+            db.session.commit()
+            raise
         except Exception as e:
-            print(f"Error processing song {song_id}: {e}")
+            log.exception("Error processing song %s: %s", song_id, e)
+            db.session.rollback()
             song.status = 'error'
             db.session.commit()
+            events.publish_song(song)
+
@@ -0,0 +1,272 @@
+import queue
+import logging
+import threading
+import time
+from concurrent.futures import Future, as_completed
+from multiprocessing import current_process
+from multiprocessing.connection import Client, Listener
+import numpy as np
+from model_registry import get_whisper_pool
+from transcription import WHISPER_RATE
+from pipeline import set_process_threads
+import events
+import metrics
+
+log = logging.getLogger(__name__)
+
+# Whisper decodes fixed 30 s windows of 16 kHz audio
+WINDOW_SAMPLES = 30 * WHISPER_RATE
+SECONDS_PER_TIMESTAMP = 0.02
+# Whisper's own fallback schedule for windows that decode badly
+FALLBACK_TEMPERATURES = (0.0, 0.2, 0.4, 0.6, 0.8, 1.0)
+
+
+class WindowBatcher:
+    """
+    Collects windows submitted from any number of threads and hands them to
+    ``decode`` in batches of up to ``batch_size``. A batch goes out when it
+    is full or ``max_wait`` seconds after its first window arrived, so a
+    lone song isn't held back waiting for company.
+    """
+
+    def __init__(self, decode, batch_size=8, max_wait=0.2):
+        self.decode = decode
+        self.batch_size = max(1, int(batch_size))
+        self.max_wait = max_wait
+        self._queue = queue.Queue()
+        threading.Thread(target=self._loop, daemon=True, name='whisper-batcher').start()
+
+    def submit(self, window):
+        future = Future()
+        self._queue.put((window, future))
+        return future
+
+    def _loop(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            metrics.observe('transcription_batch_windows', len(batch))
+            try:
+                with metrics.span('transcription_batch_seconds'):
+                    results = self.decode([window for window, _ in batch])
+            except Exception as e:
+                log.exception("Batch of %s windows failed: %s", len(batch), e)
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+
+
+def _split_segments(tokens, tokenizer, duration):
+    """
+    Cut one window's decoded tokens into segments at its timestamp tokens.
+    Times are seconds into the window.
+    """
+    segments = []
+    start, text = 0.0, []
+    for token in tokens:
+        if token >= tokenizer.timestamp_begin:
+            t = (token - tokenizer.timestamp_begin) * SECONDS_PER_TIMESTAMP
+            if text:
+                segments.append({'seek': 0, 'start': start, 'end': t, 'tokens': text,
+                                 'text': tokenizer.decode(text)})
+                text = []
+            start = t
+        elif token < tokenizer.eot:
+            text.append(token)
+    if text:
+        segments.append({'seek': 0, 'start': start, 'end': duration, 'tokens': text, 'text': tokenizer.decode(text)})
+    return segments
+
+
+def _needs_fallback(result):
+    if result.no_speech_prob > 0.6 and result.avg_logprob < -1.0:
+        return False  # Silence; decoding it again won't help
+    return result.compression_ratio > 2.4 or result.avg_logprob < -1.0
+
+
+def decode_windows(app, windows):
+    """
+    Decode a batch of windows, each (samples, word_timestamps), with one
+    forward pass of the shared model per temperature. Returns, per window,
+    a list of {start, end, text[, words]} relative to the window.
+    """
+    import torch
+    import whisper
+    from whisper.timing import add_word_timestamps
+    from whisper.tokenizer import get_tokenizer
+
+    with get_whisper_pool(app).acquire(app.config['WHISPER_MODEL']) as model:
+        mel = torch.stack([
+            whisper.log_mel_spectrogram(whisper.pad_or_trim(torch.from_numpy(samples)), n_mels=model.dims.n_mels)
+            for samples, _ in windows]).to(model.device)
+        fp16 = model.device.type == 'cuda'
+
+        decoded = [None] * len(windows)
+        pending = list(range(len(windows)))
+        for temperature in FALLBACK_TEMPERATURES:
+            options = whisper.DecodingOptions(temperature=temperature, fp16=fp16)
+            retry = []
+            for i, result in zip(pending, whisper.decode(model, mel[pending], options)):
+                decoded[i] = result
+                if _needs_fallback(result):
+                    retry.append(i)
+            pending = retry
+            if not pending:
+                break
+
+        output = []
+        for i, ((samples, word_timestamps), result) in enumerate(zip(windows, decoded)):
+            if result.no_speech_prob > 0.6 and result.avg_logprob < -1.0:
+                output.append([])
+                continue
+            tokenizer = get_tokenizer(model.is_multilingual, num_languages=model.num_languages,
+                                      language=result.language, task='transcribe')
+            num_frames = len(samples) // whisper.audio.HOP_LENGTH
+            segments = _split_segments(result.tokens, tokenizer, len(samples) / whisper.audio.SAMPLE_RATE)
+            if word_timestamps and segments:
+                add_word_timestamps(segments=segments, model=model, tokenizer=tokenizer, mel=mel[i],
+                                    num_frames=num_frames, last_speech_timestamp=0.0)
+            window_segments = []
+            for segment in segments:
+                entry = {'start': segment['start'], 'end': segment['end'], 'text': segment['text']}
+                if word_timestamps:
+                    entry['words'] = [{'start': w['start'], 'end': w['end'], 'word': w['word']}
+                                      for w in segment.get('words', ())]
+                window_segments.append(entry)
+            output.append(window_segments)
+        return output
+
+
+_local = None
+_local_lock = threading.Lock()
+
+
+def _local_batcher(app):
+    """
+    This process's batcher, for when no shared service is running (a single
+    worker, the benchmark). It still batches a song's windows together.
+    """
+    global _local
+    with _local_lock:
+        if _local is None:
+            _local = WindowBatcher(lambda windows: decode_windows(app, windows),
+                                   batch_size=app.config.get('TRANSCRIPTION_BATCH_SIZE', 8),
+                                   max_wait=app.config.get('TRANSCRIPTION_BATCH_WAIT_MS', 200) / 1000)
+        return _local
+
+
+def _results_local(app, windows):
+    batcher = _local_batcher(app)
+    futures = {batcher.submit(window): i for i, window in enumerate(windows)}
+    for future in as_completed(futures):
+        yield futures[future], future.result()
+
+
+def _results_remote(address, windows):
+    with Client(address, authkey=current_process().authkey) as conn:
+        for i, window in enumerate(windows):
+            conn.send((i, window))
+        for _ in windows:
+            i, segments, error = conn.recv()
+            if error:
+                raise RuntimeError(f"Transcription service: {error}")
+            yield i, segments
+
+
+def _collect(results, total, on_progress):
+    collected = []
+    for item in results:
+        collected.append(item)
+        if on_progress:
+            on_progress(100 * len(collected) / total)
+    return collected
+
+
+def transcribe_windows(app, samples, on_progress=None, word_timestamps=False):
+    """
+    Transcribe 16 kHz mono samples as independent 30 s windows through the
+    batching service shared by this node's workers (or this process's own
+    batcher), so windows from several songs share forward passes. Returns
+    segments with times in seconds into ``samples``.
+    """
+    samples = np.ascontiguousarray(samples, dtype=np.float32)
+    windows = [(samples[start:start + WINDOW_SAMPLES], word_timestamps)
+               for start in range(0, len(samples), WINDOW_SAMPLES)]
+    if not windows:
+        return []
+
+    address = app.config.get('TRANSCRIPTION_SERVICE_ADDRESS')
+    results = None
+    if address:
+        try:
+            results = _collect(_results_remote(address, windows), len(windows), on_progress)
+        except (OSError, EOFError) as e:
+            log.warning("Transcription service unavailable (%s), decoding in this process", e)
+    if results is None:
+        results = _collect(_results_local(app, windows), len(windows), on_progress)
+
+    segments = []
+    for i, window_segments in sorted(results, key=lambda item: item[0]):
+        offset = i * WINDOW_SAMPLES / WHISPER_RATE
+        for segment in window_segments:
+            entry = dict(segment, start=segment['start'] + offset, end=segment['end'] + offset)
+            if 'words' in segment:
+                entry['words'] = [dict(w, start=w['start'] + offset, end=w['end'] + offset) for w in segment['words']]
+            segments.append(entry)
+    return segments
+
+
+# --- Shared service process ---
+
+def _serve(conn, batcher):
+    send_lock = threading.Lock()
+
+    def reply(i, future):
+        error = future.exception()
+        message = (i, None, str(error)) if error else (i, future.result(), None)
+        with send_lock:
+            try:
+                conn.send(message)
+            except OSError:
+                pass  # Client went away
+
+    with conn:
+        while True:
+            try:
+                i, window = conn.recv()
+            except (EOFError, OSError):
+                return
+            batcher.submit(window).add_done_callback(lambda future, i=i: reply(i, future))
+
+
+def service_main(address, threads, event_queue=None):
+    """
+    Entry point of the node's transcription service process: owns the
+    Whisper model and batches windows sent by the worker processes.
+    """
+    set_process_threads(threads)
+    if event_queue is not None:
+        events.set_forward_queue(event_queue)
+        metrics.start_forwarding(lambda delta: events.publish(metrics.FORWARD_CHANNEL, delta))
+    from app import create_app
+
+    app = create_app()
+    batcher = WindowBatcher(lambda windows: decode_windows(app, windows),
+                            batch_size=app.config.get('TRANSCRIPTION_BATCH_SIZE', 8),
+                            max_wait=app.config.get('TRANSCRIPTION_BATCH_WAIT_MS', 200) / 1000)
+    listener = Listener(address, authkey=current_process().authkey)
+    log.info("Transcription service on %s (batches of %s, %s threads)", address, batcher.batch_size, threads)
+    while True:
+        conn = listener.accept()
+        threading.Thread(target=_serve, args=(conn, batcher), daemon=True).start()
@@ -0,0 +1,588 @@
+"""
+Offline benchmark of the processing pipeline and API.
+
+    python benchmark.py                          # stub models, default lengths
+    python benchmark.py --lengths 30,600 --out bench.json
+    python benchmark.py --models real            # Demucs + Whisper tiny
+    python benchmark.py --save-baseline          # record bench_baseline.json
+    python benchmark.py --baseline bench_baseline.json --tolerance 0.2
+
+Every case runs in a fresh process against a throwaway SQLite database and
+media folder, so peak RSS is per case. Cases:
+
+    song:<seconds>  process_song_task on synthetic audio of that length
+    mix:<seconds>[x<takes>]
+                    align, denoise + mix takes of one song (process_recordings_task),
+                    with the alignment error against the take's true latency
+    score:<seconds> track the melody of a synthetic vocals stem and score a take
+                    against it (decode, pitch tracking, DTW), with the resulting score
+    list            GET /api/songs pages and lyrics fetches over a seeded library
+    startup         import + create_app + first request of a web process, with
+                    import time per top-level package; fails if the web process
+                    loaded the processing engine or an ML framework
+
+With the default stub models, separation is a mid/side centre cancel and
+transcription an energy-based segmenter, so the numbers track the pipeline
+around the models (decoding, encoding, peaks, DB, scheduling) rather than
+model speed. Exits with status 1 if a metric regressed past the tolerance.
+"""
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import resource
+import subprocess
+import tempfile
+
+METRICS = ('wall_s', 'cpu_s', 'peak_rss_mb')
+DEFAULT_BASELINE = 'bench_baseline.json'
+
+# Only processing workers may import these; API processes must stay small
+ENGINE_MODULES = ('audio_processor', 'separation', 'streaming', 'transcription', 'pipeline')
+HEAVY_MODULES = ('torch', 'torchaudio', 'whisper', 'demucs', 'julius', 'faster_whisper', 'ctranslate2',
+                 'spleeter', 'tensorflow')
+
+
+def synth_audio(path, seconds, samplerate=44100):
+    """
+    Stereo test signal: a tone per channel plus noise, so separation and
+    peaks have something to work on.
+    """
+    cmd = ["ffmpeg", "-v", "error",
+           "-f", "lavfi", "-i", f"sine=f=220:d={seconds}:sample_rate={samplerate}",
+           "-f", "lavfi", "-i", f"sine=f=330:d={seconds}:sample_rate={samplerate}",
+           "-f", "lavfi", "-i", f"anoisesrc=d={seconds}:a=0.05:r={samplerate}",
+           "-filter_complex", "[0:a][2:a]amix=inputs=2[l];[1:a][2:a]amix=inputs=2[r];[l][r]join=inputs=2:channel_layout=stereo",
+           "-y", path]
+    subprocess.run(cmd, check=True)
+    return path
+
+
+def _usage():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def _peak_rss_mb():
+    # ru_maxrss is KiB on Linux; ffmpeg children are reported separately
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    return round(own, 1), round(children, 1)
+
+
+class StageTimer:
+    """
+    Wraps module functions to add up the wall time spent in each.
+    """
+
+    def __init__(self):
+        self.stages = {}
+
+    def wrap(self, module, name, label=None):
+        fn = getattr(module, name)
+        label = label or name
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.stages[label] = round(self.stages.get(label, 0) + time.perf_counter() - start, 4)
+
+        setattr(module, name, timed)
+
+
+# --- Stub models ---
+
+class StubSeparator:
+    """
+    Stands in for DemucsEngine: removes the centre of the mix (L - R) chunk
+    by chunk and writes the stems, returning Stems like the real one (the
+    centre is the "vocals").
+    """
+
+    samplerate = 44100
+
+    def __init__(self):
+        import types
+        self.model = types.SimpleNamespace(audio_channels=2)
+
+    def instrumental_path(self, filepath, output_dir):
+        base_name = os.path.splitext(os.path.basename(filepath))[0]
+        return os.path.join(output_dir, 'stub', base_name, 'no_vocals.wav')
+
+    def separate(self, filepath, output_dir, on_progress=None, audio=None, keep_vocals=False):
+        import numpy as np
+        from audio_io import AudioBuffer, PartialWavWriter, decode_audio
+        from separation import Stems, vocals_path
+
+        if audio is None:
+            audio = decode_audio(filepath, self.samplerate, 2)
+        samples = audio.samples
+        accompaniment = np.empty(samples.shape, dtype=np.float32)
+        chunk = 30 * self.samplerate
+        for start in range(0, samples.shape[1], chunk):
+            side = (samples[0, start:start + chunk] - samples[1, start:start + chunk]) / 2
+            accompaniment[0, start:start + chunk] = side
+            accompaniment[1, start:start + chunk] = -side
+            if on_progress:
+                on_progress(100 * min(1, (start + chunk) / samples.shape[1]))
+
+        path = self.instrumental_path(filepath, output_dir)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        writer = PartialWavWriter(path, self.samplerate, 2)
+        writer.append(accompaniment)
+        writer.close()
+        vocals = None
+        if keep_vocals:
+            centre = (samples[0] + samples[1]) / 2
+            vocals = AudioBuffer(np.stack([centre, centre]), self.samplerate, path=vocals_path(path))
+            writer = PartialWavWriter(vocals.path, self.samplerate, 2)
+            writer.append(vocals.samples)
+            writer.close()
+        return Stems(AudioBuffer(accompaniment, self.samplerate, path=path), vocals)
+
+
+def stub_transcribe(app, filepath, on_progress=None, audio=None):
+    """
+    Stands in for Whisper: one segment per 5 s window with any energy.
+    """
+    import numpy as np
+    from audio_io import decode_audio
+    from transcription import WHISPER_RATE
+
+    mono = audio.mono(WHISPER_RATE) if audio is not None else decode_audio(filepath, WHISPER_RATE, 1).samples[0]
+    window = 5 * WHISPER_RATE
+    segments = []
+    for i, start in enumerate(range(0, len(mono), window)):
+        if np.sqrt(np.mean(mono[start:start + window] ** 2)) > 1e-3:
+            segments.append({'start': start / WHISPER_RATE, 'end': min(len(mono), start + window) / WHISPER_RATE,
+                             'text': f'line {i}'})
+        if on_progress:
+            on_progress(100 * min(1, (start + window) / len(mono)))
+    return segments
+
+
+# --- Cases (run in the child process) ---
+
+def make_app(workdir, models):
+    os.chdir(workdir)
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    from app import create_app
+    from models import db
+
+    app = create_app()
+    if models == 'real':
+        app.config['WHISPER_MODEL'] = 'tiny'
+    with app.app_context():
+        db.create_all()
+    return app
+
+
+def make_user(app):
+    from models import db, User
+
+    with app.app_context():
+        user = User(username='bench', email='bench@example.com', password_hash='x')
+        db.session.add(user)
+        db.session.commit()
+        return user.id
+
+
+def case_song(app, seconds, models):
+    import audio_processor
+    from models import db, Song
+
+    timer = StageTimer()
+    if models == 'stub':
+        separator = StubSeparator()
+        audio_processor.inprocess_engine = lambda app: separator
+        audio_processor.transcribe_lyrics = stub_transcribe
+        app.config['PROCESSING_MODE'] = 'batch'  # The streaming path needs torch
+    for name, label in (('decode_for_app', 'decode'), ('separate_vocals', 'separate'),
+                        ('transcribe_lyrics', 'transcribe'), ('encode_instrumental', 'encode'),
+                        ('compute_waveform_peaks', 'peaks'), ('measure_instrumental_loudness', 'loudness'),
+                        ('extract_melody', 'melody'), ('finalize_song', 'finalize')):
+        timer.wrap(audio_processor, name, label)
+
+    user_id = make_user(app)
+    upload_dir = os.path.join(app.config['UPLOAD_FOLDER'], 'uploads', str(user_id))
+    os.makedirs(upload_dir, exist_ok=True)
+    filepath = synth_audio(os.path.join(upload_dir, f'synth_{seconds}.wav'), seconds)
+    with app.app_context():
+        song = Song(title='bench', filename=os.path.basename(filepath), user_id=user_id, duration=seconds)
+        db.session.add(song)
+        db.session.commit()
+        song_id = song.id
+
+    start = time.perf_counter()
+    audio_processor.process_song_task(song_id, filepath, app)
+    wall = time.perf_counter() - start
+    with app.app_context():
+        status = Song.query.get(song_id).status
+    if status != 'ready':
+        raise RuntimeError(f"song finished with status {status}")
+    return wall, timer.stages
+
+
+def case_mix(app, seconds, models, takes=1, latency=0.15):
+    """
+    Mix ``takes`` recordings of one song. Each take is the instrumental as
+    picked up by the mic ``latency`` seconds late, plus a sung tone, so the
+    offset the mixer applied can be checked against the true one.
+    """
+    import mixing
+    import mix_engine
+    from models import db, Song, Recording
+
+    timer = StageTimer()
+    timer.wrap(mixing, 'render_recording', 'render')
+    timer.wrap(mix_engine, 'measure_loudness', 'instrumental_loudness')
+    timer.wrap(mix_engine, '_prepare', 'decode_take')
+    timer.wrap(mix_engine, 'align', 'align')
+    user_id = make_user(app)
+    rec_dir = os.path.join(app.config['UPLOAD_FOLDER'], 'recordings')
+    os.makedirs(rec_dir, exist_ok=True)
+    instrumental = os.path.join(app.config['UPLOAD_FOLDER'], 'instrumentals', 'bench.wav')
+    # Tones and noise plus two click trains, so there are onsets to line up
+    beat = f"aevalsrc=0.4*sin(2*PI*880*t)*(exp(-40*mod(t\\,0.37))+exp(-40*mod(t\\,0.61))):d={seconds}:s=44100"
+    subprocess.run(["ffmpeg", "-v", "error", "-i", synth_audio(instrumental + '.tmp.wav', seconds),
+                    "-f", "lavfi", "-i", beat, "-filter_complex", "[0:a][1:a]amix=inputs=2:normalize=0",
+                    "-f", "wav", "-y", instrumental], check=True)
+    os.remove(instrumental + '.tmp.wav')
+
+    recording_ids = []
+    with app.app_context():
+        song = Song(title='bench', filename='bench.wav', user_id=user_id, status='ready',
+                    instrumental_path=instrumental)
+        db.session.add(song)
+        db.session.commit()
+        for i in range(takes):
+            take = f'rec_bench_{i}.webm'
+            subprocess.run(["ffmpeg", "-v", "error", "-i", instrumental,
+                            "-f", "lavfi", "-i", f"sine=f={440 + 20 * i}:d={seconds}",
+                            "-filter_complex", f"[0:a]pan=mono|c0=0.5*c0+0.5*c1,adelay={int(latency * 1000)},"
+                            "volume=0.3[bleed];[1:a][bleed]amix=inputs=2:duration=first",
+                            "-c:a", "libopus", "-y", os.path.join(rec_dir, take)], check=True)
+            recording = Recording(filename=take, raw_filename=take, song_id=song.id, user_id=user_id,
+                                  status='processing')
+            db.session.add(recording)
+            db.session.commit()
+            recording_ids.append(recording.id)
+
+    start = time.perf_counter()
+    mixed = mixing.process_recordings_task(recording_ids, app)
+    wall = time.perf_counter() - start
+    if not all(mixed.values()):
+        raise RuntimeError("mixing failed")
+    with app.app_context():
+        offsets = [Recording.query.get(i).offset_ms for i in recording_ids]
+    # How far the applied offset is from the true one (amix applies none)
+    errors = [abs((offset or 0) - 1000 * latency) for offset in offsets]
+    timer.stages['align_error_ms'] = round(max(errors), 1)
+    return wall, timer.stages
+
+
+def synth_melody(path, seconds, delay=0.0, off_key_every=0, samplerate=44100):
+    """
+    A sung line: held notes with vibrato and harmonics, one per half
+    second, in 8 s phrases with a rest between. With ``off_key_every`` every
+    nth phrase is a minor third sharp. Returns the phrases' (start, end).
+    """
+    import numpy as np
+    from audio_io import PartialWavWriter
+
+    rng = np.random.default_rng(0)
+    samples = np.zeros(int(seconds * samplerate), dtype=np.float32)
+    phrases = []
+    for index, start in enumerate(np.arange(1.0, seconds - 9, 9.0)):
+        phrases.append((float(start), float(start + 8)))
+        shift = 3 if off_key_every and index % off_key_every == off_key_every - 1 else 0
+        for note_start in np.arange(start, start + 8, 0.5):
+            note = rng.integers(48, 76) + shift
+            n = int(0.45 * samplerate)
+            t = np.arange(n) / samplerate
+            phase = 2 * np.pi * np.cumsum(440 * 2 ** ((note - 69 + 0.3 * np.sin(2 * np.pi * 5 * t)) / 12)) / samplerate
+            tone = sum(a * np.sin(h * phase) for h, a in ((1, 1), (2, 0.5), (3, 0.3), (4, 0.2)))
+            at = int((note_start + delay) * samplerate)
+            samples[at:at + n] += 0.2 * tone[:len(samples) - at]
+    samples += 0.003 * rng.standard_normal(len(samples)).astype(np.float32)
+    writer = PartialWavWriter(path, samplerate, 1)
+    writer.append(samples[None, :])
+    writer.close()
+    return phrases
+
+
+def case_score(app, seconds, latency=0.15):
+    """
+    Track the melody of a vocals stem, then score a take of it sung
+    ``latency`` seconds late with every fourth phrase off key (so the
+    expected score is about 75).
+    """
+    import scoring
+    import mix_engine
+    from audio_io import decode_for_app
+
+    timer = StageTimer()
+    timer.wrap(scoring, 'pitch_contour', 'pitch')
+    timer.wrap(scoring, 'dtw_band', 'dtw')
+    folder = os.path.join(app.config['UPLOAD_FOLDER'], 'instrumentals', 'bench')
+    os.makedirs(folder, exist_ok=True)
+    vocals = os.path.join(folder, 'vocals.wav')
+    phrases = [{'start': start, 'end': end, 'text': f'line {i}'}
+               for i, (start, end) in enumerate(synth_melody(vocals, seconds))]
+    take = os.path.join(folder, 'take.wav')
+    synth_melody(take, seconds, delay=latency, off_key_every=4)
+    subprocess.run(["ffmpeg", "-v", "error", "-i", take, "-c:a", "libopus", "-y", take + '.webm'], check=True)
+
+    with app.app_context():
+        start = time.perf_counter()
+        scoring.extract_reference(app, vocals, os.path.join(folder, 'no_vocals.wav'))
+        reference = scoring.load_reference(os.path.join(folder, 'no_vocals.wav'))
+        timer.stages['reference'] = round(time.perf_counter() - start, 4)
+        # Only the take is timed: the reference is tracked once per song
+        timer.stages.pop('pitch', None)
+        # The mixer hands over the take it already decoded, so that decode isn't scoring's cost
+        start = time.perf_counter()
+        audio = decode_for_app(app, take + '.webm', mix_engine.MIX_RATE, 1)
+        timer.stages['decode'] = round(time.perf_counter() - start, 4)
+        start = time.perf_counter()
+        result = scoring.score_recording(app, audio, reference, phrases, offset=latency)
+        wall = time.perf_counter() - start
+    timer.stages['score'] = result['score']
+    return wall, timer.stages
+
+
+def case_list(app, songs=1000, pages=20):
+    from flask_jwt_extended import create_access_token
+    from models import db, Song
+
+    user_id = make_user(app)
+    lyrics = json.dumps([{'start': i * 4.0, 'end': i * 4.0 + 3.5, 'text': f'line number {i}'} for i in range(60)])
+    with app.app_context():
+        db.session.bulk_save_objects([
+            Song(title=f'song {i}', filename=f'{i}.wav', user_id=user_id, status='ready', duration=200,
+                 instrumental_path=os.path.join(app.config['UPLOAD_FOLDER'], 'instrumentals', f'{i}.wav'),
+                 lyrics_json=lyrics)
+            for i in range(songs)])
+        db.session.commit()
+        token = create_access_token(identity=str(user_id))
+
+    client = app.test_client()
+    headers = {'Authorization': f'Bearer {token}'}
+    stages = {'first_page': [], 'next_page': [], 'lyrics': [], 'lyrics_304': []}
+
+    def timed(label, *args, **kwargs):
+        start = time.perf_counter()
+        response = client.get(*args, **kwargs)
+        stages[label].append(time.perf_counter() - start)
+        return response
+
+    start = time.perf_counter()
+    for _ in range(pages):
+        response = timed('first_page', '/api/songs?limit=50', headers=headers)
+        cursor = response.headers.get('X-Next-Cursor')
+        while cursor:
+            response = timed('next_page', f'/api/songs?limit=50&cursor={cursor}', headers=headers)
+            cursor = response.headers.get('X-Next-Cursor')
+    for song_id in range(1, 101):
+        etag = timed('lyrics', f'/api/songs/{song_id}/lyrics', headers=headers).headers['ETag']
+        timed('lyrics_304', f'/api/songs/{song_id}/lyrics', headers={**headers, 'If-None-Match': etag})
+    wall = time.perf_counter() - start
+
+    summary = {}
+    for label, times in stages.items():
+        times.sort()
+        summary[f'{label}_p50_ms'] = round(1000 * times[len(times) // 2], 2)
+        summary[f'{label}_p95_ms'] = round(1000 * times[int(len(times) * 0.95)], 2)
+    return wall, summary
+
+
+def import_footprint(top=10):
+    """
+    Self import time per top-level package (ms) for ``import app`` in a fresh
+    interpreter, from ``python -X importtime``. The ``top`` largest.
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import app'], stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    totals = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        self_us, _, name = line[len('import time:'):].split('|')
+        if not self_us.strip().isdigit():
+            continue  # Header
+        package = name.strip().split('.')[0]
+        totals[package] = totals.get(package, 0) + int(self_us)
+    largest = sorted(totals.items(), key=lambda item: -item[1])[:top]
+    return {f'import_{package}_ms': round(us / 1000, 1) for package, us in largest}
+
+
+def case_startup(workdir):
+    """
+    Boot the web app the way an API process does, timing each step.
+    """
+    os.chdir(workdir)
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    before = set(sys.modules)
+    start = time.perf_counter()
+    from app import create_app
+    imported = time.perf_counter()
+    app = create_app()
+    created = time.perf_counter()
+    # Unauthenticated, so it exercises routing and JWT without the database
+    app.test_client().get('/api/songs')
+    served = time.perf_counter()
+
+    loaded = set(sys.modules) - before
+    leaked = sorted(m for m in loaded if m.split('.')[0] in ENGINE_MODULES + HEAVY_MODULES)
+    if leaked:
+        raise RuntimeError(f"Web process imported {', '.join(leaked)}")
+    stages = {'import_app': round(imported - start, 4), 'create_app': round(created - imported, 4),
+              'first_request': round(served - created, 4), 'modules_loaded': len(loaded)}
+    return served - start, stages
+
+
+def run_case(name, workdir, models):
+    """
+    Run one case in this process and return its measurements.
+    """
+    kind, _, arg = name.partition(':')
+    # startup times the app import itself, so it can't go through make_app
+    app = make_app(workdir, models) if kind != 'startup' else None
+    cpu_start = _usage()
+    if kind == 'startup':
+        wall, stages = case_startup(workdir)
+    elif kind == 'song':
+        wall, stages = case_song(app, float(arg), models)
+    elif kind == 'mix':
+        seconds, _, takes = arg.partition('x')
+        wall, stages = case_mix(app, float(seconds), models, takes=int(takes or 1))
+    elif kind == 'score':
+        wall, stages = case_score(app, float(arg))
+    elif kind == 'list':
+        wall, stages = case_list(app)
+    else:
+        raise ValueError(f"Unknown case {name}")
+    rss, children_rss = _peak_rss_mb()
+    cpu = _usage() - cpu_start
+    if kind == 'startup':
+        # Measured after the totals; it runs a second interpreter
+        stages.update(import_footprint())
+    return {
+        'wall_s': round(wall, 3),
+        'cpu_s': round(cpu, 3),
+        'peak_rss_mb': rss,
+        'children_peak_rss_mb': children_rss,
+        'stages': stages,
+    }
+
+
+# --- Driver ---
+
+def spawn_case(name, models):
+    """
+    Run a case in a child process with its own database and media folder.
+    """
+    with tempfile.TemporaryDirectory(prefix='bench_') as workdir:
+        cmd = [sys.executable, os.path.abspath(__file__), '--case', name, '--workdir', workdir, '--models', models]
+        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+    if result.returncode != 0:
+        return {'error': result.stderr.strip().splitlines()[-1] if result.stderr.strip() else 'failed'}
+    # The pipeline prints progress; the result is the last line
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def compare(results, baseline, tolerance):
+    """
+    Return a list of (case, metric, baseline, current) that got worse by
+    more than ``tolerance`` (a fraction).
+    """
+    regressions = []
+    for case, current in results.items():
+        previous = baseline.get('results', {}).get(case)
+        if not previous or 'error' in current or 'error' in previous:
+            continue
+        for metric in METRICS:
+            before, after = previous.get(metric), current.get(metric)
+            if before and after is not None and after > before * (1 + tolerance):
+                regressions.append((case, metric, before, after))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--lengths', default='30,180,600', help='Synthetic song lengths in seconds')
+    parser.add_argument('--models', choices=('stub', 'real'), default='stub')
+    parser.add_argument('--cases', help='Comma-separated cases to run (default: all)')
+    parser.add_argument('--out', default='bench_results.json')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed slowdown before failing (0.2 = 20%%)')
+    parser.add_argument('--save-baseline', action='store_true', help='Write the results as the new baseline')
+    parser.add_argument('--case', help=argparse.SUPPRESS)
+    parser.add_argument('--workdir', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        print(json.dumps(run_case(args.case, args.workdir, args.models)))
+        return 0
+
+    if args.cases:
+        cases = args.cases.split(',')
+    else:
+        lengths = [int(n) for n in args.lengths.split(',')]
+        cases = [f'song:{n}' for n in lengths] + [f'mix:{min(lengths)}', f'mix:{min(lengths)}x4', 'score:240',
+                                                    'list', 'startup']
+
+    results = {}
+    for case in cases:
+        print(f"Running {case}...")
+        results[case] = spawn_case(case, args.models)
+        print(f"  {results[case]}")
+
+    report = {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'models': args.models,
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'cpus': os.cpu_count(),
+        },
+        'results': results,
+    }
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {args.out}")
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved baseline to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}; run with --save-baseline to record one")
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline.get('meta', {}).get('models') != args.models:
+        print(f"Baseline was recorded with {baseline['meta'].get('models')} models, not comparing")
+        return 0
+
+    regressions = compare(results, baseline, args.tolerance)
+    for case, metric, before, after in regressions:
+        print(f"REGRESSION {case} {metric}: {before} -> {after} (+{100 * (after / before - 1):.0f}%)")
+    failed = [case for case, result in results.items() if 'error' in result]
+    for case in failed:
+        print(f"FAILED {case}: {results[case]['error']}")
+    if not regressions and not failed:
+        print(f"No regressions against {args.baseline} (tolerance {args.tolerance:.0%})")
+    return 1 if regressions or failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,65 @@
+import os
+import logging
+import subprocess
+from audio_io import pipe_to_ffmpeg
+import metrics
+
+log = logging.getLogger(__name__)
+
+# Streamable encodings of the instrumental, written next to no_vocals.wav.
+# The WAV itself is kept only as the mixing source.
+ENCODINGS = {
+    'opus': {'ext': '.opus', 'mimetype': 'audio/ogg', 'codec': ['-c:a', 'libopus'], 'bitrate_key': 'OPUS_BITRATE'},
+    'aac': {'ext': '.m4a', 'mimetype': 'audio/mp4', 'codec': ['-c:a', 'aac', '-movflags', '+faststart'],
+            'bitrate_key': 'AAC_BITRATE'},
+    'wav': {'ext': '.wav', 'mimetype': 'audio/wav'},
+}
+
+
+def encoded_path(wav_path, fmt):
+    return os.path.splitext(wav_path)[0] + ENCODINGS[fmt]['ext']
+
+
+def configured_formats(app):
+    formats = [f.strip() for f in app.config.get('INSTRUMENTAL_FORMATS', 'opus,aac').split(',')]
+    return [f for f in formats if f in ENCODINGS and f != 'wav']
+
+
+def transcode_instrumental(app, wav_path, audio=None):
+    """
+    Encode the instrumental to every configured format in one ffmpeg run
+    (one decode, several encoders). With ``audio`` (the AudioBuffer the
+    separator produced) the samples are piped in and the WAV isn't re-read.
+    Returns {format: path}.
+    """
+    formats = configured_formats(app)
+    if not formats:
+        return {}
+
+    output_args = []
+    outputs = {}
+    for fmt in formats:
+        spec = ENCODINGS[fmt]
+        outputs[fmt] = encoded_path(wav_path, fmt)
+        output_args += spec['codec'] + ['-b:a', app.config.get(spec['bitrate_key'], '128k'), '-y', outputs[fmt]]
+
+    if audio is not None:
+        log.debug("Encoding instrumental from memory: %s", ' '.join(output_args))
+        with metrics.span('ffmpeg_seconds', op='encode'):
+            pipe_to_ffmpeg(audio, output_args)
+        return outputs
+
+    cmd = ["ffmpeg", "-v", "error", "-i", wav_path] + output_args
+    log.debug("Encoding instrumental: %s", ' '.join(cmd))
+    with metrics.span('ffmpeg_seconds', op='encode'):
+        subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    return outputs
+
+
+def available_formats(wav_path):
+    """
+    Formats that exist on disk for this instrumental.
+    """
+    if not wav_path:
+        return []
+    return [fmt for fmt in ENCODINGS if os.path.exists(encoded_path(wav_path, fmt))]
@@ -0,0 +1,113 @@
+import json
+import logging
+import queue
+import threading
+import metrics
+
+log = logging.getLogger(__name__)
+
+
+class EventBroker:
+    """
+    In-memory pub/sub for job progress. Each subscriber gets its own bounded
+    queue; slow subscribers lose old events rather than blocking publishers.
+    """
+
+    def __init__(self, max_queued=100):
+        self.max_queued = max_queued
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, channel):
+        q = queue.Queue(maxsize=self.max_queued)
+        with self._lock:
+            self._subscribers.setdefault(channel, set()).add(q)
+        return q
+
+    def unsubscribe(self, channel, q):
+        with self._lock:
+            subscribers = self._subscribers.get(channel)
+            if subscribers:
+                subscribers.discard(q)
+                if not subscribers:
+                    del self._subscribers[channel]
+
+    def publish(self, channel, event):
+        with self._lock:
+            subscribers = list(self._subscribers.get(channel, ()))
+        for q in subscribers:
+            try:
+                q.put_nowait(event)
+            except queue.Full:
+                # Progress events supersede each other, drop the oldest
+                try:
+                    q.get_nowait()
+                except queue.Empty:
+                    pass
+                try:
+                    q.put_nowait(event)
+                except queue.Full:
+                    pass
+
+
+broker = EventBroker()
+
+# Set in worker processes: events go to the web process through this queue
+_forward_queue = None
+
+
+def set_forward_queue(q):
+    global _forward_queue
+    _forward_queue = q
+
+
+def song_channel(song_id):
+    return f"song:{song_id}"
+
+
+def publish(channel, event):
+    """
+    Publish from anywhere: locally in the web process, or forwarded to it
+    from a worker process.
+    """
+    if _forward_queue is not None:
+        try:
+            _forward_queue.put_nowait((channel, event))
+        except Exception as e:
+            log.warning("Dropping event for %s: %s", channel, e)
+    else:
+        broker.publish(channel, event)
+
+
+def publish_song(song, **extra):
+    event = {
+        'id': song.id,
+        'status': song.status,
+        'progress': song.progress,
+        'stages': json.loads(song.stage_progress) if song.stage_progress else None,
+    }
+    event.update(extra)
+    publish(song_channel(song.id), event)
+
+
+def start_pump(q):
+    """
+    Fan out events forwarded by worker processes to local subscribers, and
+    fold their metrics into this process's registry.
+    """
+    def pump():
+        while True:
+            try:
+                channel, event = q.get()
+            except (EOFError, OSError):
+                return
+            if channel == metrics.FORWARD_CHANNEL:
+                metrics.registry.merge(event)
+            else:
+                broker.publish(channel, event)
+
+    threading.Thread(target=pump, daemon=True, name='event-pump').start()
+
+
+def sse_format(event, name='progress'):
+    return f"event: {name}\ndata: {json.dumps(event)}\n\n"
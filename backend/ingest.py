@@ -0,0 +1,72 @@
+import os
+import hashlib
+import tempfile
+from flask import Request, current_app
+
+
+class HashingFile:
+    """
+    Upload stream that writes straight to a file in the uploads directory
+    and hashes the bytes as Werkzeug's form parser hands them over, so the
+    body is never buffered in memory or copied a second time.
+    """
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        fd, self.path = tempfile.mkstemp(prefix='incoming_', dir=directory)
+        self._file = os.fdopen(fd, 'wb+')
+        self._sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self._sha256.update(data)
+        self.size += len(data)
+        return self._file.write(data)
+
+    def hexdigest(self):
+        return self._sha256.hexdigest()
+
+    def __getattr__(self, name):
+        # read/seek/tell/flush/close for FileStorage
+        return getattr(self._file, name)
+
+
+class IngestRequest(Request):
+    """
+    Request class whose file parts are HashingFiles under
+    UPLOAD_FOLDER/uploads/incoming. Files not claimed with ``claim_upload``
+    by the end of the request are deleted.
+    """
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        stream = HashingFile(os.path.join(current_app.config['UPLOAD_FOLDER'], 'uploads', 'incoming'))
+        if not hasattr(self, '_ingested'):
+            self._ingested = []
+        self._ingested.append(stream)
+        return stream
+
+    def close(self):
+        super().close()
+        for stream in getattr(self, '_ingested', ()):
+            if os.path.exists(stream.path):
+                os.remove(stream.path)
+
+
+def claim_upload(file, dest_path):
+    """
+    Move an uploaded file to ``dest_path`` and return the sha256 of its
+    bytes. A rename when it was ingested by IngestRequest; otherwise the
+    file is copied and hashed the slow way.
+    """
+    stream = file.stream
+    if isinstance(stream, HashingFile):
+        stream.flush()
+        os.replace(stream.path, dest_path)
+        return stream.hexdigest()
+
+    file.save(dest_path)
+    digest = hashlib.sha256()
+    with open(dest_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 16), b''):
+            digest.update(block)
+    return digest.hexdigest()
@@ -0,0 +1,558 @@
+import os
+import json
+import heapq
+import logging
+import socket
+import tempfile
+import threading
+import time
+import multiprocessing
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import func
+from models import db, Song, Recording, Job
+from scheduling import DEFAULT_PRIORITY, Preempted, estimate_seconds, remaining_seconds, schedule_order, should_yield
+from mixing import process_recordings_task
+from model_registry import available_memory_mb
+from storage import instrumental_source, song_upload_path, start_collector
+import events
+import metrics
+import variants
+
+log = logging.getLogger(__name__)
+
+
+def default_worker_count(job_memory_mb=3000):
+    """
+    Size the worker pool to the machine: Demucs wants a couple of cores per job
+    and Demucs + Whisper together need a few GB of RAM per job.
+    """
+    cpus = os.cpu_count() or 1
+    count = max(1, cpus // 2)
+    free = available_memory_mb()
+    if free is not None:
+        count = min(count, max(1, free // job_memory_mb))
+    return count
+
+
+# --- Queue operations ---
+
+def enqueue_song(song, priority=DEFAULT_PRIORITY):
+    """
+    Queue a processing job for the song. Commits the session.
+    """
+    job = Job(song_id=song.id, user_id=song.user_id, status='queued', priority=priority,
+              est_seconds=estimate_seconds(current_app, 'song', song.duration))
+    db.session.add(job)
+    db.session.commit()
+    return job
+
+
+def enqueue_recording(recording):
+    """
+    Queue the denoise + mix job for a recording. Commits the session.
+    """
+    # Someone is waiting on the result, so it goes ahead of song processing
+    song = Song.query.get(recording.song_id)
+    job = Job(kind='mix', song_id=recording.song_id, recording_id=recording.id,
+              user_id=recording.user_id, status='queued', priority='interactive',
+              est_seconds=estimate_seconds(current_app, 'mix', song.duration if song else None))
+    db.session.add(job)
+    db.session.commit()
+    return job
+
+
+def supports_skip_locked():
+    return db.engine.dialect.name in ('postgresql', 'mysql')
+
+
+def lease_deadline(app):
+    return datetime.utcnow() + timedelta(seconds=app.config.get('JOB_LEASE_SECONDS', 60))
+
+
+def _claim_values(worker_name):
+    return {
+        'status': 'running',
+        'worker': worker_name,
+        'started_at': datetime.utcnow(),
+        'heartbeat_at': datetime.utcnow(),
+        'lease_expires_at': lease_deadline(current_app),
+        'attempts': Job.attempts + 1,
+    }
+
+
+def claim_next_job(worker_name):
+    """
+    Atomically claim the next queued job, or return None if the queue is empty.
+
+    Across users, jobs of the user with the fewest running jobs go first, so
+    one user's batch upload cannot starve everyone else. Otherwise the order
+    is weighted shortest-job-first with aging (see scheduling.py), so a long
+    DJ mix doesn't hold up three-minute songs.
+
+    The claim is a lease: the worker must heartbeat before ``lease_expires_at``
+    or the job goes back to the queue (see ``expire_leases``).
+    """
+    skip_locked = supports_skip_locked()
+    while True:
+        queued = Job.query.filter(Job.status == 'queued').all()
+        if not queued:
+            return None
+
+        running = dict(db.session.query(Job.user_id, func.count(Job.id))
+                       .filter(Job.status == 'running').group_by(Job.user_id).all())
+        order = [j.id for j in schedule_order(current_app, queued, running)]
+        claim = _claim_values(worker_name)
+
+        if skip_locked:
+            # Lock the best row nobody else is claiming; concurrent workers
+            # skip it instead of queueing behind the lock and then losing
+            for job_id in order:
+                row = Job.query.filter_by(id=job_id, status='queued') \
+                    .with_for_update(skip_locked=True).first()
+                if row is None:
+                    continue
+                Job.query.filter_by(id=job_id).update(claim, synchronize_session=False)
+                db.session.commit()
+                return Job.query.get(job_id)
+            db.session.commit()
+            return None
+
+        # SQLite: compare-and-set so two workers never claim the same job
+        claimed = Job.query.filter_by(id=order[0], status='queued').update(claim, synchronize_session=False)
+        db.session.commit()
+        if claimed:
+            return Job.query.get(order[0])
+
+
+def claim_sibling_mixes(job, worker_name, limit):
+    """
+    Claim up to ``limit`` more queued mix jobs for the same song as ``job``,
+    so their takes are mixed in one pass over its instrumental. Each is
+    claimed compare-and-set like any other, so no other worker gets them.
+    """
+    if limit <= 0:
+        return []
+    candidates = Job.query.filter(Job.kind == 'mix', Job.status == 'queued', Job.song_id == job.song_id) \
+        .order_by(Job.created_at).limit(limit).all()
+    claimed = []
+    for candidate in candidates:
+        if Job.query.filter_by(id=candidate.id, status='queued') \
+                .update(_claim_values(worker_name), synchronize_session=False):
+            claimed.append(candidate.id)
+    db.session.commit()
+    return [Job.query.get(job_id) for job_id in claimed]
+
+
+def heartbeat(app, worker_name):
+    """
+    Extend the lease on the job this worker is running. Returns False if the
+    worker no longer holds a lease (it expired and the job was re-queued).
+    """
+    renewed = Job.query.filter_by(worker=worker_name, status='running').update({
+        'heartbeat_at': datetime.utcnow(),
+        'lease_expires_at': lease_deadline(app),
+    }, synchronize_session=False)
+    db.session.commit()
+    return renewed > 0
+
+
+class Heartbeat:
+    """
+    Background thread renewing a worker's lease every JOB_HEARTBEAT_INTERVAL
+    seconds while it runs a job, so a job that takes an hour keeps its claim
+    but one whose worker died or hung is picked up elsewhere.
+    """
+
+    def __init__(self, app, worker_name):
+        self.app = app
+        self.worker_name = worker_name
+        self._wake = threading.Event()
+        self._running = False
+        threading.Thread(target=self._loop, daemon=True, name='heartbeat').start()
+
+    def job_started(self):
+        self._running = True
+
+    def job_finished(self):
+        self._running = False
+
+    def _loop(self):
+        interval = self.app.config.get('JOB_HEARTBEAT_INTERVAL', 15)
+        with self.app.app_context():
+            while not self._wake.wait(interval):
+                if not self._running:
+                    continue
+                try:
+                    if not heartbeat(self.app, self.worker_name) and self._running:
+                        log.warning("Worker %s lost the lease on its job", self.worker_name)
+                except Exception as e:
+                    log.warning("Worker %s heartbeat failed: %s", self.worker_name, e)
+                    metrics.inc('errors_total', where='heartbeat')
+                    db.session.rollback()
+                finally:
+                    db.session.remove()
+
+
+def _record_finish(job, status):
+    metrics.inc('jobs_finished_total', kind=job.kind, status=status)
+    if job.started_at:
+        metrics.observe('job_duration_seconds', (datetime.utcnow() - job.started_at).total_seconds(),
+                        kind=job.kind, status=status)
+
+
+def finish_job(job, status):
+    job.status = status
+    job.finished_at = datetime.utcnow()
+    job.lease_expires_at = None
+    db.session.commit()
+    _record_finish(job, status)
+
+
+def queue_depth():
+    """
+    Queued and running jobs by kind, for the /metrics gauge.
+    """
+    rows = db.session.query(Job.kind, Job.status, func.count(Job.id)) \
+        .filter(Job.status.in_(['queued', 'running'])).group_by(Job.kind, Job.status).all()
+    depth = {(('kind', kind), ('status', status)): 0 for kind in ('song', 'mix') for status in ('queued', 'running')}
+    for kind, status, count in rows:
+        depth[(('kind', kind), ('status', status))] = count
+    return depth
+
+
+metrics.gauge('job_queue_depth', 'Jobs waiting or running, by kind', queue_depth)
+
+
+def queue_positions(song_ids):
+    """
+    Map song id -> 1-based position in the global queue for queued songs.
+    """
+    if not song_ids:
+        return {}
+    running = dict(db.session.query(Job.user_id, func.count(Job.id))
+                   .filter(Job.status == 'running').group_by(Job.user_id).all())
+    queued = schedule_order(current_app, Job.query.filter(Job.status == 'queued').all(), running)
+    wanted = set(song_ids)
+    return {job.song_id: i + 1 for i, job in enumerate(queued)
+            if job.kind == 'song' and job.song_id in wanted}
+
+
+def estimate_completions(app, song_ids):
+    """
+    Map song id -> estimated seconds until its job finishes, for queued and
+    running songs. Replays the schedule over the worker pool: each queued
+    job starts when the earliest worker frees up.
+    """
+    if not song_ids:
+        return {}
+    running_jobs = Job.query.filter(Job.status == 'running').all()
+    progress = dict(db.session.query(Song.id, Song.progress)
+                    .filter(Song.id.in_([j.song_id for j in running_jobs])).all())
+    etas = {}
+    free_at = []
+    for job in running_jobs:
+        remaining = remaining_seconds(job, progress.get(job.song_id) if job.kind == 'song' else 0)
+        free_at.append(remaining)
+        if job.kind == 'song':
+            etas[job.song_id] = remaining
+    # Workers on other nodes show up as running jobs
+    size = max(app.config.get('WORKER_COUNT') or default_worker_count(), len(running_jobs))
+    free_at += [0.0] * max(0, size - len(free_at))
+    heapq.heapify(free_at)
+
+    running_by_user = {}
+    for job in running_jobs:
+        running_by_user[job.user_id] = running_by_user.get(job.user_id, 0) + 1
+    for job in schedule_order(app, Job.query.filter(Job.status == 'queued').all(), running_by_user):
+        finish = heapq.heappop(free_at) + remaining_seconds(job, 0)
+        heapq.heappush(free_at, finish)
+        if job.kind == 'song':
+            etas[job.song_id] = finish
+
+    wanted = set(song_ids)
+    return {song_id: round(eta) for song_id, eta in etas.items() if song_id in wanted}
+
+
+def _requeue_interrupted(app, jobs):
+    """
+    Put interrupted jobs back in the queue. Jobs that keep killing workers
+    are failed after JOB_MAX_ATTEMPTS.
+    """
+    max_attempts = app.config.get('JOB_MAX_ATTEMPTS', 3)
+    for job in jobs:
+        if job.attempts >= max_attempts:
+            log.error("Job %s failed after %s attempts", job.id, job.attempts)
+            metrics.inc('jobs_finished_total', kind=job.kind, status='failed')
+            job.status = 'failed'
+            job.finished_at = datetime.utcnow()
+            target = Recording.query.get(job.recording_id) if job.kind == 'mix' else Song.query.get(job.song_id)
+            if target:
+                target.status = 'error'
+        else:
+            log.warning("Re-queueing interrupted job %s (worker %s)", job.id, job.worker)
+            job.status = 'queued'
+            job.worker = None
+        job.lease_expires_at = None
+
+
+def expire_leases(app):
+    """
+    Re-queue running jobs whose worker stopped heartbeating, wherever it ran.
+    Rows without a lease predate leasing and count as expired.
+    """
+    query = Job.query.filter(Job.status == 'running',
+                             (Job.lease_expires_at < datetime.utcnow()) | (Job.lease_expires_at.is_(None)))
+    if supports_skip_locked():
+        query = query.with_for_update(skip_locked=True)
+    expired = query.all()
+    _requeue_interrupted(app, expired)
+    db.session.commit()
+    return len(expired)
+
+
+def recover_jobs(app, worker=None):
+    """
+    Re-queue work that was interrupted: a single local worker's job if
+    ``worker`` is given, otherwise (at startup) every job whose lease ran out,
+    plus processing songs that lost their job row. Jobs on other nodes with
+    a live lease are left alone.
+    """
+    if worker:
+        _requeue_interrupted(app, Job.query.filter_by(status='running', worker=worker).all())
+    else:
+        expire_leases(app)
+        # Songs uploaded before the job table existed, or whose job row was lost
+        active = db.session.query(Job.song_id).filter(Job.kind == 'song', Job.status.in_(['queued', 'running']))
+        for song in Song.query.filter(Song.status == 'processing', ~Song.id.in_(active)).all():
+            log.warning("Queueing orphaned song %s", song.id)
+            db.session.add(Job(song_id=song.id, user_id=song.user_id, status='queued', priority='rerun',
+                               est_seconds=estimate_seconds(app, 'song', song.duration)))
+
+    db.session.commit()
+
+
+# --- Workers ---
+
+def _lost_lease(job, worker_name):
+    """
+    True if the job was re-queued (and maybe claimed elsewhere) while this
+    worker was running it, so this worker must not record the outcome.
+    """
+    if worker_name is None or job.worker == worker_name:
+        return False
+    log.warning("Job %s was re-assigned while running on %s, discarding its outcome", job.id, worker_name)
+    return True
+
+
+def run_job(app, job_id, worker_name=None):
+    job = Job.query.get(job_id)
+    if job.kind == 'mix':
+        batch = [job]
+        if worker_name is not None:
+            batch += claim_sibling_mixes(job, worker_name, app.config.get('MIX_BATCH_SIZE', 8) - 1)
+        batch_ids = {j.id: j.recording_id for j in batch}
+        if len(batch) > 1:
+            log.info("Mixing jobs %s together (song %s)", sorted(batch_ids), job.song_id)
+        mixed = process_recordings_task(list(batch_ids.values()), app)
+        for batch_job_id, recording_id in batch_ids.items():
+            batch_job = Job.query.get(batch_job_id)
+            if batch_job is not None and not _lost_lease(batch_job, worker_name):
+                finish_job(batch_job, 'done' if mixed.get(recording_id) else 'failed')
+        return
+
+    from audio_processor import process_song_task
+
+    song = Song.query.get(job.song_id)
+    if song is None:
+        # Deleted while queued
+        finish_job(job, 'failed')
+        return
+
+    # process_song_task pushes its own app context, which removes our
+    # session on exit, so reload everything afterwards.
+    checkpoint = json.loads(job.checkpoint) if job.checkpoint else None
+    try:
+        process_song_task(song.id, song_upload_path(app, song), app, checkpoint=checkpoint,
+                          should_yield=lambda progress: should_yield(app, Job.query.get(job_id), progress))
+    except Preempted as e:
+        # Back in the queue with its place kept (created_at keeps aging)
+        job = Job.query.get(job_id)
+        if _lost_lease(job, worker_name):
+            return
+        log.info("Job %s preempted at a chunk boundary", job_id)
+        _record_finish(job, 'preempted')
+        job.status = 'queued'
+        job.worker = None
+        job.lease_expires_at = None
+        job.checkpoint = json.dumps(e.checkpoint)
+        job.preemptions = (job.preemptions or 0) + 1
+        song = Song.query.get(job.song_id)
+        job.est_seconds = remaining_seconds(job, song.progress if song else 0)
+        job.attempts = max(0, job.attempts - 1)  # Yielding isn't a failed attempt
+        db.session.commit()
+        return
+
+    job = Job.query.get(job_id)
+    if _lost_lease(job, worker_name):
+        return
+    song = Song.query.get(job.song_id)
+    finish_job(job, 'done' if song and song.status == 'ready' else 'failed')
+    if song and song.status == 'ready':
+        # Have the shifts singers pick most waiting before the first play (renders outlive the job)
+        variants.prerender_popular(app, song.id, instrumental_source(song.instrumental_path),
+                                   app.config['INSTRUMENTAL_DEFAULT_FORMAT'])
+
+
+def worker_loop(app, worker_name, stop_event=None):
+    poll_interval = app.config.get('JOB_POLL_INTERVAL', 1.0)
+    sweep_interval = app.config.get('JOB_LEASE_SECONDS', 60) / 2
+    last_sweep = 0.0
+    log.info("Worker %s started", worker_name)
+    beat = Heartbeat(app, worker_name)
+    with app.app_context():
+        while not (stop_event and stop_event.is_set()):
+            # Any node may pick up jobs left behind by a dead one
+            if time.monotonic() - last_sweep >= sweep_interval:
+                last_sweep = time.monotonic()
+                try:
+                    expired = expire_leases(app)
+                    if expired:
+                        log.warning("Re-queued %s job(s) with expired leases", expired)
+                except Exception as e:
+                    log.error("Worker %s failed to expire leases: %s", worker_name, e)
+                    db.session.rollback()
+
+            try:
+                job = claim_next_job(worker_name)
+            except Exception as e:
+                log.error("Worker %s failed to claim a job: %s", worker_name, e)
+                metrics.inc('errors_total', where='claim')
+                db.session.rollback()
+                job = None
+
+            if job is None:
+                time.sleep(poll_interval)
+                continue
+
+            job_id = job.id
+            log.info("Worker %s running %s job %s (song %s)", worker_name, job.kind, job_id, job.song_id)
+            beat.job_started()
+            try:
+                run_job(app, job_id, worker_name)
+            except Exception as e:
+                log.exception("Job %s crashed: %s", job_id, e)
+                db.session.rollback()
+                job = Job.query.get(job_id)
+                if job and not _lost_lease(job, worker_name):
+                    finish_job(job, 'failed')
+            finally:
+                beat.job_finished()
+                db.session.remove()
+
+
+def local_worker_name(pid=None):
+    return f"{socket.gethostname()}:{pid or os.getpid()}"
+
+
+def _worker_process_main(threads, event_queue=None, transcription_address=None):
+    from pipeline import set_process_threads
+
+    # Split the cores between workers before torch is imported
+    set_process_threads(threads)
+    if event_queue is not None:
+        events.set_forward_queue(event_queue)
+        # Metrics are aggregated in the web process, which serves /metrics
+        metrics.start_forwarding(lambda delta: events.publish(metrics.FORWARD_CHANNEL, delta))
+    from app import create_app
+    app = create_app()
+    app.config['TRANSCRIPTION_SERVICE_ADDRESS'] = transcription_address
+    worker_loop(app, local_worker_name())
+
+
+class WorkerPool:
+    """
+    Fixed-size pool of worker processes pulling jobs from the Job table.
+    A supervisor thread respawns dead workers and re-queues their job.
+    """
+
+    def __init__(self, app, size=None):
+        self.app = app
+        self.size = size or app.config.get('WORKER_COUNT') or default_worker_count()
+        self.threads = max(1, (os.cpu_count() or 1) // self.size)
+        self._ctx = multiprocessing.get_context('spawn')
+        self._procs = []
+        self._stop = threading.Event()
+        # Progress events from the workers, fanned out to SSE subscribers here
+        self._events = self._ctx.Queue()
+        self._service = None
+        self._service_address = None
+
+    def start(self):
+        with self.app.app_context():
+            recover_jobs(self.app)
+        events.start_pump(self._events)
+        start_collector(self.app)
+        log.info("Starting %s processing worker(s), %s thread(s) each", self.size, self.threads)
+        self._start_transcription_service()
+        self._procs = [self._spawn() for _ in range(self.size)]
+        threading.Thread(target=self._supervise, daemon=True).start()
+        return self
+
+    def stop(self):
+        """
+        Terminate the workers and put their jobs straight back in the queue,
+        rather than waiting for the leases to run out.
+        """
+        self._stop.set()
+        if self._service is not None:
+            self._service.terminate()
+        for p in self._procs:
+            p.terminate()
+        for p in self._procs:
+            p.join(timeout=10)
+        with self.app.app_context():
+            for p in self._procs:
+                recover_jobs(self.app, worker=local_worker_name(p.pid))
+            db.session.remove()
+
+    def _spawn(self):
+        p = self._ctx.Process(target=_worker_process_main,
+                              args=(self.threads, self._events, self._service_address), daemon=True)
+        p.start()
+        return p
+
+    def _start_transcription_service(self):
+        """
+        With the batched Whisper backend, start the process that owns the
+        model and batches the workers' windows. Workers fall back to
+        decoding themselves while it is down.
+        """
+        from transcription import backend_name, BatchedWhisperBackend
+
+        if backend_name(self.app) != BatchedWhisperBackend.name:
+            return
+        from batch_transcription import service_main
+
+        if self._service_address is None:
+            self._service_address = os.path.join(tempfile.mkdtemp(prefix='transcription-'), 'service.sock')
+        elif os.path.exists(self._service_address):
+            os.remove(self._service_address)  # Left behind by a crashed service
+        threads = self.app.config.get('TRANSCRIPTION_SERVICE_THREADS') or max(1, (os.cpu_count() or 1) // 2)
+        self._service = self._ctx.Process(target=service_main, args=(self._service_address, threads, self._events),
+                                          daemon=True)
+        self._service.start()
+
+    def _supervise(self):
+        while not self._stop.wait(5):
+            for i, p in enumerate(self._procs):
+                if p.is_alive():
+                    continue
+                log.error("Worker %s exited with code %s, restarting", p.pid, p.exitcode)
+                with self.app.app_context():
+                    recover_jobs(self.app, worker=local_worker_name(p.pid))
+                    db.session.remove()
+                self._procs[i] = self._spawn()
+            if self._service is not None and not self._service.is_alive():
+                log.error("Transcription service exited with code %s, restarting", self._service.exitcode)
+                self._start_transcription_service()
@@ -0,0 +1,69 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+
+_listener = None
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Let at most ``burst`` records per (logger, message template) through
+    every ``interval`` seconds. Dropped records are counted and the count is
+    appended to the next record of that template that gets through, so a
+    chatty loop (progress lines, per-chunk warnings) can't flood the log.
+    Errors are never dropped.
+    """
+
+    def __init__(self, burst=10, interval=60.0):
+        super().__init__()
+        self.burst = burst
+        self.interval = interval
+        self._windows = {}  # key -> [window start, records let through, suppressed]
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.ERROR:
+            return True
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= self.interval:
+                suppressed = window[2] if window else 0
+                self._windows[key] = [now, 1, 0]
+            elif window[1] < self.burst:
+                window[1] += 1
+                suppressed, window[2] = window[2], 0
+            else:
+                window[2] += 1
+                return False
+        if suppressed:
+            record.msg = f"{record.msg} [{suppressed} similar messages suppressed]"
+        return True
+
+
+def configure_logging(app):
+    """
+    Leveled logging for the service. Records go through a queue to a
+    background thread that does the actual writing, so request and worker
+    threads never block on stderr. Safe to call more than once per process.
+    """
+    global _listener
+    root = logging.getLogger()
+    root.setLevel(app.config.get('LOG_LEVEL', 'INFO'))
+    if _listener is not None:
+        return
+
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(processName)s] %(name)s: %(message)s'))
+    records = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(records)
+    queue_handler.addFilter(RateLimitFilter(burst=app.config.get('LOG_RATE_LIMIT_BURST', 10),
+                                            interval=app.config.get('LOG_RATE_LIMIT_INTERVAL', 60.0)))
+    root.addHandler(queue_handler)
+    _listener = logging.handlers.QueueListener(records, handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)  # Flush what's queued on exit
@@ -0,0 +1,138 @@
+import json
+import struct
+import numpy as np
+
+# Layout: header, then starts (float32), ends (float32), token ids (uint32),
+# line offsets (uint32, one per line plus the end), then the token table as
+# NUL-separated UTF-8. All little-endian.
+MAGIC = b'LWT1'
+_HEADER = struct.Struct('<4sIII')  # magic, words, lines, tokens
+
+
+class WordTimeline:
+    """
+    Word-level lyric timings in columnar form: parallel start/end arrays,
+    each word an index into a table of distinct tokens, and the offset of
+    each lyric line's first word. A song's words pack into a few KB instead
+    of a JSON object per word, and ``locate`` is a binary search over
+    ``starts``.
+
+    Lines match the segments of the song's ``lyrics_json`` one to one.
+    """
+
+    def __init__(self, starts, ends, token_ids, tokens, line_offsets):
+        self.starts = np.asarray(starts, dtype='<f4')
+        self.ends = np.asarray(ends, dtype='<f4')
+        self.token_ids = np.asarray(token_ids, dtype='<u4')
+        self.tokens = list(tokens)
+        self.line_offsets = np.asarray(line_offsets, dtype='<u4')
+
+    def __len__(self):
+        return len(self.starts)
+
+    @property
+    def line_count(self):
+        return len(self.line_offsets) - 1
+
+    @classmethod
+    def from_segments(cls, segments):
+        """
+        Build from transcription segments carrying a ``words`` list of
+        {start, end, word}. Segments without words become empty lines.
+        """
+        starts, ends, token_ids, offsets = [], [], [], []
+        vocabulary = {}
+        for segment in segments:
+            offsets.append(len(starts))
+            for word in segment.get('words') or ():
+                token = word['word'].strip()
+                if not token:
+                    continue
+                starts.append(word['start'])
+                ends.append(word['end'])
+                token_ids.append(vocabulary.setdefault(token, len(vocabulary)))
+        offsets.append(len(starts))
+        # Whisper can emit a word a few ms before the previous one ends;
+        # keep starts sorted so they stay binary-searchable
+        starts = np.maximum.accumulate(np.asarray(starts, dtype='<f4')) if starts else starts
+        return cls(starts, ends, token_ids, list(vocabulary), offsets)
+
+    def to_bytes(self):
+        table = '\0'.join(self.tokens).encode('utf-8')
+        return b''.join([
+            _HEADER.pack(MAGIC, len(self.starts), self.line_count, len(self.tokens)),
+            self.starts.tobytes(), self.ends.tobytes(), self.token_ids.tobytes(),
+            self.line_offsets.tobytes(), table,
+        ])
+
+    @classmethod
+    def from_bytes(cls, data):
+        magic, words, lines, token_count = _HEADER.unpack_from(data)
+        if magic != MAGIC:
+            raise ValueError("Not a word timeline")
+        offset = _HEADER.size
+
+        def take(dtype, count):
+            nonlocal offset
+            array = np.frombuffer(data, dtype=dtype, count=count, offset=offset)
+            offset += array.nbytes
+            return array
+
+        starts, ends = take('<f4', words), take('<f4', words)
+        token_ids, line_offsets = take('<u4', words), take('<u4', lines + 1)
+        table = bytes(data[offset:]).decode('utf-8')
+        tokens = table.split('\0') if token_count else []
+        return cls(starts, ends, token_ids, tokens, line_offsets)
+
+    def word(self, i):
+        return {'start': round(float(self.starts[i]), 3), 'end': round(float(self.ends[i]), 3),
+                'word': self.tokens[self.token_ids[i]]}
+
+    def line_words(self, line):
+        return [self.word(i) for i in range(self.line_offsets[line], self.line_offsets[line + 1])]
+
+    def locate(self, t):
+        """
+        (line, word) at time ``t`` in O(log n): the last word that started at
+        or before ``t`` and its line, or (-1, -1) before the first word.
+        """
+        word = int(np.searchsorted(self.starts, t, side='right')) - 1
+        if word < 0:
+            return -1, -1
+        line = int(np.searchsorted(self.line_offsets, word, side='right')) - 1
+        return line, word
+
+    def to_segments(self, lyrics):
+        """
+        Re-attach words to the ``lyrics_json`` segments they belong to.
+        """
+        return [dict(segment, words=self.line_words(i) if i < self.line_count else [])
+                for i, segment in enumerate(lyrics)]
+
+    def to_columns(self):
+        """
+        JSON form for clients, which search ``starts`` themselves.
+        """
+        return {
+            'starts': [round(float(t), 3) for t in self.starts],
+            'ends': [round(float(t), 3) for t in self.ends],
+            'token_ids': self.token_ids.tolist(),
+            'tokens': self.tokens,
+            'line_offsets': self.line_offsets.tolist(),
+        }
+
+
+def split_lyrics(segments):
+    """
+    Split transcription segments into the ``lyrics_json`` string (start,
+    end, text per line, unchanged for existing consumers) and the packed
+    word timeline, or None if there are no word timings.
+    """
+    lyrics_json = json_lines(segments)
+    if not any(segment.get('words') for segment in segments):
+        return lyrics_json, None
+    return lyrics_json, WordTimeline.from_segments(segments).to_bytes()
+
+
+def json_lines(segments):
+    return json.dumps([{'start': s['start'], 'end': s['end'], 'text': s['text']} for s in segments])
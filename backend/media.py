@@ -0,0 +1,56 @@
+import logging
+import threading
+import time
+import metrics
+
+log = logging.getLogger(__name__)
+
+# Per-format streaming counters, e.g. {'aac': {'streams': 3, 'bytes': ..., 'seconds': ...}}
+_stream_stats = {}
+_stats_lock = threading.Lock()
+
+
+class MeteredBody:
+    """
+    Wrap a response body to count the bytes actually sent and how long the
+    transfer took, recorded when the server closes the response.
+    """
+
+    def __init__(self, body, label):
+        self._body = body
+        self._label = label
+        self._bytes = 0
+        self._started = time.monotonic()
+
+    def __iter__(self):
+        for chunk in self._body:
+            self._bytes += len(chunk)
+            yield chunk
+
+    def close(self):
+        if hasattr(self._body, 'close'):
+            self._body.close()
+        elapsed = time.monotonic() - self._started
+        with _stats_lock:
+            stats = _stream_stats.setdefault(self._label, {'streams': 0, 'bytes': 0, 'seconds': 0.0})
+            stats['streams'] += 1
+            stats['bytes'] += self._bytes
+            stats['seconds'] += elapsed
+        metrics.inc('media_streamed_bytes_total', self._bytes, format=self._label)
+        if elapsed > 0:
+            log.debug("Streamed %s bytes of %s in %.2fs (%.0f KiB/s)",
+                      self._bytes, self._label, elapsed, self._bytes / elapsed / 1024)
+
+
+def meter_response(response, label):
+    response.direct_passthrough = False
+    response.response = MeteredBody(response.response, label)
+    return response
+
+
+def stream_stats():
+    with _stats_lock:
+        stats = {label: dict(s) for label, s in _stream_stats.items()}
+    for s in stats.values():
+        s['avg_bytes_per_second'] = s['bytes'] / s['seconds'] if s['seconds'] else None
+    return stats
@@ -0,0 +1,184 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Request latencies vs. pipeline stages that run for minutes
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+STAGE_BUCKETS = (0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+# Channel worker processes forward their metric deltas on (see events.py)
+FORWARD_CHANNEL = '__metrics__'
+
+
+class Registry:
+    """
+    Process-local counters and histograms keyed by (name, labels), plus
+    gauges computed by callbacks at scrape time. Worker processes ``drain``
+    their deltas and the web process ``merge``s them, so /metrics covers
+    the whole pool.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._meta = {}  # name -> (type, help, buckets)
+        self._counters = {}
+        self._histograms = {}  # key -> [bucket counts..., sum, count]
+        self._gauges = {}  # name -> callback returning {labels: value}
+
+    def counter(self, name, help):
+        self._meta[name] = ('counter', help, None)
+
+    def histogram(self, name, help, buckets=STAGE_BUCKETS):
+        self._meta[name] = ('histogram', help, tuple(buckets))
+
+    def gauge(self, name, help, callback):
+        self._meta[name] = ('gauge', help, None)
+        self._gauges[name] = callback
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        buckets = self._meta[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            state = self._histograms.get(key)
+            if state is None:
+                state = self._histograms[key] = [0] * (len(buckets) + 2)
+            index = bisect_left(buckets, value)
+            if index < len(buckets):
+                state[index] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    def drain(self):
+        """
+        Take and reset everything recorded since the last drain.
+        """
+        with self._lock:
+            delta = {'counters': self._counters, 'histograms': self._histograms}
+            self._counters, self._histograms = {}, {}
+        return delta
+
+    def merge(self, delta):
+        with self._lock:
+            for key, value in delta['counters'].items():
+                self._counters[key] = self._counters.get(key, 0) + value
+            for key, values in delta['histograms'].items():
+                state = self._histograms.get(key)
+                if state is None:
+                    self._histograms[key] = list(values)
+                else:
+                    for i, v in enumerate(values):
+                        state[i] += v
+
+    def render(self):
+        """
+        Prometheus text exposition format.
+        """
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {k: list(v) for k, v in self._histograms.items()}
+        lines = []
+        for name, (kind, help, buckets) in sorted(self._meta.items()):
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == 'counter':
+                for (n, labels), value in sorted(counters.items()):
+                    if n == name:
+                        lines.append(f"{name}{_labels(labels)} {value}")
+            elif kind == 'gauge':
+                try:
+                    values = self._gauges[name]()
+                except Exception as e:
+                    lines.append(f"# {name} unavailable: {e}")
+                    continue
+                for labels, value in sorted(values.items()):
+                    lines.append(f"{name}{_labels(labels)} {value}")
+            else:
+                for (n, labels), state in sorted(histograms.items()):
+                    if n != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(buckets, state):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{_labels(labels + (('le', f'{bound:g}'),))} {cumulative}")
+                    lines.append(f"{name}_bucket{_labels(labels + (('le', '+Inf'),))} {state[-1]}")
+                    lines.append(f"{name}_sum{_labels(labels)} {state[-2]}")
+                    lines.append(f"{name}_count{_labels(labels)} {state[-1]}")
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    parts = []
+    for key, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append(f'{key}="{value}"')
+    return '{' + ','.join(parts) + '}'
+
+
+registry = Registry()
+counter = registry.counter
+histogram = registry.histogram
+gauge = registry.gauge
+inc = registry.inc
+observe = registry.observe
+render = registry.render
+
+
+@contextmanager
+def span(name, **labels):
+    """
+    Time the block into histogram ``name`` (seconds), including when it raises.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def start_forwarding(send, interval=5.0):
+    """
+    In a worker process: every ``interval`` seconds hand the metrics recorded
+    since the last call to ``send`` (which forwards them to the web process).
+    """
+    def loop():
+        while True:
+            time.sleep(interval)
+            delta = registry.drain()
+            if delta['counters'] or delta['histograms']:
+                send(delta)
+
+    threading.Thread(target=loop, daemon=True, name='metrics-forward').start()
+
+
+# --- Metric definitions ---
+
+histogram('http_request_duration_seconds', 'Time to build an API response, by endpoint', REQUEST_BUCKETS)
+histogram('pipeline_stage_seconds', 'Wall time of each processing stage')
+histogram('stream_window_seconds', 'Per-window separation/transcription time in streaming mode')
+histogram('model_load_seconds', 'Time to load a model into memory')
+histogram('ffmpeg_seconds', 'Wall time of ffmpeg runs, by operation')
+histogram('db_commit_seconds', 'Time spent committing from the processing pipeline', REQUEST_BUCKETS)
+histogram('job_duration_seconds', 'Wall time of a job, by kind and outcome')
+histogram('transcription_batch_windows', 'Windows per batched Whisper forward pass', (1, 2, 4, 8, 16, 32, 64))
+histogram('transcription_batch_seconds', 'Time to decode one batch of Whisper windows')
+histogram('mix_seconds', 'Time spent mixing recordings, by step (prepare, align, render)')
+histogram('scoring_seconds', 'Time to track and score pitch, by step (reference, take)')
+histogram('mix_batch_takes', 'Recordings rendered per pass over an instrumental', (1, 2, 4, 8, 16, 32))
+counter('jobs_finished_total', 'Jobs finished, by kind and status (done, failed, preempted)')
+counter('uploads_total', 'Uploads, by result (queued, cached, rejected)')
+counter('result_cache_lookups_total', 'Result cache lookups, by result (hit, miss)')
+counter('result_cache_evictions_total', 'Result cache entries evicted')
+counter('media_streamed_bytes_total', 'Bytes of audio sent to players, by format')
+counter('errors_total', 'Errors caught and handled, by where they happened')
+counter('mix_alignments_total', 'Recording offsets, by method (estimated, hint, none)')
+counter('storage_reclaimed_bytes_total', 'Bytes freed on disk, by reason (delete, intermediate, compress, variant)')
+counter('variant_requests_total', 'Shifted instrumental requests, by result (hit, miss, rendering, busy)')
+counter('variant_renders_total', 'Shifted instrumental renders, by trigger (request, prerender) and status')
@@ -0,0 +1,516 @@
+import itertools
+import logging
+import queue
+import subprocess
+import tempfile
+import threading
+import numpy as np
+from audio_io import decode_for_app, iter_pcm_windows, probe_duration
+import metrics
+
+log = logging.getLogger(__name__)
+
+MIX_RATE = 44100
+BLOCK_SECONDS = 5.0
+# Vocal clean-up before mixing (see denoise); loudness is matched afterwards instead of by dynaudnorm
+DENOISE_FRAME = 2048
+HIGHPASS_HZ = 80  # Remove rumble
+NOISE_PERCENTILE = 10  # Of each bin's magnitude over the take: the noise floor
+# Noise-only bins are Rayleigh distributed; their 10th percentile is 0.325 of their RMS
+NOISE_PERCENTILE_TO_RMS = 1 / 0.325
+OVER_SUBTRACTION = 2.0
+NOISE_REDUCTION_DB = 12
+
+# Alignment: onset envelopes at 10 ms resolution over the loudest ALIGN_SECONDS within the
+# first ALIGN_SEARCH_SECONDS of the take, computed at a quarter of the mix rate (onsets don't
+# need the top octaves). The instrumental is buffered up to there, so this bounds memory.
+ALIGN_SECONDS = 20.0
+ALIGN_SEARCH_SECONDS = 60.0
+ALIGN_DECIMATION = 4
+ALIGN_RATE = MIX_RATE // ALIGN_DECIMATION
+HOP_SECONDS = 0.01
+ONSET_FRAME = 256
+# Browsers start recording before playback is audible, so takes run late, never by seconds
+MIN_OFFSET_SECONDS = -0.1
+MAX_OFFSET_SECONDS = 0.8
+ALIGN_MIN_CORRELATION = 0.2
+
+# BS.1770 gating
+SUB_BLOCK_SECONDS = 0.1  # Four make a 400 ms block with 75% overlap
+ABSOLUTE_GATE_LUFS = -70.0
+RELATIVE_GATE_LU = -10.0
+MAX_BOOST_DB = 24.0
+
+
+# --- Loudness ---
+
+def _biquad_power(b, a, freqs, rate):
+    z = np.exp(-2j * np.pi * freqs / rate)  # z^-1 on the unit circle
+    h = (b[0] + b[1] * z + b[2] * z * z) / (a[0] + a[1] * z + a[2] * z * z)
+    return np.abs(h) ** 2
+
+
+def k_weighting(n, rate):
+    """
+    Power response of the BS.1770 K-weighting filter (high shelf + RLB high
+    pass, designed for ``rate``) at the rfft bins of an ``n``-sample block.
+    """
+    freqs = np.fft.rfftfreq(n, 1 / rate)
+
+    gain, q, fc = 4.0, 1 / np.sqrt(2), 1500.0
+    A = 10 ** (gain / 40)
+    w0 = 2 * np.pi * fc / rate
+    alpha = np.sin(w0) / (2 * q)
+    cos, root = np.cos(w0), 2 * np.sqrt(A) * alpha
+    shelf = _biquad_power(
+        [A * ((A + 1) + (A - 1) * cos + root), -2 * A * ((A - 1) + (A + 1) * cos), A * ((A + 1) + (A - 1) * cos - root)],
+        [(A + 1) - (A - 1) * cos + root, 2 * ((A - 1) - (A + 1) * cos), (A + 1) - (A - 1) * cos - root],
+        freqs, rate)
+
+    q, fc = 0.5, 38.0
+    w0 = 2 * np.pi * fc / rate
+    alpha, cos = np.sin(w0) / (2 * q), np.cos(w0)
+    highpass = _biquad_power([(1 + cos) / 2, -(1 + cos), (1 + cos) / 2], [1 + alpha, -2 * cos, 1 - alpha], freqs, rate)
+    return (shelf * highpass).astype(np.float32)
+
+
+class LoudnessMeter:
+    """
+    Integrated loudness in LUFS after ITU-R BS.1770: K-weighted mean square
+    over 400 ms blocks with 75% overlap, gated at -70 LUFS and again 10 LU
+    below the level of what passed. Fed blocks of any size; it keeps one
+    energy per 100 ms, so memory doesn't grow with the input. The filter is
+    applied in the frequency domain per 100 ms sub-block.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.size = int(rate * SUB_BLOCK_SECONDS)
+        # Parseval over rfft bins: everything but DC (and Nyquist) appears twice
+        scale = np.full(self.size // 2 + 1, 2.0, dtype=np.float32)
+        scale[0] = 1.0
+        if self.size % 2 == 0:
+            scale[-1] = 1.0
+        self._weights = k_weighting(self.size, rate) * scale / self.size ** 2
+        self._pending = None
+        self._energies = []
+
+    def add(self, samples):
+        """
+        Feed (channels, n) or mono samples; channel energies add up.
+        """
+        samples = np.atleast_2d(samples)
+        if self._pending is not None:
+            samples = np.concatenate([self._pending, samples], axis=1)
+        full = samples.shape[1] // self.size
+        if full:
+            frames = samples[:, :full * self.size].reshape(samples.shape[0], full, self.size)
+            power = np.abs(np.fft.rfft(frames, axis=-1)) ** 2
+            self._energies.extend((power @ self._weights).sum(axis=0).tolist())
+        self._pending = samples[:, full * self.size:]
+
+    def integrated(self):
+        """
+        Gated loudness in LUFS, or None for silence.
+        """
+        energies = np.asarray(self._energies)
+        if len(energies) < 4:
+            blocks = energies[:1] if len(energies) else energies
+        else:
+            blocks = np.convolve(energies, np.full(4, 0.25), mode='valid')
+        if not len(blocks):
+            return None
+        loudness = -0.691 + 10 * np.log10(blocks + 1e-20)
+        gated = blocks[loudness > ABSOLUTE_GATE_LUFS]
+        if not len(gated):
+            return None
+        threshold = -0.691 + 10 * np.log10(gated.mean()) + RELATIVE_GATE_LU
+        gated = gated[-0.691 + 10 * np.log10(gated) > threshold]
+        return float(-0.691 + 10 * np.log10(gated.mean()))
+
+    def loudest(self, seconds, within=None):
+        """
+        Start time of the ``seconds``-long stretch with the most energy,
+        starting in the first ``within`` seconds if given.
+        """
+        width = max(1, int(seconds / SUB_BLOCK_SECONDS))
+        energies = np.asarray(self._energies)
+        if within is not None:
+            energies = energies[:int(within / SUB_BLOCK_SECONDS) + width]
+        if len(energies) <= width:
+            return 0.0
+        sums = np.convolve(energies, np.ones(width), mode='valid')
+        return float(np.argmax(sums) * SUB_BLOCK_SECONDS)
+
+
+def measure_loudness(path, rate=MIX_RATE):
+    """
+    Integrated loudness of a file in LUFS (None if silent), streamed in blocks.
+    """
+    meter = LoudnessMeter(rate)
+    for _, block, _ in iter_pcm_windows(path, rate, 2, BLOCK_SECONDS, 0):
+        meter.add(block)
+    return meter.integrated()
+
+
+def buffer_loudness(audio):
+    """
+    Integrated loudness of an AudioBuffer already in memory.
+    """
+    meter = LoudnessMeter(audio.samplerate)
+    step = int(BLOCK_SECONDS * audio.samplerate)
+    for start in range(0, audio.samples.shape[1], step):
+        meter.add(audio.samples[:, start:start + step])
+    return meter.integrated()
+
+
+# --- Alignment ---
+
+def onset_envelope(samples, rate):
+    """
+    Spectral flux of log-magnitude spectra, one value per HOP_SECONDS.
+    """
+    hop = round(rate * HOP_SECONDS)
+    if len(samples) < ONSET_FRAME + hop:
+        return np.zeros(0, dtype=np.float32)
+    frames = np.lib.stride_tricks.sliding_window_view(samples, ONSET_FRAME)[::hop]
+    spectra = np.log1p(100 * np.abs(np.fft.rfft(frames * np.hanning(ONSET_FRAME).astype(np.float32), axis=1)))
+    return np.maximum(0, np.diff(spectra, axis=0)).sum(axis=1)
+
+
+def estimate_offset(vocal, instrumental, lead):
+    """
+    How late ``vocal`` runs against ``instrumental`` in seconds, from the
+    FFT cross-correlation of their onset envelopes, and the normalized
+    correlation at that lag. Both are mono at ALIGN_RATE; ``instrumental`` starts ``lead`` seconds before
+    ``vocal`` and is longer by the range of offsets to search. Returns
+    (None, 0.0) if there is nothing to correlate.
+    """
+    ev, ei = onset_envelope(vocal, ALIGN_RATE), onset_envelope(instrumental, ALIGN_RATE)
+    lags = len(ei) - len(ev) + 1
+    ev = ev - ev.mean() if len(ev) else ev
+    norm_v = np.linalg.norm(ev)
+    if lags < 1 or norm_v == 0:
+        return None, 0.0
+    ei = ei - ei.mean()
+
+    size = 1 << int(np.ceil(np.log2(len(ei) + len(ev))))
+    corr = np.fft.irfft(np.fft.rfft(ei, size) * np.conj(np.fft.rfft(ev, size)), size)[:lags]
+    energy = np.concatenate(([0.0], np.cumsum(ei ** 2)))
+    norm_i = np.sqrt(np.maximum(energy[len(ev):len(ev) + lags] - energy[:lags], 0))
+    coeff = corr / (norm_v * norm_i + 1e-12)
+
+    k = int(np.argmax(coeff))
+    shift = 0.0
+    if 0 < k < lags - 1:
+        # Parabolic interpolation between envelope frames
+        y0, y1, y2 = coeff[k - 1], coeff[k], coeff[k + 1]
+        denom = y0 - 2 * y1 + y2
+        shift = 0.5 * (y0 - y2) / denom if denom else 0.0
+    return lead - (k + shift) * round(ALIGN_RATE * HOP_SECONDS) / ALIGN_RATE, float(coeff[k])
+
+
+def _decimate(samples):
+    # Box-filter decimation to ALIGN_RATE is enough for an onset envelope
+    return samples[:len(samples) - len(samples) % ALIGN_DECIMATION].reshape(-1, ALIGN_DECIMATION).mean(axis=1)
+
+
+def align_start(meter):
+    """
+    Where in the take to align from: its loudest stretch, late enough that
+    the instrumental reaches back over every offset searched.
+    """
+    return max(meter.loudest(ALIGN_SECONDS, ALIGN_SEARCH_SECONDS), MAX_OFFSET_SECONDS)
+
+
+def align(take, start, instrumental):
+    """
+    Offset of the take against the instrumental (mono at ALIGN_RATE from its
+    beginning): estimated from ``start`` on, else the browser's latency
+    hint, else 0. Returns (offset, method).
+    """
+    vocal = _decimate(take.vocal[int(start * MIX_RATE):int((start + ALIGN_SECONDS) * MIX_RATE)])
+    lead = MAX_OFFSET_SECONDS
+    # Search only the offset range, however short the take is
+    segment = instrumental[int((start - lead) * ALIGN_RATE):
+                           int((start - MIN_OFFSET_SECONDS) * ALIGN_RATE) + len(vocal)]
+    offset, confidence = estimate_offset(vocal, segment, lead)
+    if offset is not None and confidence >= ALIGN_MIN_CORRELATION:
+        return offset, 'estimated'
+    if take.latency_hint is not None:
+        return take.latency_hint, 'hint'
+    return 0.0, 'none'
+
+
+# --- Mixing ---
+
+def soft_limit(block, threshold=0.89, ceiling=0.99):
+    """
+    Leave samples below ``threshold`` alone and bend the rest smoothly
+    towards ``ceiling``, so loudness gain never clips. In place.
+    """
+    over = np.abs(block) > threshold
+    if over.any():
+        x = block[over]
+        knee = ceiling - threshold
+        block[over] = np.sign(x) * (threshold + knee * np.tanh((np.abs(x) - threshold) / knee))
+    return block
+
+
+def _db_to_gain(db):
+    return float(10 ** (min(db, MAX_BOOST_DB) / 20))
+
+
+def mix_gains(instrumental_lufs, vocal_lufs, target_lufs, vocal_lu):
+    """
+    (instrumental gain, vocal gain): the vocal sits ``vocal_lu`` above the
+    instrumental and the sum lands on ``target_lufs`` (uncorrelated sources
+    add in power). With no instrumental the vocal alone is normalized.
+    """
+    if instrumental_lufs is None:
+        return 1.0, (1.0 if vocal_lufs is None else _db_to_gain(target_lufs - vocal_lufs))
+    if vocal_lufs is None:
+        return _db_to_gain(target_lufs - instrumental_lufs), 1.0
+    vocal_level = instrumental_lufs + vocal_lu
+    combined = 10 * np.log10(10 ** (instrumental_lufs / 10) + 10 ** (vocal_level / 10))
+    master = target_lufs - combined
+    return _db_to_gain(master), _db_to_gain(vocal_level + master - vocal_lufs)
+
+
+class Take:
+    """
+    One vocal take to render: where it is, where the mix goes, and once
+    prepared its denoised samples, loudness, offset and gains.
+    """
+
+    def __init__(self, vocal_path, output_path, latency_hint=None):
+        self.vocal_path = vocal_path
+        self.output_path = output_path
+        self.latency_hint = latency_hint
+        self.vocal = None
+        self.offset = 0.0
+        self.alignment = None
+        self.gains = (1.0, 1.0)
+        self.start = 0  # Sample of the take heard at the instrumental's start
+        self.length = 0  # Output samples
+        self.encoder = None
+        self.error = None
+
+
+def denoise(samples, rate, chunk_frames=256):
+    """
+    Spectral gate in place: STFT with sqrt-Hann windows at 50% overlap,
+    bins under HIGHPASS_HZ removed and the rest attenuated by up to
+    NOISE_REDUCTION_DB where they sit near the take's noise floor, then
+    overlap-added back. Works through the take ``chunk_frames`` at a time
+    and adds no delay.
+    """
+    n, hop = DENOISE_FRAME, DENOISE_FRAME // 2
+    if len(samples) < n:
+        return samples
+    window = np.sqrt(np.hanning(n + 1)[:-1]).astype(np.float32)
+    frames = np.lib.stride_tricks.sliding_window_view(samples, n)[::hop]
+    # Estimated from a spread of frames rather than all of them
+    spread = frames[::max(1, len(frames) // 256)]
+    noise = np.percentile(np.abs(np.fft.rfft(spread * window, axis=1)), NOISE_PERCENTILE, axis=0)
+    noise_power = OVER_SUBTRACTION * (noise * NOISE_PERCENTILE_TO_RMS) ** 2
+    keep = (np.fft.rfftfreq(n, 1 / rate) >= HIGHPASS_HZ).astype(np.float32)
+    floor = 10 ** (-NOISE_REDUCTION_DB / 20)
+
+    carry = np.zeros(hop, dtype=np.float32)
+    for first in range(0, len(frames), chunk_frames):
+        spectra = np.fft.rfft(frames[first:first + chunk_frames] * window, axis=1)
+        power = spectra.real ** 2 + spectra.imag ** 2
+        gain = np.sqrt(np.maximum(1 - noise_power / (power + 1e-18), 0))
+        # Smooth across neighbouring bins against "musical noise"
+        gain[:, 1:-1] = (gain[:, :-2] + gain[:, 1:-1] + gain[:, 2:]) / 3
+        out = np.fft.irfft(spectra * (np.maximum(gain, floor) * keep), n, axis=1).astype(np.float32) * window
+
+        # Overlap-add; frames ahead of this chunk are read before being overwritten
+        count = len(out)
+        added = np.zeros((count + 1) * hop, dtype=np.float32)
+        added[:count * hop].reshape(count, hop)[:] += out[:, :hop]
+        added[hop:].reshape(count, hop)[:] += out[:, hop:]
+        added[:hop] += carry
+        start = first * hop
+        samples[start:start + count * hop] = added[:count * hop]
+        carry = added[count * hop:]
+    end = len(frames) * hop
+    samples[end:end + hop] = carry
+    samples[end + hop:] = 0
+    return samples
+
+
+def _prepare(app, take):
+    """
+    Decode and denoise the take once, measuring its loudness on the way.
+    """
+    duration = probe_duration(take.vocal_path)
+    take.vocal = denoise(decode_for_app(app, take.vocal_path, MIX_RATE, 1, duration).samples[0], MIX_RATE)
+    meter = LoudnessMeter(MIX_RATE)
+    step = int(BLOCK_SECONDS * MIX_RATE)
+    for start in range(0, len(take.vocal), step):
+        meter.add(take.vocal[start:start + step])
+    return meter
+
+
+class _Encoder:
+    """
+    An ffmpeg MP3 encoder fed from its own thread, so encoding overlaps the
+    decoding and mixing of the next block. At most two blocks wait.
+    """
+
+    def __init__(self, path, channels):
+        self._stderr = tempfile.TemporaryFile()
+        cmd = ["ffmpeg", "-v", "error", "-f", "f32le", "-ar", str(MIX_RATE), "-ac", str(channels),
+               "-i", "pipe:0", "-y", path]
+        self.process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=self._stderr)
+        self._blocks = queue.Queue(maxsize=2)
+        self._error = None
+        self._thread = threading.Thread(target=self._pump, daemon=True)
+        self._thread.start()
+
+    def _pump(self):
+        while True:
+            data = self._blocks.get()
+            if data is None:
+                break
+            if self._error is None:
+                try:
+                    self.process.stdin.write(data)
+                except OSError as e:
+                    self._error = e  # Keep draining so write() never blocks
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+
+    def write(self, block):
+        # (n, channels) frames are what f32le expects
+        self._blocks.put(np.ascontiguousarray(block.T, dtype='<f4').tobytes())
+
+    def close(self):
+        self._blocks.put(None)
+        self._thread.join()
+        self.process.wait()
+        with self._stderr:
+            if self.process.returncode != 0 or self._error:
+                self._stderr.seek(0)
+                message = self._stderr.read().decode(errors='replace').strip() or self._error
+                raise RuntimeError(f"ffmpeg failed: {message}")
+
+
+def _drain(held):
+    # Let go of each held block once it has been mixed
+    while held:
+        yield held.pop(0)
+
+
+def render_takes(app, instrumental_path, takes, instrumental_lufs=None, keep_vocals=False):
+    """
+    Mix takes over one instrumental in a single streaming pass: the
+    instrumental is decoded once, block by block, and each block is added
+    to every take's shifted, gain-matched vocal and fed to that take's
+    encoder. Its opening stretch is held back until the takes are aligned
+    against it. Memory is that stretch and one block per take on top of
+    the decoded takes. Takes that fail get ``error`` set; the others still
+    render. With ``keep_vocals`` each take's denoised samples stay on it
+    afterwards (e.g. for scoring) instead of being freed.
+    """
+    target = app.config.get('MIX_TARGET_LUFS', -14.0)
+    vocal_lu = app.config.get('MIX_VOCAL_LU', 1.0)
+    channels = 2 if instrumental_path else 1
+
+    prepared = []
+    for take in takes:
+        try:
+            with metrics.span('mix_seconds', step='prepare'):
+                meter = _prepare(app, take)
+            vocal_lufs = meter.integrated()
+            # The mono take is played on both channels of the mix
+            if vocal_lufs is not None and channels == 2:
+                vocal_lufs += 10 * np.log10(2)
+            take.gains = mix_gains(instrumental_lufs, vocal_lufs, target, vocal_lu)
+            prepared.append((take, meter))
+        except Exception as e:
+            take.error = e
+
+    blocks = iter(())
+    held = []
+    if instrumental_path and prepared:
+        with metrics.span('mix_seconds', step='align'):
+            starts = [align_start(meter) for _, meter in prepared]
+            needed = (max(starts) + ALIGN_SECONDS - MIN_OFFSET_SECONDS) * MIX_RATE
+            blocks = iter_pcm_windows(instrumental_path, MIX_RATE, 2, BLOCK_SECONDS, 0)
+            for _, block, _ in blocks:
+                held.append(block)
+                if sum(b.shape[1] for b in held) >= needed:
+                    break
+            opening = _decimate(np.concatenate([b.mean(axis=0) for b in held])) if held else np.zeros(0)
+            for (take, _), start in zip(prepared, starts):
+                take.offset, take.alignment = align(take, start, opening)
+                metrics.inc('mix_alignments_total', method=take.alignment)
+
+    active = []
+    for take, _ in prepared:
+        try:
+            # Output runs from the take's first in-time sample to its end
+            take.start = int(round(take.offset * MIX_RATE))
+            take.length = max(0, len(take.vocal) - take.start)
+            take.encoder = _Encoder(take.output_path, channels)
+            active.append(take)
+            log.info("Take %s: offset %.0f ms (%s), gains %.1f/%.1f dB", take.vocal_path, 1000 * take.offset,
+                     take.alignment, 20 * np.log10(take.gains[0]), 20 * np.log10(take.gains[1]))
+        except Exception as e:
+            take.error = e
+
+    def vocal_block(take, position, n):
+        # Samples of the take that line up with output[position:position + n]
+        block = np.zeros(n, dtype=np.float32)
+        lo, hi = take.start + position, take.start + position + n
+        src_lo, src_hi = max(lo, 0), min(hi, len(take.vocal))
+        if src_hi > src_lo:
+            block[src_lo - lo:src_hi - lo] = take.vocal[src_lo:src_hi]
+        return block
+
+    def feed(take, position, accompaniment):
+        n = min(accompaniment.shape[1], take.length - position)
+        if n <= 0:
+            return
+        out = accompaniment[:, :n] * take.gains[0] if channels == 2 else np.zeros((1, n), dtype=np.float32)
+        out += vocal_block(take, position, n) * take.gains[1]
+        take.encoder.write(soft_limit(out))
+
+    with metrics.span('mix_seconds', step='render'):
+        position = 0
+        if active:
+            longest = max(take.length for take in active)
+            for block in itertools.chain(_drain(held), (block for _, block, _ in blocks)):
+                for take in active:
+                    if take.error is None:
+                        try:
+                            feed(take, position, block)
+                        except Exception as e:
+                            take.error = e
+                position += block.shape[1]
+                if position >= longest:
+                    break
+        # Takes longer than the instrumental (or with none) continue on silence
+        step = int(BLOCK_SECONDS * MIX_RATE)
+        for take in active:
+            at = position
+            while take.error is None and at < take.length:
+                try:
+                    feed(take, at, np.zeros((2, min(step, take.length - at)), dtype=np.float32))
+                except Exception as e:
+                    take.error = e
+                at += step
+
+        for take in active:
+            try:
+                take.encoder.close()
+            except Exception as e:
+                take.error = take.error or e
+            if not keep_vocals:
+                take.vocal = None
+    return takes
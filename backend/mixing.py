@@ -0,0 +1,214 @@
+import os
+import json
+import logging
+import subprocess
+from audio_io import AudioBuffer
+from models import db, Recording, Song
+import metrics
+import mix_engine
+import scoring
+import storage
+import variants
+
+log = logging.getLogger(__name__)
+
+# highpass=f=80: Remove rumble
+# afftdn=nf=-25: Denoise (noise floor -25dB)
+# dynaudnorm: Normalize volume
+VOCAL_CHAIN = "highpass=f=80,afftdn=nf=-25,dynaudnorm"
+
+
+def mix_command(vocal_path, instrumental_path, output_path, denoise=True):
+    """
+    Build one ffmpeg invocation that cleans up the vocal and mixes it with the
+    instrumental in a single filter graph, so there is one decode of each
+    input, one encode and no intermediate file.
+    """
+    vocal_filter = VOCAL_CHAIN if denoise else "anull"
+    if instrumental_path:
+        graph = f"[0:a]{vocal_filter}[v];[1:a][v]amix=inputs=2:duration=shortest[out]"
+        return ["ffmpeg", "-v", "error", "-i", vocal_path, "-i", instrumental_path,
+                "-filter_complex", graph, "-map", "[out]", "-y", output_path]
+    return ["ffmpeg", "-v", "error", "-i", vocal_path, "-af", vocal_filter, "-y", output_path]
+
+
+def render_recording(vocal_path, instrumental_path, output_path):
+    """
+    Denoise + mix to MP3 with ffmpeg alone (MIX_ENGINE=ffmpeg). If the denoise filters fail (e.g. an ffmpeg build
+    without afftdn), mix the untreated vocal rather than lose the take.
+    """
+    try:
+        cmd = mix_command(vocal_path, instrumental_path, output_path)
+        log.debug("Mixing audio: %s", ' '.join(cmd))
+        with metrics.span('ffmpeg_seconds', op='mix'):
+            subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except subprocess.CalledProcessError as e:
+        log.warning("Error denoising/mixing audio, retrying without denoise: %s",
+                    e.stderr.decode(errors='replace').strip())
+        cmd = mix_command(vocal_path, instrumental_path, output_path, denoise=False)
+        with metrics.span('ffmpeg_seconds', op='mix'):
+            subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    return output_path
+
+
+def _instrumental_lufs(song, instrumental_path):
+    # Measured once per instrumental; a song still streaming in isn't final yet
+    if song.instrumental_lufs is None:
+        lufs = mix_engine.measure_loudness(instrumental_path)
+        if song.status != 'ready':
+            return lufs
+        song.instrumental_lufs = lufs
+        db.session.commit()
+    return song.instrumental_lufs
+
+
+def _instrumental_for(app, song, semitones, tempo):
+    """
+    The instrumental a take was sung over: the song's own, or the shifted
+    variant (rendered now if it isn't cached). None if the song has none.
+    """
+    source = storage.instrumental_source(song.instrumental_path) if song else None
+    if source is None or variants.is_original(semitones, tempo):
+        return source
+    formats = list(variants.FORMATS)
+    preferred = app.config.get('INSTRUMENTAL_DEFAULT_FORMAT')
+    if preferred in formats:
+        formats.remove(preferred)
+        formats.insert(0, preferred)
+    for fmt in formats:
+        path = variants.variant_path(app, song.id, semitones, tempo, fmt)
+        if variants.cached(path):
+            return path
+    path = variants.render(app, source, variants.variant_path(app, song.id, semitones, tempo, formats[0]),
+                           semitones, tempo, formats[0])
+    if path is None:
+        # Mixing over the unshifted track would put the take out of key
+        raise RuntimeError(f"Could not render the {semitones:+d} st / {tempo:.2f}x instrumental")
+    return path
+
+
+def _render_batch(app, song, instrumental_path, recordings, rec_dir, reference=None):
+    """
+    Mix recordings of one song: with the NumPy engine in one pass over the
+    instrumental, or one ffmpeg run each if MIX_ENGINE is 'ffmpeg'. With a
+    ``reference`` melody each take is scored too, from the samples the mixer
+    already decoded. Returns {recording id: output filename or None}.
+    """
+    outputs = {}
+    for recording in recordings:
+        raw_filename = recording.raw_filename or recording.filename
+        prefix = 'mixed' if instrumental_path else 'clean'
+        outputs[recording.id] = (raw_filename, f"{prefix}_{os.path.splitext(raw_filename)[0]}.mp3")
+
+    if app.config.get('MIX_ENGINE') == 'ffmpeg':
+        results = {}
+        for recording in recordings:
+            raw_filename, mixed_filename = outputs[recording.id]
+            try:
+                render_recording(os.path.join(rec_dir, raw_filename), instrumental_path,
+                                 os.path.join(rec_dir, mixed_filename))
+                results[recording.id] = mixed_filename
+            except Exception as e:
+                log.error("Error mixing recording %s: %s", recording.id, e)
+                results[recording.id] = None
+            if reference is not None:
+                _score(app, song, recording, reference, os.path.join(rec_dir, raw_filename))
+        return results
+
+    default_latency = app.config.get('MIX_DEFAULT_LATENCY_MS')
+    takes = []
+    for recording in recordings:
+        raw_filename, mixed_filename = outputs[recording.id]
+        latency = recording.latency_ms if recording.latency_ms is not None else default_latency
+        takes.append(mix_engine.Take(os.path.join(rec_dir, raw_filename), os.path.join(rec_dir, mixed_filename),
+                                     latency_hint=None if latency is None else latency / 1000))
+    # A shift leaves the loudness as it was, so the original's measurement serves variants too
+    lufs = _instrumental_lufs(song, storage.instrumental_source(song.instrumental_path)) \
+        if instrumental_path else None
+    metrics.observe('mix_batch_takes', len(takes))
+    mix_engine.render_takes(app, instrumental_path, takes, instrumental_lufs=lufs,
+                            keep_vocals=reference is not None)
+
+    results = {}
+    for recording, take in zip(recordings, takes):
+        if take.error is not None:
+            log.error("Error mixing recording %s: %s", recording.id, take.error)
+            results[recording.id] = None
+        else:
+            recording.offset_ms = round(1000 * take.offset, 1)
+            results[recording.id] = outputs[recording.id][1]
+        if reference is not None:
+            vocal = take.vocal
+            take.vocal = None
+            _score(app, song, recording, reference, take.vocal_path if vocal is None
+                   else AudioBuffer(vocal[None, :], mix_engine.MIX_RATE))
+    return results
+
+
+def _score(app, song, recording, reference, take):
+    # Optional like the mix itself: a take that can't be scored is still kept
+    if recording.offset_ms is not None:
+        offset_ms = recording.offset_ms
+    else:
+        offset_ms = recording.latency_ms or app.config.get('MIX_DEFAULT_LATENCY_MS') or 0
+    try:
+        result = scoring.score_recording(app, take, reference, json.loads(song.lyrics_json or '[]'),
+                                         recording.semitones or 0, recording.tempo or 1.0, offset_ms / 1000)
+    except Exception as e:
+        log.warning("Error scoring recording %s: %s", recording.id, e)
+        metrics.inc('errors_total', where='scoring')
+        return
+    recording.score = result['score']
+    recording.score_json = json.dumps(result['phrases'])
+
+
+def process_recordings_task(recording_ids, app):
+    """
+    Background task: turn raw browser takes into final mixed recordings.
+    Takes sung over the same instrumental (song and key/tempo shift) are
+    mixed together, reading it once. With SCORING each take is also scored
+    against the song's melody. Returns {recording id: True if the mix was
+    produced}.
+    """
+    with app.app_context():
+        rec_dir = os.path.join(app.config['UPLOAD_FOLDER'], 'recordings')
+        by_track = {}
+        for recording in Recording.query.filter(Recording.id.in_(recording_ids)).all():
+            key = (recording.song_id, recording.semitones or 0, recording.tempo or 1.0)
+            by_track.setdefault(key, []).append(recording)
+
+        mixed = {}
+        for (song_id, semitones, tempo), recordings in by_track.items():
+            song = Song.query.get(song_id)
+            reference = scoring.load_reference(song.instrumental_path) \
+                if song and app.config.get('SCORING', True) else None
+            try:
+                # The WAV, the FLAC it was compressed to once cold, or a shifted variant
+                instrumental_path = _instrumental_for(app, song, semitones, tempo)
+                results = _render_batch(app, song, instrumental_path, recordings, rec_dir, reference)
+            except Exception as e:
+                log.error("Error mixing recordings %s: %s", [r.id for r in recordings], e)
+                results = {}
+
+            for recording in recordings:
+                raw_filename = recording.raw_filename or recording.filename
+                if results.get(recording.id):
+                    recording.filename = results[recording.id]
+                    mixed[recording.id] = True
+                else:
+                    metrics.inc('errors_total', where='mix')
+                    # Fallback to the raw recording if mixing fails
+                    recording.filename = raw_filename
+                    mixed[recording.id] = False
+                recording.status = 'ready'
+                db.session.commit()
+                # The mixed file replaces the raw take on disk
+                storage.finish_recording(app, recording, raw_filename)
+        return mixed
+
+
+def process_recording_task(recording_id, app):
+    """
+    Background task for a single take. Returns True if the mix was produced.
+    """
+    return process_recordings_task([recording_id], app).get(recording_id, False)
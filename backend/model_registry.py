@@ -0,0 +1,210 @@
+import gc
+import os
+import logging
+import threading
+import time
+from contextlib import contextmanager
+import metrics
+
+log = logging.getLogger(__name__)
+
+# Rough resident size of each Whisper checkpoint in MB, used to decide whether
+# there is room to load another copy before we start evicting idle ones.
+WHISPER_MODEL_SIZES_MB = {
+    'tiny': 150,
+    'base': 300,
+    'small': 900,
+    'medium': 2000,
+    'large': 4000,
+}
+
+
+def available_memory_mb():
+    """
+    Return the memory available to new allocations in MB, or None if unknown.
+    """
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) // 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') // (1024 * 1024)
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+class _PooledModel:
+    def __init__(self, size, model):
+        self.size = size
+        self.model = model
+        self.in_use = False
+        self.last_used = time.monotonic()
+
+
+class WhisperModelPool:
+    """
+    Process-wide pool of loaded Whisper models.
+
+    Each copy is handed out to one job at a time (Whisper's decoder installs
+    kv-cache hooks on the model, so a copy must not be shared by two
+    concurrent transcriptions). At most ``max_copies`` models are alive at
+    once; when the cap is reached, or free memory drops below
+    ``min_free_mb``, idle copies are evicted least-recently-used first.
+    """
+
+    def __init__(self, max_copies=1, idle_ttl=900, min_free_mb=512, loader=None):
+        self.max_copies = max(1, int(max_copies))
+        self.idle_ttl = idle_ttl
+        self.min_free_mb = min_free_mb
+        self._loader = loader or self._load_whisper
+        self._copies = []
+        self._loading = 0
+        self._cond = threading.Condition()
+
+    @staticmethod
+    def _load_whisper(size):
+        import whisper
+        return whisper.load_model(size)
+
+    @contextmanager
+    def acquire(self, size):
+        """
+        Borrow a model of the given size for the duration of the ``with`` block.
+        """
+        entry = self._checkout(size)
+        try:
+            yield entry.model
+        finally:
+            self._checkin(entry)
+
+    def _checkout(self, size):
+        with self._cond:
+            while True:
+                self._evict_expired()
+                for entry in self._copies:
+                    if entry.size == size and not entry.in_use:
+                        entry.in_use = True
+                        return entry
+
+                if len(self._copies) + self._loading >= self.max_copies:
+                    # Make room by dropping an idle copy of another size
+                    if not self._evict_lru():
+                        self._cond.wait()
+                        continue
+
+                self._make_room_for(size)
+                self._loading += 1
+                break
+
+        try:
+            log.info("Loading Whisper model '%s'", size)
+            with metrics.span('model_load_seconds', model=f"whisper-{size}"):
+                model = self._loader(size)
+        except Exception:
+            with self._cond:
+                self._loading -= 1
+                self._cond.notify_all()
+            raise
+
+        entry = _PooledModel(size, model)
+        entry.in_use = True
+        with self._cond:
+            self._loading -= 1
+            self._copies.append(entry)
+        return entry
+
+    def _checkin(self, entry):
+        with self._cond:
+            entry.in_use = False
+            entry.last_used = time.monotonic()
+            self._cond.notify_all()
+
+    def _make_room_for(self, size):
+        # Called with the lock held. Evict idle copies while the machine is
+        # short on memory for the model we are about to load.
+        needed = WHISPER_MODEL_SIZES_MB.get(size.split('.')[0], 0) + self.min_free_mb
+        free = available_memory_mb()
+        while free is not None and free < needed:
+            if not self._evict_lru():
+                break
+            free = available_memory_mb()
+
+    def _evict_lru(self):
+        idle = [e for e in self._copies if not e.in_use]
+        if not idle:
+            return False
+        victim = min(idle, key=lambda e: e.last_used)
+        self._drop(victim)
+        return True
+
+    def _evict_expired(self):
+        if not self.idle_ttl:
+            return
+        now = time.monotonic()
+        for entry in list(self._copies):
+            if not entry.in_use and now - entry.last_used > self.idle_ttl:
+                self._drop(entry)
+
+    def _drop(self, entry):
+        log.info("Evicting Whisper model '%s'", entry.size)
+        self._copies.remove(entry)
+        entry.model = None
+        gc.collect()
+
+    def trim(self):
+        """
+        Evict every idle model, e.g. after a batch of jobs or on memory pressure.
+        """
+        with self._cond:
+            for entry in list(self._copies):
+                if not entry.in_use:
+                    self._drop(entry)
+
+    def stats(self):
+        with self._cond:
+            return {
+                'loaded': [e.size for e in self._copies],
+                'in_use': sum(1 for e in self._copies if e.in_use),
+                'max_copies': self.max_copies,
+            }
+
+
+_pools = {}
+_pool_lock = threading.Lock()
+
+
+def _get_pool(app, name, loader=None):
+    with _pool_lock:
+        if name not in _pools:
+            _pools[name] = WhisperModelPool(
+                max_copies=app.config.get('WHISPER_POOL_SIZE', 1),
+                idle_ttl=app.config.get('WHISPER_IDLE_TTL', 900),
+                min_free_mb=app.config.get('WHISPER_MIN_FREE_MB', 512),
+                loader=loader,
+            )
+        return _pools[name]
+
+
+def get_whisper_pool(app):
+    """
+    Return this process's Whisper pool, creating it from the app config on first use.
+    """
+    return _get_pool(app, 'whisper')
+
+
+def get_faster_whisper_pool(app):
+    """
+    Pool of faster-whisper (CTranslate2) models, loaded on WHISPER_DEVICE with
+    WHISPER_COMPUTE_TYPE weights (int8 by default) and WHISPER_CPU_THREADS
+    intra-op threads.
+    """
+    def load(size):
+        from faster_whisper import WhisperModel
+        return WhisperModel(size, device=app.config.get('WHISPER_DEVICE', 'auto'),
+                            compute_type=app.config.get('WHISPER_COMPUTE_TYPE', 'int8'),
+                            cpu_threads=app.config.get('WHISPER_CPU_THREADS', 0))
+
+    return _get_pool(app, 'faster-whisper', loader=load)
@@ -14,23 +14,92 @@ class User(db.Model):
     recordings = db.relationship('Recording', backref='user', lazy=True)
 
 class Song(db.Model):
+    __table_args__ = (
+        # Per-user listing, newest first
+        db.Index('ix_song_user_upload_date', 'user_id', 'upload_date'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(200), nullable=False)
     artist = db.Column(db.String(200), nullable=True)
     filename = db.Column(db.String(200), nullable=False)  # Original file
     instrumental_path = db.Column(db.String(200), nullable=True)
+    instrumental_lufs = db.Column(db.Float, nullable=True)  # Integrated loudness, measured during processing (at first mix for older songs)
     lyrics_json = db.Column(db.Text, nullable=True)  # JSON string of lyrics with timestamps
+    lyrics_words = db.Column(db.LargeBinary, nullable=True)  # Packed word timings (see lyrics_timeline.py)
     duration = db.Column(db.Float, nullable=True)
     upload_date = db.Column(db.DateTime, default=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     status = db.Column(db.String(20), default='processing') # processing, ready, error
     progress = db.Column(db.Integer, default=0)
+    stage_progress = db.Column(db.Text, nullable=True)  # JSON {stage: percentage}
+    cache_key = db.Column(db.String(64), nullable=True, index=True)  # Content hash shared with CachedResult
+    upload_hash = db.Column(db.String(64), nullable=True, index=True)  # sha256 of the uploaded bytes + model versions
 
 class Recording(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(200), default="My Recording")
-    filename = db.Column(db.String(200), nullable=False)
+    filename = db.Column(db.String(200), nullable=False)  # Mixed file once ready, raw take until then
+    raw_filename = db.Column(db.String(200), nullable=True)  # Vocal take as uploaded by the browser
     song_id = db.Column(db.Integer, db.ForeignKey('song.id'), nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     duration = db.Column(db.Float, nullable=True)
+    latency_ms = db.Column(db.Float, nullable=True)  # Output latency the browser reported while recording
+    offset_ms = db.Column(db.Float, nullable=True)  # How late the take ran against the instrumental, as mixed
+    # The key/tempo shift of the instrumental it was sung over (see variants.py)
+    semitones = db.Column(db.Integer, nullable=False, default=0)
+    tempo = db.Column(db.Float, nullable=False, default=1.0)
+    score = db.Column(db.Float, nullable=True)  # 0-100 pitch accuracy against the song's melody
+    score_json = db.Column(db.Text, nullable=True)  # JSON list of per-phrase scores, one per lyrics line
+    status = db.Column(db.String(20), default='ready') # processing, ready, error
+
+class CachedResult(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    key = db.Column(db.String(64), unique=True, nullable=False)  # sha256 of decoded audio + model versions
+    instrumental_path = db.Column(db.String(200), nullable=False)
+    lyrics_json = db.Column(db.Text, nullable=True)
+    lyrics_words = db.Column(db.LargeBinary, nullable=True)
+    size_bytes = db.Column(db.BigInteger, default=0)
+    ref_count = db.Column(db.Integer, default=0)  # Songs currently pointing at these artifacts
+    hits = db.Column(db.Integer, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    last_used_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+class Job(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(20), default='song') # song (separate + lyrics), mix (recording)
+    song_id = db.Column(db.Integer, db.ForeignKey('song.id'), nullable=False)
+    recording_id = db.Column(db.Integer, db.ForeignKey('recording.id'), nullable=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    status = db.Column(db.String(20), default='queued', index=True) # queued, running, done, failed
+    priority = db.Column(db.String(20), default='upload') # interactive, upload, rerun (see scheduling.py)
+    est_seconds = db.Column(db.Float, nullable=True)  # Estimated processing time, for shortest-job-first
+    checkpoint = db.Column(db.Text, nullable=True)  # JSON resume state of a preempted streaming job
+    preemptions = db.Column(db.Integer, default=0)
+    attempts = db.Column(db.Integer, default=0)
+    worker = db.Column(db.String(100), nullable=True)  # host:pid of the worker that claimed it
+    lease_expires_at = db.Column(db.DateTime, nullable=True, index=True)  # Running job is re-queued after this
+    heartbeat_at = db.Column(db.DateTime, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+class Artifact(db.Model):
+    """
+    A file in the media folder, tracked so it can be deleted with its owner,
+    tiered and counted against its user's quota (see storage.py). Owner ids
+    are plain columns so a row can outlive its song as a deletion tombstone.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    path = db.Column(db.String(500), unique=True, nullable=False)  # Relative to UPLOAD_FOLDER
+    kind = db.Column(db.String(20), nullable=False)  # upload, instrumental, encoding, peaks, vocals, checkpoint, take, mix
+    user_id = db.Column(db.Integer, nullable=True, index=True)  # Whose quota it counts against
+    song_id = db.Column(db.Integer, nullable=True, index=True)
+    recording_id = db.Column(db.Integer, nullable=True, index=True)
+    cache_key = db.Column(db.String(64), nullable=True, index=True)  # Shared via the result cache, which owns it
+    size_bytes = db.Column(db.BigInteger, default=0)
+    tier = db.Column(db.String(20), default='hot')  # hot, compressing, cold (FLAC)
+    state = db.Column(db.String(20), default='live', index=True)  # live, deleted (file removal pending)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    last_access_at = db.Column(db.DateTime, default=datetime.utcnow)
@@ -0,0 +1,128 @@
+import os
+import struct
+import subprocess
+import numpy as np
+
+# Peaks are stored in the audiowaveform .dat (version 1) format: a 20-byte
+# little-endian header followed by interleaved int16 min/max pairs, one file
+# per resolution next to the instrumental.
+DAT_HEADER = struct.Struct('<iIiiI')  # version, flags, sample_rate, samples_per_pixel, length
+PEAKS_SAMPLE_RATE = 22050
+
+
+def peaks_path(wav_path, samples_per_pixel):
+    return f"{os.path.splitext(wav_path)[0]}.peaks-{samples_per_pixel}.dat"
+
+
+def configured_resolutions(app):
+    resolutions = sorted({int(r) for r in app.config.get('PEAKS_RESOLUTIONS', '256,1024,4096').split(',')})
+    # Coarser levels are folded from the finest one, so they must be multiples of it
+    finest = resolutions[0]
+    return sorted({max(finest, round(r / finest) * finest) for r in resolutions})
+
+
+def _block_min_max(samples, samples_per_pixel):
+    """
+    Min/max of every ``samples_per_pixel`` block; the last block may be short.
+    """
+    pad = -len(samples) % samples_per_pixel
+    if pad:
+        # Repeat the last sample so padding never creates a fake peak
+        samples = np.concatenate([samples, np.full(pad, samples[-1], dtype=samples.dtype)])
+    blocks = samples.reshape(-1, samples_per_pixel)
+    return blocks.min(axis=1), blocks.max(axis=1)
+
+
+def _ffmpeg_blocks(wav_path, sample_rate, block_samples):
+    """
+    Decode mono int16 through an ffmpeg pipe, ``block_samples`` at a time.
+    """
+    cmd = ["ffmpeg", "-v", "error", "-i", wav_path, "-ac", "1", "-ar", str(sample_rate), "-f", "s16le", "-"]
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    while True:
+        data = process.stdout.read(block_samples * 2)
+        if not data:
+            break
+        yield np.frombuffer(data[:len(data) - len(data) % 2], dtype='<i2')
+    stderr = process.stderr.read().decode(errors='replace')
+    process.wait()
+    if process.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed to decode {wav_path}: {stderr.strip()}")
+
+
+def _buffer_blocks(audio, sample_rate, block_samples):
+    """
+    The same int16 blocks taken from an AudioBuffer already in memory.
+    """
+    mono = audio.mono(sample_rate)
+    for start in range(0, len(mono), block_samples):
+        yield (np.clip(mono[start:start + block_samples], -1.0, 1.0) * 32767).astype('<i2')
+
+
+def compute_peaks(wav_path, resolutions, sample_rate=PEAKS_SAMPLE_RATE, block_pixels=4096, audio=None):
+    """
+    Return {samples_per_pixel: (mins, maxs)} for every resolution, from one
+    pass over the audio: ``audio`` (an AudioBuffer) if given, otherwise the
+    file decoded once (mono, int16, through an ffmpeg pipe).
+    """
+    finest = resolutions[0]
+    # Work in whole pixels' worth of samples at a time so memory stays bounded
+    block_samples = finest * block_pixels
+    if audio is not None:
+        blocks = _buffer_blocks(audio, sample_rate, block_samples)
+    else:
+        blocks = _ffmpeg_blocks(wav_path, sample_rate, block_samples)
+
+    mins, maxs = [], []
+    for samples in blocks:
+        if len(samples):
+            block_min, block_max = _block_min_max(samples, finest)
+            mins.append(block_min)
+            maxs.append(block_max)
+
+    base_min = np.concatenate(mins) if mins else np.zeros(0, dtype='<i2')
+    base_max = np.concatenate(maxs) if maxs else np.zeros(0, dtype='<i2')
+    levels = {finest: (base_min, base_max)}
+    for spp in resolutions[1:]:
+        factor = spp // finest
+        if len(base_min) == 0:
+            levels[spp] = (base_min, base_max)
+            continue
+        level_min, _ = _block_min_max(base_min, factor)
+        _, level_max = _block_min_max(base_max, factor)
+        levels[spp] = (level_min, level_max)
+    return levels
+
+
+def write_dat(path, mins, maxs, sample_rate, samples_per_pixel):
+    data = np.empty(len(mins) * 2, dtype='<i2')
+    data[0::2] = mins
+    data[1::2] = maxs
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(DAT_HEADER.pack(1, 0, sample_rate, samples_per_pixel, len(mins)))
+        f.write(data.tobytes())
+    os.replace(tmp_path, path)
+
+
+def generate_peaks(app, wav_path, audio=None):
+    """
+    Compute and store every configured resolution. Returns {spp: path}.
+    """
+    resolutions = configured_resolutions(app)
+    levels = compute_peaks(wav_path, resolutions, audio=audio)
+    paths = {}
+    for spp, (mins, maxs) in levels.items():
+        paths[spp] = peaks_path(wav_path, spp)
+        write_dat(paths[spp], mins, maxs, PEAKS_SAMPLE_RATE, spp)
+    return paths
+
+
+def closest_resolution(wav_path, app, requested):
+    """
+    The stored resolution nearest to ``requested`` samples per pixel, or None.
+    """
+    stored = [spp for spp in configured_resolutions(app) if os.path.exists(peaks_path(wav_path, spp))]
+    if not stored:
+        return None
+    return min(stored, key=lambda spp: abs(spp - requested)) if requested else stored[len(stored) // 2]
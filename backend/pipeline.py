@@ -0,0 +1,118 @@
+import os
+import threading
+import metrics
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+class Stage:
+    """
+    One step of a processing job. ``fn`` receives a dict with the results of
+    the stages listed in ``deps`` and returns this stage's result.
+    """
+
+    def __init__(self, name, fn, deps=()):
+        self.name = name
+        self.fn = fn
+        self.deps = tuple(deps)
+
+
+class StageProgress:
+    """
+    Thread-safe per-stage progress (0-100) with an overall percentage weighted
+    by each stage's rough share of the job's wall time.
+    Stage threads call ``update``; the coordinating thread reads ``snapshot``.
+    """
+
+    def __init__(self, weights):
+        self._weights = dict(weights)
+        self._progress = {name: 0 for name in weights}
+        self._lock = threading.Lock()
+
+    def update(self, stage, percentage):
+        percentage = max(0, min(100, int(percentage)))
+        with self._lock:
+            # Never move backwards, progress bars should only grow
+            if percentage > self._progress[stage]:
+                self._progress[stage] = percentage
+
+    def callback(self, stage):
+        return lambda percentage: self.update(stage, percentage)
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._progress)
+
+    def overall(self):
+        with self._lock:
+            total = sum(self._weights.values()) or 1
+            return int(sum(self._progress[n] * w for n, w in self._weights.items()) / total)
+
+
+def job_thread_budget():
+    """
+    CPU threads this job may use. Workers set OMP_NUM_THREADS to their share
+    of the machine; fall back to every core when running standalone.
+    """
+    try:
+        return max(1, int(os.environ['OMP_NUM_THREADS']))
+    except (KeyError, ValueError):
+        return os.cpu_count() or 1
+
+
+def set_process_threads(threads):
+    """
+    Size this process's torch/OpenMP pool; call before torch is imported.
+    The pool is shared by every thread in the process, so concurrent stages
+    can't each have their own share of it: it is set once per process.
+    """
+    os.environ.setdefault('OMP_NUM_THREADS', str(threads))
+    os.environ.setdefault('MKL_NUM_THREADS', os.environ['OMP_NUM_THREADS'])
+
+
+def _timed(stage, inputs):
+    with metrics.span('pipeline_stage_seconds', stage=stage.name):
+        return stage.fn(inputs)
+
+
+def run_stages(stages, on_tick=None, tick_interval=0.5):
+    """
+    Run a DAG of stages, starting each one as soon as its dependencies have
+    finished, so independent stages overlap. ``on_tick`` is called from the
+    calling thread every ``tick_interval`` seconds (e.g. to persist progress).
+    Returns {stage name: result}; the first stage error is re-raised.
+    """
+    pending = {s.name: s for s in stages}
+    for stage in stages:
+        missing = [d for d in stage.deps if d not in pending]
+        if missing:
+            raise ValueError(f"Stage {stage.name} depends on unknown stages {missing}")
+
+    results = {}
+    running = {}
+    with ThreadPoolExecutor(max_workers=len(stages), thread_name_prefix='stage') as pool:
+        while pending or running:
+            for name, stage in list(pending.items()):
+                if all(d in results for d in stage.deps):
+                    inputs = {d: results[d] for d in stage.deps}
+                    running[pool.submit(_timed, stage, inputs)] = name
+                    del pending[name]
+
+            if not running:
+                raise ValueError(f"Stages {sorted(pending)} can never run (dependency cycle)")
+
+            done, _ = wait(running, timeout=tick_interval, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                error = future.exception()
+                if error is not None:
+                    # Let already-running stages finish (threads can't be
+                    # killed) but don't start any new ones.
+                    for f in running:
+                        f.cancel()
+                    raise error
+                results[name] = future.result()
+
+            if on_tick:
+                on_tick()
+
+    return results
@@ -0,0 +1,190 @@
+import os
+import shutil
+import hashlib
+import threading
+from datetime import datetime
+from importlib import metadata
+import numpy as np
+from sqlalchemy import func
+from models import db, CachedResult, Artifact
+import metrics
+
+# Process-local lookup counters; hits per entry are also kept in the DB
+_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+_stats_lock = threading.Lock()
+
+
+def _count(name):
+    with _stats_lock:
+        _stats[name] += 1
+    if name == 'evictions':
+        metrics.inc('result_cache_evictions_total')
+    else:
+        metrics.inc('result_cache_lookups_total', result='hit' if name == 'hits' else 'miss')
+
+
+def _package_version(name):
+    try:
+        return metadata.version(name)
+    except metadata.PackageNotFoundError:
+        return 'unknown'
+
+
+def model_fingerprint(app):
+    """
+    Identify the models that produced a result, so upgrading either one
+    naturally invalidates old cache entries.
+    """
+    return '|'.join([
+        f"demucs:{app.config.get('DEMUCS_MODEL', 'htdemucs')}:{_package_version('demucs')}",
+        f"whisper:{app.config['WHISPER_MODEL']}:{transcription_fingerprint(app)}",
+        f"lyrics:{app.config.get('TRANSCRIBE_SOURCE', 'vocals')}:{int(bool(app.config.get('WORD_TIMESTAMPS', True)))}"
+        f":{int(bool(app.config.get('TRANSCRIPTION_VAD', True)))}",
+    ])
+
+
+def transcription_fingerprint(app):
+    # Deferred so the web process doesn't load the transcription engine to hash an upload
+    from transcription import backend_name, FasterWhisperBackend, BatchedWhisperBackend
+
+    name = backend_name(app)
+    if name == FasterWhisperBackend.name:
+        return f"faster-whisper:{_package_version('faster-whisper')}:{app.config.get('WHISPER_COMPUTE_TYPE', 'int8')}"
+    if name == BatchedWhisperBackend.name:
+        # Independent windows transcribe slightly differently from sequential decoding
+        return f"whisper-batched:{_package_version('openai-whisper')}"
+    return _package_version('openai-whisper')
+
+
+def audio_cache_key(app, audio, block_seconds=10):
+    """
+    Hash decoded audio (not the file bytes), so the same track re-uploaded
+    with different tags or a different container still matches. ``audio``
+    is the AudioBuffer the job decodes anyway; its rate and layout are part
+    of the key, so buffers decoded for another engine never match.
+    """
+    digest = hashlib.sha256(model_fingerprint(app).encode())
+    digest.update(f"|{audio.samplerate}x{audio.channels}|".encode())
+    # 16-bit, as ffmpeg would have decoded it, so float rounding noise can't split keys
+    block = max(1, int(block_seconds * audio.samplerate))
+    for start in range(0, audio.samples.shape[1], block):
+        pcm = np.clip(audio.samples[:, start:start + block], -1.0, 1.0) * 32767
+        digest.update(np.ascontiguousarray(pcm.T).astype('<i2').tobytes())
+    return digest.hexdigest()
+
+
+def upload_hash(app, file_sha256):
+    """
+    Key for the exact uploaded bytes under the current models. A byte-identical
+    re-upload can reuse the earlier song's cache_key without decoding again.
+    """
+    return hashlib.sha256(f"{model_fingerprint(app)}|{file_sha256}".encode()).hexdigest()
+
+
+def lookup(key):
+    """
+    Return the cached result for ``key`` and take a reference on it, or None.
+    The caller commits.
+    """
+    entry = CachedResult.query.filter_by(key=key).first() if key else None
+    if entry is None:
+        _count('misses')
+        return None
+    _count('hits')
+    entry.hits = (entry.hits or 0) + 1
+    entry.ref_count = (entry.ref_count or 0) + 1
+    entry.last_used_at = datetime.utcnow()
+    return entry
+
+
+def _artifact_dir(entry):
+    return os.path.dirname(entry.instrumental_path)
+
+
+def _dir_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def store(song):
+    """
+    Record a finished song's artifacts under its cache key. The song holds the
+    first reference. The caller commits.
+    """
+    if not song.cache_key or not song.instrumental_path:
+        return None
+    if CachedResult.query.filter_by(key=song.cache_key).first():
+        # An identical upload finished first; keep ours private
+        song.cache_key = None
+        return None
+    entry = CachedResult(
+        key=song.cache_key,
+        instrumental_path=song.instrumental_path,
+        lyrics_json=song.lyrics_json,
+        lyrics_words=song.lyrics_words,
+        size_bytes=_dir_size(os.path.dirname(song.instrumental_path)),
+        ref_count=1,
+    )
+    db.session.add(entry)
+    return entry
+
+
+def release(song):
+    """
+    Drop the song's reference to shared artifacts. Returns True if the song's
+    files are owned by the cache and must not be deleted with it. Unreferenced
+    entries stay cached until evicted. The caller commits.
+    """
+    if not song.cache_key:
+        return False
+    entry = CachedResult.query.filter_by(key=song.cache_key).first()
+    if entry is None:
+        return False
+    entry.ref_count = max(0, (entry.ref_count or 0) - 1)
+    return True
+
+
+def evict(app):
+    """
+    Delete least-recently-used unreferenced entries until the cache fits in
+    RESULT_CACHE_MAX_BYTES. Commits.
+    """
+    max_bytes = app.config.get('RESULT_CACHE_MAX_BYTES')
+    if not max_bytes:
+        return 0
+    total = db.session.query(func.coalesce(func.sum(CachedResult.size_bytes), 0)).scalar()
+    instrumentals = os.path.realpath(os.path.join(app.config['UPLOAD_FOLDER'], 'instrumentals'))
+    evicted = 0
+    while total > max_bytes:
+        entry = CachedResult.query.filter(CachedResult.ref_count <= 0) \
+            .order_by(CachedResult.last_used_at).first()
+        if entry is None:
+            break  # Everything left is in use
+        folder = os.path.realpath(_artifact_dir(entry))
+        if folder.startswith(instrumentals + os.sep):
+            shutil.rmtree(folder, ignore_errors=True)
+        total -= entry.size_bytes or 0
+        Artifact.query.filter_by(cache_key=entry.key).delete()
+        db.session.delete(entry)
+        db.session.commit()
+        evicted += 1
+        _count('evictions')
+    return evicted
+
+
+def cache_stats():
+    with _stats_lock:
+        stats = dict(_stats)
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_rate'] = stats['hits'] / lookups if lookups else None
+    row = db.session.query(func.count(CachedResult.id),
+                           func.coalesce(func.sum(CachedResult.size_bytes), 0),
+                           func.coalesce(func.sum(CachedResult.hits), 0)).one()
+    stats['entries'], stats['size_bytes'], stats['total_hits'] = int(row[0]), int(row[1]), int(row[2])
+    return stats
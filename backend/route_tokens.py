@@ -0,0 +1,29 @@
+from itsdangerous import URLSafeTimedSerializer, BadSignature
+
+# Browsers can't send headers from EventSource or <audio>, so those GETs
+# take a short-lived token in the URL instead of the session JWT. Each is
+# signed for one user, one route and one song, and isn't a JWT, so it can't
+# stand in for the session anywhere else.
+ROUTES = ('events', 'accompaniment')
+
+
+def _serializer(app):
+    return URLSafeTimedSerializer(app.config['JWT_SECRET_KEY'], salt='route-token')
+
+
+def issue(app, user_id, route, song_id):
+    return _serializer(app).dumps({'user': str(user_id), 'route': route, 'song': song_id})
+
+
+def verify(app, token, route, song_id):
+    """
+    The user id a token was issued to, or None if it is forged, older than
+    ROUTE_TOKEN_SECONDS or for another route or song.
+    """
+    try:
+        claims = _serializer(app).loads(token, max_age=app.config.get('ROUTE_TOKEN_SECONDS', 3600))
+    except BadSignature:  # Also raised when expired
+        return None
+    if claims.get('route') != route or claims.get('song') != song_id:
+        return None
+    return claims.get('user')
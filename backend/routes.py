@@ -1,12 +1,32 @@
-from flask import Blueprint, request, jsonify, current_app, send_from_directory
+from flask import Blueprint, request, jsonify, current_app, send_from_directory, send_file, Response, stream_with_context
 from models import db, User, Song, Recording
 from werkzeug.security import generate_password_hash, check_password_hash
-from flask_jwt_extended import create_access_token, jwt_required, get_jwt_identity
+from flask_jwt_extended import create_access_token, jwt_required, get_jwt_identity, verify_jwt_in_request
 import os
-import threading
-from audio_processor import process_song_task
+import json
+import logging
+import base64
+import hashlib
+from urllib.parse import urlencode
+from sqlalchemy import or_, and_
+from sqlalchemy.orm import defer
+from jobs import enqueue_song, enqueue_recording, queue_positions, estimate_completions
+import result_cache
+import route_tokens
+import storage
+import variants
+from ingest import claim_upload
+from audio_io import probe_audio
+from encoding import ENCODINGS, encoded_path, available_formats
+from media import meter_response, stream_stats
+from peaks import closest_resolution, peaks_path
+from lyrics_timeline import WordTimeline
+import events
+import metrics
+import queue
 from datetime import datetime
-import subprocess
+
+log = logging.getLogger(__name__)
 
 api_bp = Blueprint('api', __name__)
 
@@ -57,20 +77,25 @@ def get_me():
 @api_bp.route('/upload', methods=['POST'])
 @jwt_required()
 def upload_song():
-    print("Upload request received")
-    print(f"Headers: {request.headers}")
-    print(f"Files: {request.files}")
-    
+    """
+    The file part is streamed to disk and hashed while the body arrives (see
+    ingest.py); it is then validated with ffprobe so bad files are rejected
+    before anything is queued.
+    """
     if 'file' not in request.files:
-        print("Error: No file part")
+        log.info("Upload without a file part")
         return jsonify({'error': 'No file part'}), 400
     file = request.files['file']
     current_user_id = get_jwt_identity()
-    print(f"User ID: {current_user_id}")
+    log.info("Upload from user %s (%s bytes)", current_user_id, request.content_length)
     
     if file.filename == '':
-        print("Error: No selected file")
+        log.info("Upload from user %s without a file name", current_user_id)
         return jsonify({'error': 'No selected file'}), 400
+    if storage.over_quota(current_app, current_user_id):
+        log.info("Upload from user %s rejected: over storage quota", current_user_id)
+        metrics.inc('uploads_total', result='rejected')
+        return jsonify({'error': 'Storage quota exceeded'}), 413
         
     if file:
         # Create user specific folder
@@ -80,64 +105,356 @@ def upload_song():
         filename = f"{datetime.now().timestamp()}_{file.filename}"
         filepath = os.path.join(user_upload_dir, filename)
         try:
-            file.save(filepath)
+            file_sha256 = claim_upload(file, filepath)
         except Exception as e:
-            print(f"Error saving file: {e}")
+            log.error("Error saving upload: %s", e)
+            metrics.inc('errors_total', where='upload_save')
             return jsonify({'error': 'Failed to save file'}), 500
+
+        try:
+            info = probe_audio(filepath)
+        except FileNotFoundError:
+            log.warning("ffprobe not found, accepting upload without validation")
+            info = {}
+        if info is None:
+            os.remove(filepath)
+            metrics.inc('uploads_total', result='rejected')
+            log.info("Rejected upload %s: not audio", file.filename)
+            return jsonify({'error': 'Not a supported audio file'}), 400
+        
+        # The same bytes processed before? Reuse its instrumental and lyrics. Matching by
+        # audio content needs a full decode, so the worker does that before separating.
+        upload_hash = result_cache.upload_hash(current_app, file_sha256)
+        previous = Song.query.filter(Song.upload_hash == upload_hash, Song.cache_key.isnot(None)).first()
+        cache_key = previous.cache_key if previous else None
+        cached = result_cache.lookup(cache_key) if cache_key else None
         
         new_song = Song(
             title=file.filename, 
             filename=filename, 
             user_id=current_user_id,
-            status='processing'
+            status='processing',
+            duration=info.get('duration'),
+            cache_key=cache_key,
+            upload_hash=upload_hash
         )
+        if cached:
+            new_song.instrumental_path = cached.instrumental_path
+            new_song.lyrics_json = cached.lyrics_json
+            new_song.lyrics_words = cached.lyrics_words
+            new_song.status = 'ready'
+            new_song.progress = 100
         db.session.add(new_song)
+        db.session.flush()
+        storage.track(current_app, filepath, 'upload', user_id=new_song.user_id, song_id=new_song.id)
         db.session.commit()
         
-        # Start background processing
-        thread = threading.Thread(target=process_song_task, args=(new_song.id, filepath, current_app._get_current_object()))
-        thread.start()
+        if cached:
+            metrics.inc('uploads_total', result='cached')
+            return jsonify({'message': 'Upload successful, already processed', 'song_id': new_song.id,
+                            'queue_position': None})
         
-        return jsonify({'message': 'Upload successful, processing started', 'song_id': new_song.id})
+        # Hand off to the worker pool
+        enqueue_song(new_song)
+        metrics.inc('uploads_total', result='queued')
+        positions = queue_positions([new_song.id])
+        
+        return jsonify({'message': 'Upload successful, processing queued', 'song_id': new_song.id,
+                        'queue_position': positions.get(new_song.id),
+                        'eta_seconds': estimate_completions(current_app, [new_song.id]).get(new_song.id)})
+
+# Fields /api/songs can return; 'lyrics' is opt-in since it is the bulk of the payload
+SONG_FIELDS = {
+    'id': lambda s, ctx: s.id,
+    'title': lambda s, ctx: s.title,
+    'status': lambda s, ctx: s.status,
+    'instrumental_url': lambda s, ctx: media_url(storage.instrumental_source(s.instrumental_path) or s.instrumental_path),
+    # Compressed, range-servable version for playback; instrumental_url stays the lossless download
+    'stream_url': lambda s, ctx: f"/api/stream/{s.id}/accompaniment" if s.instrumental_path else None,
+    'lyrics': lambda s, ctx: s.lyrics_json,
+    'upload_date': lambda s, ctx: s.upload_date.isoformat(),
+    'duration': lambda s, ctx: s.duration,
+    'progress': lambda s, ctx: s.progress,
+    'stages': lambda s, ctx: json.loads(s.stage_progress) if s.stage_progress else None,
+    'queue_position': lambda s, ctx: ctx['positions'].get(s.id),
+    # Estimated seconds until processing finishes (queued or running songs)
+    'eta_seconds': lambda s, ctx: ctx['etas'].get(s.id),
+    # Streaming jobs expose the instrumental and lyrics while still processing
+    'partial': lambda s, ctx: s.status == 'processing' and s.instrumental_path is not None,
+}
+DEFAULT_SONG_FIELDS = [f for f in SONG_FIELDS if f != 'lyrics']
+
+def media_url(path):
+    if not path:
+        return None
+    root = current_app.config['UPLOAD_FOLDER'] + os.sep
+    rel = path[len(root):] if path.startswith(root) else os.path.relpath(path, current_app.config['UPLOAD_FOLDER'])
+    return f"/api/media/{rel}"
+
+def encode_cursor(song):
+    raw = f"{song.upload_date.isoformat()}|{song.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def decode_cursor(cursor):
+    upload_date, song_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+    return datetime.fromisoformat(upload_date), int(song_id)
 
 @api_bp.route('/songs', methods=['GET'])
 @jwt_required()
 def get_songs():
+    """
+    List the user's songs, newest first.
+
+    Query params: limit (default 50, max 200), cursor (from the X-Next-Cursor
+    header of the previous page), fields (comma-separated, see SONG_FIELDS),
+    status (e.g. ready). The body stays a plain list; the next page cursor is
+    sent in X-Next-Cursor and a Link header.
+    """
     current_user_id = get_jwt_identity()
-    songs = Song.query.filter_by(user_id=current_user_id).order_by(Song.upload_date.desc()).all()
-    return jsonify([{
-        'id': s.id,
-        'title': s.title,
-        'status': s.status,
-        'instrumental_url': f"/api/media/{os.path.relpath(s.instrumental_path, current_app.config['UPLOAD_FOLDER'])}" if s.instrumental_path else None,
-        'lyrics': s.lyrics_json,
-        'upload_date': s.upload_date.isoformat(),
-        'progress': s.progress
-    } for s in songs])
+    limit = max(1, min(request.args.get('limit', 50, type=int), 200))
+    fields = request.args.get('fields')
+    fields = [f for f in fields.split(',') if f in SONG_FIELDS] if fields else DEFAULT_SONG_FIELDS
+
+    # (user_id, upload_date) index keeps this an index range scan
+    query = Song.query.filter_by(user_id=current_user_id).options(defer(Song.lyrics_words))
+    if request.args.get('status'):
+        query = query.filter(Song.status == request.args['status'])
+    if 'lyrics' not in fields:
+        query = query.options(defer(Song.lyrics_json))
+    cursor = request.args.get('cursor')
+    if cursor:
+        try:
+            upload_date, song_id = decode_cursor(cursor)
+        except (ValueError, UnicodeDecodeError):
+            return jsonify({'error': 'Invalid cursor'}), 400
+        query = query.filter(or_(Song.upload_date < upload_date,
+                                 and_(Song.upload_date == upload_date, Song.id < song_id)))
+    songs = query.order_by(Song.upload_date.desc(), Song.id.desc()).limit(limit + 1).all()
+    has_more = len(songs) > limit
+    songs = songs[:limit]
+
+    processing = [s.id for s in songs if s.status == 'processing']
+    ctx = {'positions': queue_positions(processing) if 'queue_position' in fields else {},
+           'etas': estimate_completions(current_app, processing) if 'eta_seconds' in fields else {}}
+    response = jsonify([{f: SONG_FIELDS[f](s, ctx) for f in fields} for s in songs])
+    if has_more:
+        next_cursor = encode_cursor(songs[-1])
+        response.headers['X-Next-Cursor'] = next_cursor
+        args = request.args.to_dict()
+        args['cursor'] = next_cursor
+        response.headers['Link'] = f'<{request.base_url}?{urlencode(args)}>; rel="next"'
+    return response
+
+@api_bp.route('/songs/<int:song_id>/lyrics', methods=['GET'])
+@jwt_required()
+def get_song_lyrics(song_id):
+    """
+    Lyrics JSON for one song. Supports If-None-Match, so clients can
+    revalidate (e.g. while a streaming job is still adding lines) for free.
+    """
+    current_user_id = get_jwt_identity()
+    song = Song.query.filter_by(id=song_id, user_id=current_user_id).first()
+    if not song:
+        return jsonify({'error': 'Song not found'}), 404
+
+    body = song.lyrics_json or '[]'
+    response = current_app.response_class(body, mimetype='application/json')
+    response.set_etag(hashlib.sha1(body.encode()).hexdigest())
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response.make_conditional(request)
+
+@api_bp.route('/songs/<int:song_id>/lyrics/words', methods=['GET'])
+@jwt_required()
+def get_song_words(song_id):
+    """
+    Word timings for one song as parallel columns (starts, ends, token_ids
+    into tokens, and line_offsets: the first word of each lyrics line).
+    With ?t=<seconds>, instead the line and word playing at that time
+    (a binary search) and that line's words. 404 if the song has no word
+    timings.
+    """
+    current_user_id = get_jwt_identity()
+    song = Song.query.filter_by(id=song_id, user_id=current_user_id).first()
+    if not song:
+        return jsonify({'error': 'Song not found'}), 404
+    if not song.lyrics_words:
+        return jsonify({'error': 'No word timings for this song'}), 404
+
+    timeline = WordTimeline.from_bytes(song.lyrics_words)
+    t = request.args.get('t', type=float)
+    if t is not None:
+        line, word = timeline.locate(t)
+        return jsonify({'t': t, 'line': line, 'word': word,
+                        'words': timeline.line_words(line) if line >= 0 else []})
+
+    response = jsonify(timeline.to_columns())
+    response.set_etag(hashlib.sha1(song.lyrics_words).hexdigest())
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response.make_conditional(request)
+
+def request_user(route, song_id):
+    """
+    The caller's user id, from a route token (?token=) for this route and
+    song or else the Authorization header. None if neither is valid.
+    """
+    token = request.args.get('token')
+    if token:
+        return route_tokens.verify(current_app, token, route, song_id)
+    verify_jwt_in_request(optional=True)
+    return get_jwt_identity()
+
+@api_bp.route('/songs/<int:song_id>/route-token', methods=['POST'])
+@jwt_required()
+def issue_route_token(song_id):
+    """
+    A short-lived token for one header-less GET on the caller's song:
+    {'route': 'events'} for the progress stream, 'accompaniment' for a
+    key/tempo-shifted instrumental. Passed back as ?token=.
+    """
+    current_user_id = get_jwt_identity()
+    song = Song.query.filter_by(id=song_id, user_id=current_user_id).first()
+    if not song:
+        return jsonify({'error': 'Song not found'}), 404
+    route = (request.get_json(silent=True) or {}).get('route')
+    if route not in route_tokens.ROUTES:
+        return jsonify({'error': f"route must be one of {', '.join(route_tokens.ROUTES)}"}), 400
+    return jsonify({'token': route_tokens.issue(current_app, current_user_id, route, song_id),
+                    'expires_in': current_app.config['ROUTE_TOKEN_SECONDS']})
+
+@api_bp.route('/songs/<int:song_id>/events', methods=['GET'])
+def song_events(song_id):
+    """
+    Server-Sent Events stream of a song's progress, ending once it is ready
+    or failed. Takes an 'events' route token, since EventSource can't send headers.
+    """
+    current_user_id = request_user('events', song_id)
+    if current_user_id is None:
+        return jsonify({'error': 'Missing or invalid token'}), 401
+    song = Song.query.filter_by(id=song_id, user_id=current_user_id).first()
+    if not song:
+        return jsonify({'error': 'Song not found'}), 404
+
+    channel = events.song_channel(song_id)
+    subscription = events.broker.subscribe(channel)
+    positions = queue_positions([song_id])
+    initial = {
+        'id': song.id,
+        'status': song.status,
+        'progress': song.progress,
+        'stages': json.loads(song.stage_progress) if song.stage_progress else None,
+        'queue_position': positions.get(song_id),
+        'eta_seconds': estimate_completions(current_app, [song_id]).get(song_id),
+    }
+    # Don't hold a pooled connection for the lifetime of the stream
+    db.session.close()
+
+    def generate():
+        try:
+            yield events.sse_format(initial)
+            last = initial
+            while last['status'] == 'processing':
+                try:
+                    last = subscription.get(timeout=15)
+                except queue.Empty:
+                    # No push (e.g. worker on another node): fall back to the DB
+                    current = Song.query.get(song_id)
+                    if current is None:
+                        return
+                    last = {'id': current.id, 'status': current.status, 'progress': current.progress,
+                            'stages': json.loads(current.stage_progress) if current.stage_progress else None,
+                            'queue_position': queue_positions([song_id]).get(song_id),
+                            'eta_seconds': estimate_completions(current_app, [song_id]).get(song_id)}
+                    db.session.close()
+                yield events.sse_format(last)
+        finally:
+            events.broker.unsubscribe(channel, subscription)
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@api_bp.route('/songs/<int:song_id>/reprocess', methods=['POST'])
+@jwt_required()
+def reprocess_song(song_id):
+    """
+    Queue a failed song again. Re-runs are scheduled behind fresh uploads.
+    """
+    current_user_id = get_jwt_identity()
+    song = Song.query.filter_by(id=song_id, user_id=current_user_id).first()
+    if not song:
+        return jsonify({'error': 'Song not found'}), 404
+    if song.status != 'error':
+        return jsonify({'error': 'Only failed songs can be reprocessed'}), 409
+
+    song.status = 'processing'
+    song.progress = 0
+    song.stage_progress = None
+    enqueue_song(song, priority='rerun')
+    return jsonify({'message': 'Reprocessing queued', 'song_id': song.id,
+                    'queue_position': queue_positions([song.id]).get(song.id),
+                    'eta_seconds': estimate_completions(current_app, [song.id]).get(song.id)})
 
 @api_bp.route('/songs/<int:song_id>', methods=['DELETE'])
 @jwt_required()
 def delete_song(song_id):
     current_user_id = get_jwt_identity()
     song = Song.query.filter_by(id=song_id, user_id=current_user_id).first()
-    db.session.delete(song)
-    db.session.commit()
-    # TODO: Delete actual files to save space
+    if not song:
+        return jsonify({'error': 'Song not found'}), 404
+    # Shared artifacts stay with the result cache until evicted
+    freed = storage.delete_song(current_app, song)
+    log.info("Deleted song %s, %s bytes freed", song_id, freed)
     return jsonify({'message': 'Song deleted'})
 
-@api_bp.route('/recordings', methods=['GET'])
+@api_bp.route('/cache/stats', methods=['GET'])
 @jwt_required()
-def get_recordings():
-    current_user_id = get_jwt_identity()
-    recordings = Recording.query.filter_by(user_id=current_user_id).order_by(Recording.created_at.desc()).all()
-    return jsonify([{
+def get_cache_stats():
+    return jsonify(result_cache.cache_stats())
+
+def serialize_recording(r):
+    return {
         'id': r.id,
         'title': r.title,
         'filename': r.filename,
         'url': f"/api/media/recordings/{r.filename}",
         'created_at': r.created_at.isoformat(),
-        'duration': r.duration
-    } for r in recordings])
+        'duration': r.duration,
+        'offset_ms': r.offset_ms,
+        'semitones': r.semitones,
+        'tempo': r.tempo,
+        'score': r.score,
+        'status': r.status
+    }
+
+@api_bp.route('/recordings', methods=['GET'])
+@jwt_required()
+def get_recordings():
+    current_user_id = get_jwt_identity()
+    recordings = Recording.query.filter_by(user_id=current_user_id).order_by(Recording.created_at.desc()).all()
+    return jsonify([serialize_recording(r) for r in recordings])
+
+@api_bp.route('/recordings/<int:rec_id>', methods=['GET'])
+@jwt_required()
+def get_recording(rec_id):
+    current_user_id = get_jwt_identity()
+    recording = Recording.query.filter_by(id=rec_id, user_id=current_user_id).first()
+    if not recording:
+        return jsonify({'error': 'Recording not found'}), 404
+    return jsonify(serialize_recording(recording))
+
+@api_bp.route('/recordings/<int:rec_id>/score', methods=['GET'])
+@jwt_required()
+def get_recording_score(rec_id):
+    """
+    Pitch score of a take: overall and per lyrics line (start, end, text,
+    score; score is null for lines with nothing to sing or not reached).
+    """
+    current_user_id = get_jwt_identity()
+    recording = Recording.query.filter_by(id=rec_id, user_id=current_user_id).first()
+    if not recording:
+        return jsonify({'error': 'Recording not found'}), 404
+    if recording.score_json is None:
+        return jsonify({'error': 'Recording has no score'}), 404
+    return jsonify({'score': recording.score, 'phrases': json.loads(recording.score_json)})
 
 @api_bp.route('/recordings/<int:rec_id>', methods=['DELETE'])
 @jwt_required()
@@ -147,27 +464,29 @@ def delete_recording(rec_id):
     if not recording:
         return jsonify({'error': 'Recording not found'}), 404
         
-    db.session.delete(recording)
-    db.session.commit()
-    
-    # Try to delete the file
-    try:
-        file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], 'recordings', recording.filename)
-        if os.path.exists(file_path):
-            os.remove(file_path)
-    except Exception as e:
-        print(f"Error deleting file: {e}")
-        
+    # Removes the mix and the raw take once the rows are gone
+    storage.delete_recording(current_app, recording)
     return jsonify({'message': 'Recording deleted'})
 
 @api_bp.route('/recordings', methods=['POST'])
 @jwt_required()
 def save_recording():
+    """
+    Store the raw take and queue denoising + mixing on the worker pool. Returns
+    right away; poll GET /api/recordings/<id> until status is 'ready'.
+    """
     if 'file' not in request.files:
         return jsonify({'error': 'No file part'}), 400
     file = request.files['file']
     song_id = request.form.get('song_id')
     current_user_id = get_jwt_identity()
+    if storage.over_quota(current_app, current_user_id):
+        return jsonify({'error': 'Storage quota exceeded'}), 413
+    # The variant the take was sung over; scoring and mixing both depend on it
+    try:
+        semitones, tempo = variants.parse_shift(current_app, request.form)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     
     if file:
         user_rec_dir = os.path.join(current_app.config['UPLOAD_FOLDER'], 'recordings')
@@ -176,89 +495,140 @@ def save_recording():
         filename = f"rec_{current_user_id}_{datetime.now().timestamp()}.webm"
         filepath = os.path.join(user_rec_dir, filename)
         file.save(filepath)
-        
-        # Mix with instrumental if song_id is provided
-        final_filename = filename
-        
-        # 1. Denoise the vocal recording first
-        try:
-            denoised_filename = f"denoised_{filename}"
-            denoised_filepath = os.path.join(user_rec_dir, denoised_filename)
-            
-            # FFmpeg command for noise removal and enhancement
-            # highpass=f=80: Remove rumble
-            # afftdn=nf=-25: Denoise (noise floor -25dB)
-            # dynaudnorm: Normalize volume
-            denoise_cmd = [
-                "ffmpeg",
-                "-i", filepath,
-                "-af", "highpass=f=80,afftdn=nf=-25,dynaudnorm",
-                "-y",
-                denoised_filepath
-            ]
-            print(f"Denoising audio: {' '.join(denoise_cmd)}")
-            subprocess.run(denoise_cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            
-            if os.path.exists(denoised_filepath):
-                # Use the denoised file for mixing
-                filepath = denoised_filepath 
-                # We keep the original filename variable for DB, but point filepath to the clean version
-        except Exception as e:
-            print(f"Error denoising audio: {e}")
-            # Continue with original file if denoising fails
-
-        if song_id:
-            song = Song.query.get(song_id)
-            if song and song.instrumental_path and os.path.exists(song.instrumental_path):
-                try:
-                    mixed_filename = f"mixed_{filename.replace('.webm', '.mp3')}"
-                    mixed_filepath = os.path.join(user_rec_dir, mixed_filename)
-                    
-                    # FFmpeg command to mix audio
-                    # -i instrumental -i vocal (now denoised)
-                    cmd = [
-                        "ffmpeg",
-                        "-i", song.instrumental_path,
-                        "-i", filepath,
-                        "-filter_complex", "amix=inputs=2:duration=shortest",
-                        "-y",
-                        mixed_filepath
-                    ]
-                    print(f"Mixing audio: {' '.join(cmd)}")
-                    subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                    
-                    # If successful, use the mixed file
-                    if os.path.exists(mixed_filepath):
-                        final_filename = mixed_filename
-                except Exception as e:
-                    print(f"Error mixing audio: {e}")
-                    # Fallback to original (or denoised) recording if mixing fails
+        # The browser's output latency, a hint for aligning the take if estimation fails
+        latency_ms = request.form.get('latency_ms', type=float)
+        if latency_ms is not None:
+            latency_ms = min(max(latency_ms, 0.0), 1000.0)
         
         new_rec = Recording(
             title=f"Recording {datetime.now().strftime('%Y-%m-%d %H:%M')}",
-            filename=final_filename,
+            filename=filename,
+            raw_filename=filename,
             song_id=song_id,
-            user_id=current_user_id
+            user_id=current_user_id,
+            latency_ms=latency_ms,
+            semitones=semitones,
+            tempo=tempo,
+            status='processing'
         )
         db.session.add(new_rec)
+        db.session.flush()
+        storage.track(current_app, filepath, 'take', user_id=new_rec.user_id, recording_id=new_rec.id)
         db.session.commit()
-        return jsonify({'message': 'Recording saved'})
+        enqueue_recording(new_rec)
+        return jsonify({'message': 'Recording saved, mixing queued', 'recording_id': new_rec.id,
+                        'status': new_rec.status})
     return jsonify({'error': 'Save failed'}), 500
 
 # --- Media Serving ---
 @api_bp.route('/media/<path:filename>')
 def serve_media(filename):
     # Security check: ensure we don't traverse up
-    return send_from_directory(current_app.config['UPLOAD_FOLDER'], filename)
+    # Finished files (final mixes, stems of ready songs) never change, so let browsers keep them;
+    # anything else may still be growing (a streaming song's WAV) and must be revalidated
+    folder = current_app.config['UPLOAD_FOLDER']
+    final = storage.finished(current_app, os.path.join(folder, filename))
+    response = send_from_directory(folder, filename,
+                                   max_age=current_app.config['MEDIA_CACHE_MAX_AGE'] if final else None)
+    if not final:
+        response.cache_control.no_cache = True
+    return meter_response(response, 'media')
 
 @api_bp.route('/stream/<int:song_id>/accompaniment')
 def stream_accompaniment(song_id):
+    """
+    Stream the instrumental with Range support. ?format=opus|aac|wav picks an
+    encoding; by default the configured streaming format is used when it exists.
+    ?semitones=&tempo= ask for a key/tempo-shifted variant (see variants.py);
+    those start renders, so only the song's owner may ask (with an
+    'accompaniment' route token, since <audio> can't send headers).
+    """
     song = Song.query.get_or_404(song_id)
-    if not song.instrumental_path or not os.path.exists(song.instrumental_path):
+    available = available_formats(song.instrumental_path)
+    if not available:
         return jsonify({'error': 'Instrumental not found'}), 404
+    try:
+        semitones, tempo = variants.parse_shift(current_app, request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     
-    # Determine directory and filename
-    directory = os.path.dirname(song.instrumental_path)
-    filename = os.path.basename(song.instrumental_path)
+    fmt = request.args.get('format') or current_app.config['INSTRUMENTAL_DEFAULT_FORMAT']
+    if not variants.is_original(semitones, tempo):
+        user_id = request_user('accompaniment', song.id)
+        if user_id is None:
+            return jsonify({'error': 'Missing or invalid token'}), 401
+        if str(song.user_id) != str(user_id):
+            return jsonify({'error': 'Song not found'}), 404
+        if song.status != 'ready':
+            return jsonify({'error': 'Song is still processing'}), 409
+        return stream_variant(song, semitones, tempo, fmt if fmt in variants.FORMATS else 'aac')
+
+    if fmt not in available:
+        # The WAV is gone once the instrumental has been compressed cold
+        fmt = 'wav' if 'wav' in available else available[0]
     
-    return send_from_directory(directory, filename)
+    # send_file handles Range / If-Range / Content-Length and 206 responses.
+    # A file that is still growing (streaming job) must not be cached.
+    ready = song.status == 'ready'
+    if ready:
+        storage.touch(current_app, song.instrumental_path)
+    response = send_file(encoded_path(song.instrumental_path, fmt), mimetype=ENCODINGS[fmt]['mimetype'],
+                         conditional=True, max_age=current_app.config['MEDIA_CACHE_MAX_AGE'] if ready else None)
+    if ready:
+        response.cache_control.immutable = True
+    response.headers['Accept-Ranges'] = 'bytes'
+    return meter_response(response, fmt)
+
+def stream_variant(song, semitones, tempo, fmt):
+    """
+    A shifted instrumental: from the variant cache with Range support, or,
+    while it is rendering, streamed as the renderer writes it.
+    """
+    path = variants.variant_path(current_app, song.id, semitones, tempo, fmt)
+    mimetype = variants.FORMATS[fmt]['mimetype']
+    if variants.cached(path):
+        metrics.inc('variant_requests_total', result='hit')
+        response = send_file(path, mimetype=mimetype, conditional=True,
+                             max_age=current_app.config['MEDIA_CACHE_MAX_AGE'])
+        response.cache_control.immutable = True
+        response.headers['Accept-Ranges'] = 'bytes'
+        return meter_response(response, fmt)
+
+    source = storage.instrumental_source(song.instrumental_path)
+    if source is None:
+        return jsonify({'error': 'Instrumental not found'}), 404
+    try:
+        started = variants.start_render(current_app._get_current_object(), source, path, semitones, tempo, fmt)
+    except variants.RenderLimit:
+        metrics.inc('variant_requests_total', result='busy')
+        response = jsonify({'error': 'Too many key/tempo changes rendering, try again shortly'})
+        response.headers['Retry-After'] = '5'
+        return response, 503
+    metrics.inc('variant_requests_total', result='miss' if started else 'rendering')
+    # Length unknown and still growing: no ranges, and nothing may cache it
+    response = Response(variants.follow(path), mimetype=mimetype)
+    response.headers['Cache-Control'] = 'no-store'
+    response.headers['Accept-Ranges'] = 'none'
+    return meter_response(response, fmt)
+
+@api_bp.route('/songs/<int:song_id>/peaks')
+def get_song_peaks(song_id):
+    """
+    Precomputed min/max waveform peaks in audiowaveform .dat format.
+    ?resolution=<samples per pixel> picks the closest stored level.
+    """
+    song = Song.query.get_or_404(song_id)
+    if song.status != 'ready' or not song.instrumental_path:
+        return jsonify({'error': 'Peaks not available'}), 404
+    spp = closest_resolution(song.instrumental_path, current_app, request.args.get('resolution', type=int))
+    if spp is None:
+        return jsonify({'error': 'Peaks not available'}), 404
+    response = send_file(peaks_path(song.instrumental_path, spp), mimetype='application/octet-stream',
+                         conditional=True, max_age=current_app.config['MEDIA_CACHE_MAX_AGE'])
+    response.headers['X-Samples-Per-Pixel'] = str(spp)
+    return response
+
+@api_bp.route('/stream/stats')
+@jwt_required()
+def get_stream_stats():
+    return jsonify(stream_stats())
@@ -0,0 +1,110 @@
+import threading
+import time
+from datetime import datetime
+from models import db, Song, Job
+
+# Priority classes scale a job's estimated cost when ordering the queue:
+# a recording mix someone is waiting on beats a fresh upload, and re-runs
+# (recovered or orphaned work) yield to both.
+PRIORITY_WEIGHTS = {'interactive': 0.25, 'upload': 1.0, 'rerun': 2.0}
+DEFAULT_PRIORITY = 'upload'
+
+# Assumed length when an upload couldn't be probed
+DEFAULT_DURATION = 240.0
+
+_factor = {'value': None, 'at': 0.0}
+_factor_lock = threading.Lock()
+
+
+class Preempted(Exception):
+    """
+    Raised by a job that stopped at a chunk boundary so shorter work can run.
+    ``checkpoint`` is what it needs to resume.
+    """
+
+    def __init__(self, checkpoint):
+        super().__init__('preempted')
+        self.checkpoint = checkpoint
+
+
+def cost_factor(app, sample=20, ttl=60):
+    """
+    Processing seconds per second of audio, from the median of recently
+    finished song jobs (JOB_COST_FACTOR until there is history).
+    Cached per process for ``ttl`` seconds.
+    """
+    with _factor_lock:
+        if _factor['value'] is not None and time.monotonic() - _factor['at'] < ttl:
+            return _factor['value']
+
+    rows = db.session.query(Job.started_at, Job.finished_at, Song.duration) \
+        .join(Song, Song.id == Job.song_id) \
+        .filter(Job.kind == 'song', Job.status == 'done', Job.preemptions == 0, Song.duration > 0) \
+        .order_by(Job.finished_at.desc()).limit(sample).all()
+    ratios = sorted((finished - started).total_seconds() / duration
+                    for started, finished, duration in rows if started and finished)
+    value = ratios[len(ratios) // 2] if ratios else app.config.get('JOB_COST_FACTOR', 1.0)
+
+    with _factor_lock:
+        _factor['value'], _factor['at'] = value, time.monotonic()
+    return value
+
+
+def estimate_seconds(app, kind, duration):
+    """
+    Expected processing time of a job for ``duration`` seconds of audio.
+    """
+    duration = duration or DEFAULT_DURATION
+    if kind == 'mix':
+        # One ffmpeg pass, much faster than real time
+        return 2.0 + 0.05 * duration
+    return app.config.get('JOB_COST_OVERHEAD', 20.0) + cost_factor(app) * duration
+
+
+def remaining_seconds(job, progress):
+    return (job.est_seconds or 0) * (1 - (progress or 0) / 100)
+
+
+def job_score(app, job, now, est_seconds=None):
+    """
+    Lower runs first: weighted shortest-job-first, with every second spent
+    waiting taking JOB_AGING_RATE seconds off, so long jobs can't starve.
+    """
+    weight = PRIORITY_WEIGHTS.get(job.priority, 1.0)
+    waited = (now - job.created_at).total_seconds() if job.created_at else 0
+    est = job.est_seconds if est_seconds is None else est_seconds
+    return weight * (est or 0) - app.config.get('JOB_AGING_RATE', 1.0) * waited
+
+
+def schedule_order(app, jobs, running_by_user=None):
+    """
+    Queued jobs in the order workers will claim them: users with fewer
+    running jobs first (so one user's batch can't starve others), then by score.
+    """
+    now = datetime.utcnow()
+    running_by_user = running_by_user or {}
+    return sorted(jobs, key=lambda j: (running_by_user.get(j.user_id, 0), job_score(app, j, now), j.id))
+
+
+def should_yield(app, job, progress):
+    """
+    Whether a running job should checkpoint and go back to the queue: a
+    much shorter job has been waiting for JOB_PREEMPT_AFTER seconds (so no
+    worker is free for it) and would be scheduled ahead of what is left of
+    this one.
+    """
+    max_preemptions = app.config.get('JOB_MAX_PREEMPTIONS', 3)
+    if not max_preemptions or (job.preemptions or 0) >= max_preemptions:
+        return False
+    now = datetime.utcnow()
+    if job.started_at and (now - job.started_at).total_seconds() < app.config.get('JOB_PREEMPT_MIN_RUN', 60):
+        return False
+
+    remaining = remaining_seconds(job, progress)
+    cutoff = remaining / app.config.get('JOB_PREEMPT_RATIO', 4.0)
+    waiting_since = datetime.utcfromtimestamp(time.time() - app.config.get('JOB_PREEMPT_AFTER', 30))
+    shorter = Job.query.filter(Job.status == 'queued', Job.est_seconds < cutoff,
+                               Job.created_at <= waiting_since).all()
+    # Requeued, this job would keep its age; don't yield to work it would beat
+    own_score = job_score(app, job, now, est_seconds=remaining)
+    return any(job_score(app, other, now) < own_score for other in shorter)
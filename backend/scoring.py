@@ -0,0 +1,249 @@
+import os
+import logging
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from audio_io import decode_for_app
+import metrics
+
+log = logging.getLogger(__name__)
+
+# Pitch tracking (YIN) on mono at a fifth of 44.1 kHz, so the mixer's
+# decoded take is decimated rather than resampled; plenty for a sung
+# fundamental
+PITCH_RATE = 8820
+HOP_SECONDS = 0.02
+YIN_WINDOW = 256  # Integration window, 29 ms
+MIN_HZ, MAX_HZ = 65.0, 1000.0
+YIN_THRESHOLD = 0.2
+# Frames this far below the take's loud frames are silence, whatever YIN says
+SILENCE_DB = 40
+FRAME_BLOCK = 4096  # Frames per FFT batch, bounds memory on long takes
+
+# Alignment of the take's contour to the reference's (DTW)
+DTW_HOP_SECONDS = 0.04
+DTW_BAND_SECONDS = 1.0  # How far the singer may rush or drag
+VOICING_MISMATCH_COST = 0.5
+WARP_COST = 1.0  # Per frame at the edge of the band, as much as a wrong note
+
+# Per-frame marks: full within IN_TUNE_SEMITONES, none from OFF_KEY_SEMITONES
+IN_TUNE_SEMITONES = 0.5
+OFF_KEY_SEMITONES = 2.0
+
+
+def pitch_path(instrumental_path):
+    # Reference melody, stored next to the stems: MIDI note per HOP_SECONDS frame, NaN where unvoiced
+    return os.path.splitext(instrumental_path)[0] + '.pitch.npy'
+
+
+def pitch_contour(samples, rate=PITCH_RATE):
+    """
+    Fundamental frequency of mono ``samples`` as fractional MIDI notes, one
+    per HOP_SECONDS frame, NaN where unvoiced. YIN, computed for blocks of
+    frames at once with FFTs.
+    """
+    min_lag, max_lag = int(rate / MAX_HZ), int(np.ceil(rate / MIN_HZ))
+    span = YIN_WINDOW + max_lag
+    n_frames = int(len(samples) / rate / HOP_SECONDS)
+    if n_frames == 0:
+        return np.zeros(0, dtype=np.float32)
+    # Frame k looks at samples from k * HOP_SECONDS on (rounded, the hop needn't be whole samples)
+    starts = np.rint(np.arange(n_frames) * rate * HOP_SECONDS).astype(np.int64)
+    padded = np.zeros(starts[-1] + span, dtype=np.float32)
+    padded[:len(samples)] = samples[:len(padded)]
+    windows = sliding_window_view(padded, span)
+
+    energy = np.concatenate(([0.0], np.cumsum(padded.astype(np.float64) ** 2)))
+    power = (energy[starts + YIN_WINDOW] - energy[starts]) / YIN_WINDOW
+    floor = np.percentile(power, 95) * 10 ** (-SILENCE_DB / 10) if power.any() else np.inf
+
+    size = 1 << int(np.ceil(np.log2(span)))
+    lags = np.arange(1, max_lag + 1)
+    midi = np.full(n_frames, np.nan, dtype=np.float32)
+    for lo in range(0, n_frames, FRAME_BLOCK):
+        block = windows[starts[lo:lo + FRAME_BLOCK]]
+        # Difference function d(tau) = E(0) + E(tau) - 2 r(tau), r from one FFT per frame
+        spectrum = np.fft.rfft(block, size)
+        head = np.fft.rfft(block[:, :YIN_WINDOW], size)
+        r = np.fft.irfft(spectrum * np.conj(head), size)[:, 1:max_lag + 1]
+        offsets = starts[lo:lo + len(block), None] + lags
+        d = (power[lo:lo + len(block), None] * YIN_WINDOW + energy[offsets + YIN_WINDOW] - energy[offsets]
+             - 2 * r)
+        # Cumulative mean normalized difference, lags 1..max_lag
+        cmnd = d * lags / np.maximum(np.cumsum(d, axis=1), 1e-12)
+        cmnd[:, :min_lag - 1] = np.inf
+
+        # First dip under the threshold, followed down to its minimum
+        dip = (cmnd[:, :-1] < YIN_THRESHOLD) & (cmnd[:, :-1] <= cmnd[:, 1:])
+        voiced = dip.any(axis=1) & (power[lo:lo + len(block)] > floor)
+        k = np.argmax(dip, axis=1)
+        k = np.clip(k, 1, max_lag - 2)
+        rows = np.arange(len(block))
+        y0, y1, y2 = cmnd[rows, k - 1], cmnd[rows, k], cmnd[rows, k + 1]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            denom = y0 - 2 * y1 + y2
+            shift = np.where(np.abs(denom) > 1e-12, 0.5 * (y0 - y2) / denom, 0.0)
+        lag = k + 1 + np.clip(np.nan_to_num(shift), -1, 1)
+        notes = 69 + 12 * np.log2(rate / lag / 440.0)
+        midi[lo:lo + len(block)] = np.where(voiced, notes, np.nan)
+    return midi
+
+
+def extract_reference(app, vocals, instrumental_path):
+    """
+    Track the melody of a song's vocals stem (an AudioBuffer, or the path
+    of the stem) and store it as float16 next to the instrumental. Returns
+    the path.
+    """
+    if isinstance(vocals, str):
+        vocals = decode_for_app(app, vocals, PITCH_RATE, 1)
+    with metrics.span('scoring_seconds', step='reference'):
+        contour = pitch_contour(_pitch_samples(vocals))
+    path = pitch_path(instrumental_path)
+    np.save(path, contour.astype(np.float16))
+    return path
+
+
+def _pitch_samples(audio):
+    # Mono at PITCH_RATE; a box filter is anti-aliasing enough to track pitch from
+    if audio.samplerate % PITCH_RATE:
+        return audio.mono(PITCH_RATE)
+    factor = audio.samplerate // PITCH_RATE
+    mono = audio.samples.mean(axis=0) if audio.channels > 1 else audio.samples[0]
+    return mono[:len(mono) - len(mono) % factor].reshape(-1, factor).mean(axis=1)
+
+
+def score_recording(app, take, reference, phrases, semitones=0, tempo=1.0, offset=0.0):
+    """
+    Score a take with ``score_take``. ``take`` is the take's file or its
+    samples as an AudioBuffer (the mixer's decoded copy, saving a decode).
+    """
+    if isinstance(take, str):
+        take = decode_for_app(app, take, PITCH_RATE, 1)
+    with metrics.span('scoring_seconds', step='take'):
+        return score_take(pitch_contour(_pitch_samples(take)), reference, phrases, semitones, tempo, offset)
+
+
+def load_reference(instrumental_path):
+    """
+    A song's stored melody as float32, or None if it has none.
+    """
+    path = pitch_path(instrumental_path) if instrumental_path else None
+    if path is None or not os.path.exists(path):
+        return None
+    try:
+        return np.load(path).astype(np.float32)
+    except (OSError, ValueError) as e:
+        log.warning("Unreadable melody %s: %s", path, e)
+        return None
+
+
+def _pool(contour, factor):
+    # Median of the voiced frames in each group, NaN where most are unvoiced
+    n = len(contour) // factor
+    groups = np.sort(contour[:n * factor].reshape(n, factor), axis=1)  # NaNs sort last
+    count = np.sum(~np.isnan(groups), axis=1)
+    median = groups[np.arange(n), np.maximum(count - 1, 0) // 2]
+    return np.where(count * 2 >= factor, median, np.nan)
+
+
+def _interval(a, b):
+    # Semitones between two notes, ignoring octaves (0..6)
+    d = np.abs(a - b) % 12
+    return np.minimum(d, 12 - d)
+
+
+def frame_marks(take, reference):
+    """
+    0..1 per reference frame sung against: full marks within
+    IN_TUNE_SEMITONES, none from OFF_KEY_SEMITONES or when silent.
+    """
+    with np.errstate(invalid='ignore'):
+        marks = 1 - (_interval(take, reference) - IN_TUNE_SEMITONES) / (OFF_KEY_SEMITONES - IN_TUNE_SEMITONES)
+    return np.where(np.isnan(take), 0.0, np.clip(marks, 0.0, 1.0))
+
+
+def dtw_band(take, reference, band):
+    """
+    Align two contours on the same time grid with DTW restricted to
+    ``band`` frames either side of the diagonal; open at both ends.
+    Returns the matched (take index, reference index) pairs.
+
+    Each row is solved at once: with steps from the row below, and S the
+    running sum of the row's costs, D[k] = S[k] + min over m <= k of
+    (from_below[m] - S[m - 1]), a cumulative minimum.
+    """
+    rows, width = len(take), 2 * band + 1
+    cols = np.arange(rows)[:, None] + np.arange(-band, band + 1)[None, :]
+    valid = (cols >= 0) & (cols < len(reference))
+    ref = reference[np.clip(cols, 0, len(reference) - 1)]
+    t = take[:, None]
+    voiced_t, voiced_r = ~np.isnan(t), ~np.isnan(ref)
+    cost = np.where(voiced_t & voiced_r, np.minimum(np.nan_to_num(_interval(t, ref)), 3.0) / 3.0,
+                    np.where(voiced_t == voiced_r, 0.0, VOICING_MISMATCH_COST))
+    # Drifting from the beat costs a little, so a wrong note isn't excused by a far-off right one
+    cost = cost + WARP_COST * np.abs(np.arange(-band, band + 1)) / max(band, 1)
+    cost = np.where(valid, cost, 1e6)
+
+    acc = np.empty((rows, width))
+    previous = np.zeros(width + 1)
+    previous[width] = np.inf
+    for i in range(rows):
+        below = np.minimum(previous[:width], previous[1:])  # Diagonal step, or straight up the same column
+        running = np.cumsum(cost[i])
+        acc[i] = running + np.minimum.accumulate(below - np.concatenate(([0.0], running[:-1])))
+        previous[:width] = acc[i]
+
+    # Walk back from the cheapest end
+    path = []
+    i, k = rows - 1, int(np.argmin(acc[-1]))
+    while i >= 0:
+        path.append((i, i + k - band))
+        steps = [(acc[i - 1, k] if i else 0.0, i - 1, k),
+                 (acc[i - 1, k + 1] if i and k + 1 < width else np.inf, i - 1, k + 1),
+                 (acc[i, k - 1] if k else np.inf, i, k - 1)]
+        _, i, k = min(steps, key=lambda s: s[0])
+    path.reverse()
+    return np.array([p for p in path if valid[p[0], p[1] - p[0] + band]], dtype=np.int64).reshape(-1, 2)
+
+
+def score_take(take, reference, phrases, semitones=0, tempo=1.0, offset=0.0):
+    """
+    Score a take's pitch contour against the song's melody. ``semitones``
+    and ``tempo`` are the shift the take was sung over and ``offset`` how
+    late it runs (seconds), so take time t is song time (t - offset) *
+    tempo. ``phrases`` are lyrics segments with start and end in song time.
+    Returns {'score', 'phrases': [{'start', 'end', 'text', 'score'}]};
+    scores are 0..100, None for phrases with nothing to sing or past the
+    end of the take.
+    """
+    # Resample the take onto the song's frame grid
+    song_frames = np.arange(len(reference))
+    source = np.rint((song_frames * HOP_SECONDS / tempo + offset) / HOP_SECONDS).astype(np.int64)
+    inside = (source >= 0) & (source < len(take))
+    covered = int(np.count_nonzero(inside))
+    if covered == 0:
+        return {'score': None, 'phrases': [dict(p, score=None) for p in phrases]}
+    first = int(np.argmax(inside))
+    on_grid = np.full(len(reference), np.nan, dtype=np.float32)
+    on_grid[inside] = take[source[inside]]
+
+    factor = int(round(DTW_HOP_SECONDS / HOP_SECONDS))
+    sung = _pool(on_grid[first:first + covered], factor)
+    melody = _pool(reference[first:first + covered], factor) + semitones
+    path = dtw_band(sung, melody, int(round(DTW_BAND_SECONDS / DTW_HOP_SECONDS)))
+
+    # Best match per melody frame; frames the path never reaches score 0
+    marks = np.zeros(len(melody))
+    np.maximum.at(marks, path[:, 1], frame_marks(sung[path[:, 0]], melody[path[:, 1]]))
+    to_sing = ~np.isnan(melody)
+    times = (first + np.arange(len(melody)) * factor) * HOP_SECONDS
+
+    scored = []
+    for phrase in phrases:
+        inside_phrase = to_sing & (times >= phrase['start']) & (times < phrase['end'])
+        score = None
+        if inside_phrase.any():
+            score = round(100 * float(marks[inside_phrase].mean()), 1)
+        scored.append({'start': phrase['start'], 'end': phrase['end'], 'text': phrase['text'], 'score': score})
+    total = round(100 * float(marks[to_sing].mean()), 1) if to_sing.any() else None
+    return {'score': total, 'phrases': scored}
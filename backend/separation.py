@@ -0,0 +1,165 @@
+import os
+import logging
+import threading
+from collections import namedtuple
+from audio_io import AudioBuffer
+import metrics
+
+log = logging.getLogger(__name__)
+
+# Stems written next to the upload name, matching the layout of the Demucs CLI
+# (output_dir/<model>/<track>/no_vocals.wav) so existing paths keep working.
+INSTRUMENTAL_STEM = 'no_vocals.wav'
+VOCALS_STEM = 'vocals.wav'
+
+# Result of separating a song; vocals is None when it wasn't asked for
+Stems = namedtuple('Stems', ['instrumental', 'vocals'])
+
+
+def vocals_path(instrumental_path):
+    return os.path.join(os.path.dirname(instrumental_path), VOCALS_STEM)
+
+
+class DemucsEngine:
+    """
+    In-process Demucs separation.
+
+    The model is loaded once per worker process and reused for every job,
+    instead of paying PyTorch start-up and weight loading for each song as
+    the CLI does. Audio is separated in fixed-size chunks with a short
+    crossfade so progress can be reported after every chunk, and only the
+    accompaniment (everything but the vocals) is kept and written.
+    """
+
+    def __init__(self, model_name='htdemucs', device=None, chunk_seconds=30.0, overlap_seconds=1.0):
+        self.model_name = model_name
+        self.device = device
+        self.chunk_seconds = chunk_seconds
+        self.overlap_seconds = overlap_seconds
+        self._model = None
+        self._lock = threading.Lock()
+
+    @property
+    def model(self):
+        with self._lock:
+            if self._model is None:
+                import torch
+                from demucs.pretrained import get_model
+
+                log.info("Loading Demucs model '%s'", self.model_name)
+                with metrics.span('model_load_seconds', model=f"demucs-{self.model_name}"):
+                    model = get_model(self.model_name)
+                model.eval()
+                if self.device is None:
+                    self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
+                self._model = model
+            return self._model
+
+    @property
+    def samplerate(self):
+        return self.model.samplerate
+
+    def load_audio(self, filepath):
+        """
+        Decode a file to a (channels, samples) tensor at the model's rate.
+        """
+        from demucs.audio import AudioFile
+
+        model = self.model
+        return AudioFile(filepath).read(streams=0, samplerate=model.samplerate, channels=model.audio_channels)
+
+    def separate_array(self, wav, with_vocals=False):
+        """
+        Return the accompaniment for a (channels, samples) tensor, or
+        (accompaniment, vocals) with ``with_vocals``.
+        """
+        import torch
+        from demucs.apply import apply_model
+
+        model = self.model
+        # Same normalisation the Demucs CLI applies before separating
+        ref = wav.mean(0)
+        mean, std = ref.mean(), ref.std() + 1e-8
+        with torch.no_grad():
+            sources = apply_model(model, ((wav - mean) / std)[None], device=self.device,
+                                  split=True, overlap=0.25, progress=False)[0]
+        sources = sources * std + mean
+        vocals = sources[model.sources.index('vocals')]
+        accompaniment = sources.sum(0) - vocals
+        return (accompaniment, vocals) if with_vocals else accompaniment
+
+    def instrumental_path(self, filepath, output_dir):
+        base_name = os.path.splitext(os.path.basename(filepath))[0]
+        return os.path.join(output_dir, self.model_name, base_name, INSTRUMENTAL_STEM)
+
+    def separate(self, filepath, output_dir, on_progress=None, audio=None, keep_vocals=False):
+        """
+        Separate ``filepath`` and write the accompaniment stem (and the
+        vocals stem with ``keep_vocals``). ``audio`` is the job's
+        already-decoded AudioBuffer at the model's rate, if any. Returns
+        Stems of AudioBuffers whose paths are the stem files.
+        """
+        import torch
+        from demucs.audio import save_audio
+
+        if audio is not None and audio.samplerate == self.samplerate:
+            wav = torch.from_numpy(audio.samples)
+        else:
+            wav = self.load_audio(filepath)
+        length = wav.shape[-1]
+        chunk = max(1, int(self.chunk_seconds * self.samplerate))
+        overlap = min(int(self.overlap_seconds * self.samplerate), chunk)
+        fade_in = torch.linspace(0, 1, overlap) if overlap else None
+
+        # Chunk i covers [start, start + chunk + overlap); neighbouring chunks
+        # are blended with complementary linear ramps over the overlap.
+        accompaniment = torch.zeros(wav.shape, dtype=torch.float32)
+        vocals = torch.zeros(wav.shape, dtype=torch.float32) if keep_vocals else None
+        starts = range(0, max(1, length - overlap), chunk)
+        for i, start in enumerate(starts):
+            end = min(length, start + chunk + overlap)
+            parts = self.separate_array(wav[:, start:end], with_vocals=True)
+            for part, stem in zip(parts, (accompaniment, vocals)):
+                if stem is None:
+                    continue
+                if fade_in is not None:
+                    if start > 0:
+                        part[:, :overlap] *= fade_in
+                    if end < length:
+                        part[:, -overlap:] *= fade_in.flip(0)
+                stem[:, start:end] += part
+            if on_progress:
+                on_progress(100 * (i + 1) / len(starts))
+
+        instrumental_path = self.instrumental_path(filepath, output_dir)
+        os.makedirs(os.path.dirname(instrumental_path), exist_ok=True)
+        save_audio(accompaniment, instrumental_path, samplerate=self.samplerate)
+        vocals_buffer = None
+        if vocals is not None:
+            save_audio(vocals, vocals_path(instrumental_path), samplerate=self.samplerate)
+            vocals_buffer = AudioBuffer(vocals.numpy(), self.samplerate, path=vocals_path(instrumental_path))
+        # Encoding, peaks and transcription read these samples instead of decoding the WAVs
+        return Stems(AudioBuffer(accompaniment.numpy(), self.samplerate, path=instrumental_path), vocals_buffer)
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_separation_engine(app):
+    """
+    Return this process's Demucs engine, or None if Demucs can't be imported
+    (callers then fall back to the CLI).
+    """
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            try:
+                import demucs.apply  # noqa: F401
+            except ImportError:
+                return None
+            _engine = DemucsEngine(
+                model_name=app.config.get('DEMUCS_MODEL', 'htdemucs'),
+                chunk_seconds=app.config.get('DEMUCS_CHUNK_SECONDS', 30.0),
+            )
+        return _engine
@@ -0,0 +1,369 @@
+import os
+import logging
+import subprocess
+import threading
+from datetime import datetime, timedelta
+from sqlalchemy import func
+from models import db, Artifact, Job, Recording, Song
+import metrics
+import variants
+
+log = logging.getLogger(__name__)
+
+# Cold instrumentals are kept as FLAC next to where the WAV was
+COLD_EXT = '.flac'
+
+def song_upload_path(app, song):
+    return os.path.join(app.config['UPLOAD_FOLDER'], 'uploads', str(song.user_id), song.filename)
+
+
+def recording_path(app, filename):
+    return os.path.join(app.config['UPLOAD_FOLDER'], 'recordings', filename)
+
+
+def _relative(app, path):
+    return os.path.relpath(os.path.abspath(path), app.config['UPLOAD_FOLDER'])
+
+
+def _absolute(app, artifact):
+    return os.path.join(app.config['UPLOAD_FOLDER'], artifact.path)
+
+
+def _file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def instrumental_source(wav_path):
+    """
+    The instrumental file to read: the WAV, or its FLAC once compressed
+    cold. None if neither exists.
+    """
+    if not wav_path:
+        return None
+    if os.path.exists(wav_path):
+        return wav_path
+    flac = os.path.splitext(wav_path)[0] + COLD_EXT
+    return flac if os.path.exists(flac) else None
+
+
+def _stem_kind(name):
+    if name.endswith('.tail.npy'):
+        return 'checkpoint'
+    if name.endswith('.pitch.npy'):
+        return 'pitch'
+    if name.startswith('vocals.'):
+        return 'vocals'
+    if '.peaks-' in name:
+        return 'peaks'
+    if name.endswith('.wav') or name.endswith(COLD_EXT):
+        return 'instrumental'
+    return 'encoding'
+
+
+# --- Tracking ---
+
+def track(app, path, kind, user_id=None, song_id=None, recording_id=None, cache_key=None):
+    """
+    Record (or refresh) the artifact at ``path``. The caller commits.
+    """
+    rel = _relative(app, path)
+    artifact = Artifact.query.filter_by(path=rel).first()
+    if artifact is None:
+        artifact = Artifact(path=rel, kind=kind)
+        db.session.add(artifact)
+    artifact.user_id, artifact.song_id, artifact.recording_id = user_id, song_id, recording_id
+    artifact.cache_key = cache_key
+    artifact.size_bytes = _file_size(path)
+    artifact.state = 'live'
+    return artifact
+
+
+def track_song(app, song):
+    """
+    Record a song's upload and everything in its stem folder. Stems shared
+    through the result cache are owned by the cache entry. Idempotent, so it
+    also adopts files of songs processed before tracking existed. The caller
+    commits.
+    """
+    track(app, song_upload_path(app, song), 'upload', user_id=song.user_id, song_id=song.id)
+    if not song.instrumental_path:
+        return
+    folder = os.path.dirname(song.instrumental_path)
+    if not os.path.isdir(folder):
+        return
+    # A song reusing cached stems doesn't become their owner
+    existing = Artifact.query.filter_by(path=_relative(app, song.instrumental_path)).first()
+    if existing is not None and existing.song_id != song.id:
+        return
+    for name in os.listdir(folder):
+        track(app, os.path.join(folder, name), _stem_kind(name), user_id=song.user_id,
+              song_id=song.id, cache_key=song.cache_key)
+
+
+def touch(app, path):
+    """
+    Note that a tracked file was used, at most once a day, so cold tiering
+    can tell what is still played.
+    """
+    rel = _relative(app, path)
+    cutoff = datetime.utcnow() - timedelta(days=1)
+    updated = Artifact.query.filter(Artifact.path == rel, Artifact.last_access_at < cutoff) \
+        .update({'last_access_at': datetime.utcnow()}, synchronize_session=False)
+    if updated:
+        db.session.commit()
+
+
+def finished(app, path):
+    """
+    True if a tracked file won't change any more: a final mix, or a stem of
+    a song that is done processing. While a song streams its instrumental WAV
+    is still growing.
+    """
+    artifact = Artifact.query.filter_by(path=_relative(app, path), state='live').first()
+    if artifact is None:
+        return False
+    if artifact.kind == 'mix':
+        return True
+    if artifact.song_id is None:
+        return False
+    song = Song.query.get(artifact.song_id)
+    return song is not None and song.status == 'ready'
+
+
+# --- Deletion ---
+
+def discard(artifacts):
+    """
+    Mark artifacts for deletion. Their rows turn into tombstones in the
+    caller's transaction; the files are removed by ``purge`` once that has
+    committed (and by the collector if the process dies first), so a
+    rolled-back delete never loses files.
+    """
+    for artifact in artifacts:
+        artifact.state = 'deleted'
+
+
+def purge(app, reason='delete'):
+    """
+    Remove the files of committed tombstones, then the tombstones. Commits.
+    Returns the bytes freed.
+    """
+    freed = 0
+    for artifact in Artifact.query.filter_by(state='deleted').all():
+        path = _absolute(app, artifact)
+        try:
+            if os.path.exists(path):
+                freed += _file_size(path)
+                os.remove(path)
+        except OSError as e:
+            log.warning("Could not delete %s: %s", artifact.path, e)
+            continue
+        db.session.delete(artifact)
+        _remove_empty_parent(path, app)
+    db.session.commit()
+    if freed:
+        metrics.inc('storage_reclaimed_bytes_total', freed, reason=reason)
+    return freed
+
+
+def _remove_empty_parent(path, app):
+    folder = os.path.dirname(path)
+    root = os.path.join(app.config['UPLOAD_FOLDER'], 'instrumentals')
+    if folder.startswith(root + os.sep):
+        try:
+            os.rmdir(folder)
+        except OSError:
+            pass  # Not empty
+
+
+def delete_recording(app, recording):
+    """
+    Delete a recording, its jobs and its files (take and mix). Commits.
+    """
+    for filename in {recording.filename, recording.raw_filename} - {None}:
+        track(app, recording_path(app, filename), 'mix', user_id=recording.user_id, recording_id=recording.id)
+    discard(Artifact.query.filter_by(recording_id=recording.id).all())
+    Job.query.filter_by(recording_id=recording.id).delete()
+    db.session.delete(recording)
+    db.session.commit()
+    purge(app)
+
+
+def delete_song(app, song):
+    """
+    Delete a song with its jobs, recordings and files in one transaction,
+    then remove the files and its cached variants. Stems shared through the
+    result cache stay with the cache (released here, evicted by it later).
+    Commits.
+    """
+    import result_cache
+
+    track_song(app, song)
+    shared = result_cache.release(song)
+    owned = Artifact.query.filter(Artifact.song_id == song.id)
+    if shared:
+        # Only the cache entry keeps these now; they count against no one
+        owned.filter(Artifact.cache_key == song.cache_key) \
+            .update({'song_id': None, 'user_id': None}, synchronize_session=False)
+        owned = owned.filter(Artifact.cache_key.is_(None))
+    discard(owned.all())
+
+    for recording in Recording.query.filter_by(song_id=song.id).all():
+        for filename in {recording.filename, recording.raw_filename} - {None}:
+            track(app, recording_path(app, filename), 'mix', user_id=recording.user_id, recording_id=recording.id)
+        discard(Artifact.query.filter_by(recording_id=recording.id).all())
+        db.session.delete(recording)
+    Job.query.filter_by(song_id=song.id).delete()
+    db.session.delete(song)
+    db.session.commit()
+    variants.drop(app, song.id)
+    return purge(app)
+
+
+def drop_intermediates(app, song):
+    """
+    After a song job: record its files and delete the ones nothing reads
+    any more (the vocals stem unless KEEP_VOCALS_STEM, checkpoint tails).
+    Commits.
+    """
+    track_song(app, song)
+    unused = ['checkpoint'] if app.config.get('KEEP_VOCALS_STEM') else ['checkpoint', 'vocals']
+    discard(Artifact.query.filter(Artifact.song_id == song.id, Artifact.kind.in_(unused)).all())
+    db.session.commit()
+    purge(app, reason='intermediate')
+
+
+def finish_recording(app, recording, raw_filename):
+    """
+    After a mix job: record the mix and drop the raw take it was made from.
+    Commits.
+    """
+    track(app, recording_path(app, recording.filename), 'mix', user_id=recording.user_id,
+          recording_id=recording.id)
+    if raw_filename and raw_filename != recording.filename:
+        raw = track(app, recording_path(app, raw_filename), 'take', user_id=recording.user_id,
+                    recording_id=recording.id)
+        discard([raw])
+        recording.raw_filename = None
+    db.session.commit()
+    purge(app, reason='intermediate')
+
+
+# --- Tiering and quotas ---
+
+def compress_instrumental(app, artifact):
+    """
+    Replace a hot instrumental WAV with FLAC (lossless, about half the
+    size). Mixing reads the FLAC directly; streaming uses the encodings.
+    Claims the row first so two collectors never compress the same file.
+    Returns the bytes saved.
+    """
+    claimed = Artifact.query.filter_by(id=artifact.id, tier='hot') \
+        .update({'tier': 'compressing'}, synchronize_session=False)
+    db.session.commit()
+    if not claimed:
+        return 0
+
+    wav = _absolute(app, artifact)
+    flac = os.path.splitext(wav)[0] + COLD_EXT
+    try:
+        with metrics.span('ffmpeg_seconds', op='compress'):
+            subprocess.run(["ffmpeg", "-v", "error", "-i", wav, "-c:a", "flac", "-y", flac],
+                           check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except (OSError, subprocess.CalledProcessError) as e:
+        log.warning("Could not compress %s: %s", artifact.path, e)
+        if os.path.exists(flac):
+            os.remove(flac)
+        artifact = Artifact.query.get(artifact.id)
+        artifact.tier = 'hot'
+        db.session.commit()
+        return 0
+
+    artifact = Artifact.query.get(artifact.id)
+    before = artifact.size_bytes or _file_size(wav)
+    artifact.path = _relative(app, flac)
+    artifact.size_bytes = _file_size(flac)
+    artifact.tier = 'cold'
+    db.session.commit()
+    os.remove(wav)
+    saved = max(0, before - artifact.size_bytes)
+    metrics.inc('storage_reclaimed_bytes_total', saved, reason='compress')
+    return saved
+
+
+def usage_bytes(user_id):
+    return db.session.query(func.coalesce(func.sum(Artifact.size_bytes), 0)) \
+        .filter(Artifact.user_id == user_id, Artifact.state == 'live').scalar()
+
+
+def over_quota(app, user_id):
+    quota = app.config.get('STORAGE_QUOTA_BYTES')
+    return bool(quota) and usage_bytes(user_id) >= quota
+
+
+def collect(app):
+    """
+    One garbage-collection pass: finish interrupted deletions, compress
+    instrumentals unplayed for STORAGE_COLD_AFTER_DAYS, and compress early
+    for users over STORAGE_QUOTA_BYTES. Returns a summary dict.
+    """
+    summary = {'purged_bytes': purge(app), 'compressed': 0}
+
+    cold_after = app.config.get('STORAGE_COLD_AFTER_DAYS', 30)
+    candidates = Artifact.query.filter(Artifact.kind == 'instrumental', Artifact.tier == 'hot',
+                                       Artifact.state == 'live')
+    stale = []
+    if cold_after:
+        cutoff = datetime.utcnow() - timedelta(days=cold_after)
+        stale = candidates.filter(Artifact.last_access_at < cutoff).all()
+
+    quota = app.config.get('STORAGE_QUOTA_BYTES')
+    if quota:
+        over = db.session.query(Artifact.user_id).filter(Artifact.state == 'live', Artifact.user_id.isnot(None)) \
+            .group_by(Artifact.user_id).having(func.sum(Artifact.size_bytes) > quota).all()
+        for (user_id,) in over:
+            log.warning("User %s is over the storage quota, compressing their instrumentals", user_id)
+            stale += candidates.filter(Artifact.user_id == user_id) \
+                .order_by(Artifact.last_access_at).all()
+
+    seen = set()
+    for artifact in stale:
+        if artifact.id in seen:
+            continue
+        seen.add(artifact.id)
+        # Don't compress a stem a job is still reading or writing
+        if artifact.song_id and Job.query.filter(Job.song_id == artifact.song_id,
+                                                 Job.status.in_(['queued', 'running'])).count():
+            continue
+        if compress_instrumental(app, artifact):
+            summary['compressed'] += 1
+    return summary
+
+
+def start_collector(app):
+    """
+    Run ``collect`` every STORAGE_GC_INTERVAL seconds in a background thread.
+    """
+    interval = app.config.get('STORAGE_GC_INTERVAL', 3600)
+    if not interval:
+        return
+
+    def loop():
+        stop = threading.Event()
+        while not stop.wait(interval):
+            with app.app_context():
+                try:
+                    summary = collect(app)
+                    if summary['purged_bytes'] or summary['compressed']:
+                        log.info("Storage collection: %s", summary)
+                except Exception as e:
+                    log.error("Storage collection failed: %s", e)
+                    metrics.inc('errors_total', where='storage_gc')
+                    db.session.rollback()
+                finally:
+                    db.session.remove()
+
+    threading.Thread(target=loop, daemon=True, name='storage-gc').start()
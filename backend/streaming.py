@@ -0,0 +1,192 @@
+import os
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from models import db
+import events
+import metrics
+from audio_io import iter_pcm_windows, resample_mono, PartialWavWriter
+from scheduling import Preempted
+from separation import vocals_path
+from transcription import WHISPER_RATE, transcribe as transcribe_samples
+from lyrics_timeline import WordTimeline, split_lyrics
+
+log = logging.getLogger(__name__)
+
+
+def should_stream(app, duration):
+    """
+    Long tracks are processed chunk by chunk; PROCESSING_MODE can force either way.
+    """
+    mode = app.config.get('PROCESSING_MODE', 'auto')
+    if mode in ('streaming', 'batch'):
+        return mode == 'streaming'
+    threshold = app.config.get('STREAMING_MIN_SECONDS', 300)
+    return duration is not None and duration >= threshold
+
+
+def _owned_segments(segments, offset, window_start, window_end, first, last, overlap):
+    """
+    Shift window-relative Whisper segments to song time and keep those whose
+    midpoint falls in the part of the window this chunk is responsible for,
+    so speech in the overlap is not transcribed twice.
+    """
+    lo = window_start + (0 if first else overlap / 2)
+    hi = window_end - (0 if last else overlap / 2)
+    kept = []
+    for segment in segments:
+        start, end = segment['start'] + offset, segment['end'] + offset
+        if lo <= (start + end) / 2 < hi or (last and (start + end) / 2 >= hi):
+            entry = {'start': start, 'end': end, 'text': segment['text'].strip()}
+            if 'words' in segment:
+                entry['words'] = [dict(w, start=w['start'] + offset, end=w['end'] + offset) for w in segment['words']]
+            kept.append(entry)
+    return kept
+
+
+def _resume_state(checkpoint, instrumental_path, lyrics_json, lyrics_words):
+    """
+    Validate a checkpoint left by a preempted run. Returns (start_sample,
+    index, pending_tail, lyrics), or None to start over.
+    """
+    if not checkpoint or not os.path.exists(instrumental_path):
+        return None
+    tail_path = checkpoint.get('tail')
+    try:
+        tail = np.load(tail_path) if tail_path else None
+    except (OSError, ValueError):
+        return None
+    finally:
+        if tail_path and os.path.exists(tail_path):
+            os.remove(tail_path)
+    lyrics = json.loads(lyrics_json or '[]')
+    if lyrics_words:
+        lyrics = WordTimeline.from_bytes(lyrics_words).to_segments(lyrics)
+    return checkpoint['start'], checkpoint['index'], tail, lyrics
+
+
+def process_song_streaming(app, song, filepath, engine, instrumental_path, duration, progress,
+                           checkpoint=None, should_yield=None):
+    """
+    Separate and transcribe a song in overlapping windows, committing the
+    growing instrumental and lyrics after every window so playback can start
+    before the job finishes. Runs in the job's thread with an app context;
+    ``progress`` is the job's StageProgress.
+
+    After each window ``should_yield(overall_progress)`` is asked whether to
+    stop for shorter work; if so the window boundary, held-back crossfade
+    tail and written length are saved and Preempted is raised with them as
+    the checkpoint. Passing that checkpoint back resumes from there.
+
+    With TRANSCRIBE_SOURCE=vocals each window's vocals are transcribed once
+    it is separated; otherwise the mix is transcribed alongside separation.
+    """
+    import torch
+
+    window_seconds = app.config.get('STREAMING_WINDOW_SECONDS', 60)
+    overlap_seconds = app.config.get('STREAMING_OVERLAP_SECONDS', 5)
+    samplerate = engine.samplerate
+    channels = engine.model.audio_channels
+    overlap = int(overlap_seconds * samplerate)
+    fade_in = np.linspace(0, 1, overlap, dtype=np.float32)
+    total_samples = int(duration * samplerate) if duration else None
+
+    os.makedirs(os.path.dirname(instrumental_path), exist_ok=True)
+    resume = _resume_state(checkpoint, instrumental_path, song.lyrics_json, song.lyrics_words)
+    writer = None
+    if resume:
+        start_sample, first_index, pending_tail, lyrics = resume
+        try:
+            writer = PartialWavWriter(instrumental_path, samplerate, channels, resume_frames=start_sample)
+            log.info("Song %s: resuming at %.0fs", song.id, start_sample / samplerate)
+        except ValueError as e:
+            log.warning("Song %s: can't resume (%s), starting over", song.id, e)
+    if writer is None:
+        start_sample, first_index, pending_tail, lyrics = 0, 0, None, []
+        writer = PartialWavWriter(instrumental_path, samplerate, channels)
+    # The vocals stem is kept for scoring: its melody is tracked once the song is done
+    vocals_writer = None
+    if app.config.get('SCORING', True):
+        try:
+            vocals_writer = PartialWavWriter(vocals_path(instrumental_path), samplerate, channels,
+                                             resume_frames=start_sample)
+        except (ValueError, OSError) as e:
+            log.warning("Song %s: not keeping the vocals stem (%s), it won't be scored", song.id, e)
+            if os.path.exists(vocals_path(instrumental_path)):
+                os.remove(vocals_path(instrumental_path))
+
+    from_vocals = app.config.get('TRANSCRIBE_SOURCE', 'vocals') == 'vocals'
+
+    def separate(window):
+        with metrics.span('stream_window_seconds', step='separate'):
+            stems = engine.separate_array(torch.from_numpy(np.ascontiguousarray(window)), with_vocals=True)
+            return tuple(stem.numpy() for stem in stems)
+
+    def transcribe(window, prompt):
+        with metrics.span('stream_window_seconds', step='transcribe'):
+            audio = resample_mono(window, samplerate, WHISPER_RATE)
+            return transcribe_samples(app, audio, initial_prompt=prompt)
+
+    try:
+        with ThreadPoolExecutor(max_workers=2, thread_name_prefix='stream') as pool:
+            windows = iter_pcm_windows(filepath, samplerate, channels, window_seconds, overlap_seconds,
+                                       start_sample=start_sample)
+            for index, (start, window, last) in enumerate(windows, start=first_index):
+                # Separation and transcription of a window are independent
+                prompt = lyrics[-1]['text'] if lyrics else None
+                sep_future = pool.submit(separate, window)
+                if from_vocals:
+                    accompaniment, vocals = sep_future.result()
+                    segments = transcribe(vocals, prompt)
+                else:
+                    asr_future = pool.submit(transcribe, window, prompt)
+                    accompaniment, vocals = sep_future.result()
+                    segments = asr_future.result()
+                if vocals_writer is not None:
+                    # Overlaps are cut, not crossfaded: enough to track pitch from
+                    vocals_writer.append(vocals if last or overlap == 0 else vocals[:, :-overlap])
+
+                # Crossfade with the held-back end of the previous window
+                if pending_tail is not None:
+                    n = min(overlap, accompaniment.shape[1])
+                    accompaniment[:, :n] = accompaniment[:, :n] * fade_in[:n] + pending_tail[:, :n]
+                if last or overlap == 0:
+                    writer.append(accompaniment)
+                    pending_tail = None
+                else:
+                    writer.append(accompaniment[:, :-overlap])
+                    pending_tail = accompaniment[:, -overlap:] * fade_in[::-1]
+
+                window_start = start / samplerate
+                window_end = (start + window.shape[1]) / samplerate
+                lyrics.extend(_owned_segments(segments, window_start, window_start, window_end,
+                                              index == 0, last, overlap_seconds))
+
+                done = start + window.shape[1]
+                pct = 100 if last else (100 * done / total_samples if total_samples else 0)
+                progress.update('separate', pct)
+                progress.update('transcribe', pct)
+                song.instrumental_path = instrumental_path
+                song.instrumental_lufs = None
+                song.lyrics_json, song.lyrics_words = split_lyrics(lyrics)
+                song.progress = progress.overall()
+                song.stage_progress = json.dumps(progress.snapshot())
+                with metrics.span('db_commit_seconds', site='window'):
+                    db.session.commit()
+                events.publish_song(song, partial=True)
+                log.info("Song %s: streamed window %s (%.0fs)", song.id, index + 1, window_end)
+
+                if not last and should_yield and should_yield(song.progress):
+                    tail_path = None
+                    if pending_tail is not None:
+                        tail_path = f"{os.path.splitext(instrumental_path)[0]}.tail.npy"
+                        np.save(tail_path, pending_tail)
+                    raise Preempted({'start': writer.frames, 'index': index + 1, 'tail': tail_path})
+    finally:
+        writer.close()
+        if vocals_writer is not None:
+            vocals_writer.close()
+
+    lyrics_json, lyrics_words = split_lyrics(lyrics)
+    return {'instrumental_path': instrumental_path, 'lyrics_json': lyrics_json, 'lyrics_words': lyrics_words}
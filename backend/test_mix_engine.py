@@ -0,0 +1,115 @@
+import numpy as np
+import pytest
+
+from mix_engine import (MIX_RATE, ALIGN_RATE, ALIGN_SECONDS, MIN_OFFSET_SECONDS, MAX_OFFSET_SECONDS,
+                        LoudnessMeter, estimate_offset, denoise, mix_gains, soft_limit)
+
+
+def tone(hz, seconds, amplitude, rate=MIX_RATE):
+    t = np.arange(int(seconds * rate)) / rate
+    return (amplitude * np.sin(2 * np.pi * hz * t)).astype(np.float32)
+
+
+def loudness(samples, rate=MIX_RATE, block=None):
+    meter = LoudnessMeter(rate)
+    samples = np.atleast_2d(samples)
+    step = block or samples.shape[1]
+    for start in range(0, samples.shape[1], step):
+        meter.add(samples[:, start:start + step])
+    return meter.integrated()
+
+
+def test_loudness_of_reference_tone():
+    # BS.1770: a 997 Hz sine at 0 dBFS in one channel reads -3.01 LUFS
+    assert loudness(tone(997, 5, 1.0)) == pytest.approx(-3.01, abs=0.05)
+    assert loudness(tone(997, 5, 0.1)) == pytest.approx(-23.01, abs=0.05)
+
+
+def test_loudness_adds_channels():
+    mono = tone(997, 5, 0.1)
+    assert loudness(np.stack([mono, mono])) == pytest.approx(-20.0, abs=0.05)
+
+
+def test_loudness_does_not_depend_on_block_size():
+    samples = tone(440, 7.3, 0.2)
+    assert loudness(samples, block=1234) == pytest.approx(loudness(samples), abs=1e-6)
+
+
+def test_loudness_gates_silence():
+    audible = tone(997, 5, 0.1)
+    with_gaps = np.concatenate([np.zeros(10 * MIX_RATE, dtype=np.float32), audible,
+                                np.zeros(10 * MIX_RATE, dtype=np.float32)])
+    # Ungated, 20 s of silence would pull it down by 7 dB; only the blocks straddling the edges count
+    assert loudness(with_gaps) == pytest.approx(loudness(audible), abs=0.5)
+    assert loudness(np.zeros(5 * MIX_RATE, dtype=np.float32)) is None
+
+
+def clicks(seconds, rate, seed=0):
+    """
+    Decaying noise bursts at irregular times, like a drum track.
+    """
+    rng = np.random.default_rng(seed)
+    samples = np.zeros(int(seconds * rate), dtype=np.float32)
+    decay = np.exp(-np.arange(int(0.05 * rate)) / (0.01 * rate)).astype(np.float32)
+    for at in np.cumsum(rng.uniform(0.15, 0.6, int(seconds / 0.15))):
+        start = int(at * rate)
+        if start + len(decay) > len(samples):
+            break
+        samples[start:start + len(decay)] += decay * rng.standard_normal(len(decay)).astype(np.float32)
+    return samples
+
+
+@pytest.mark.parametrize('delay', [0.0, 0.05, 0.15, 0.42, 0.7])
+def test_estimate_offset_recovers_known_delay(delay):
+    song = clicks(40, ALIGN_RATE)
+    # The take hears the song ``delay`` seconds late
+    take = np.concatenate([np.zeros(int(round(delay * ALIGN_RATE)), dtype=np.float32), song])
+    start, lead = 5.0, MAX_OFFSET_SECONDS
+    vocal = take[int(start * ALIGN_RATE):int((start + ALIGN_SECONDS) * ALIGN_RATE)]
+    segment = song[int((start - lead) * ALIGN_RATE):int((start - MIN_OFFSET_SECONDS) * ALIGN_RATE) + len(vocal)]
+    offset, confidence = estimate_offset(vocal, segment, lead)
+    assert offset == pytest.approx(delay, abs=0.005)
+    assert confidence > 0.9
+
+
+def test_estimate_offset_of_silence():
+    silence = np.zeros(ALIGN_RATE * 5, dtype=np.float32)
+    assert estimate_offset(silence, np.zeros(ALIGN_RATE * 6, dtype=np.float32), MAX_OFFSET_SECONDS) == (None, 0.0)
+
+
+def test_denoise_lowers_noise_and_keeps_the_voice():
+    rng = np.random.default_rng(0)
+    voice = tone(330, 4, 0.3)
+    voice[:MIX_RATE] = 0  # A second of noise only before singing
+    noise = (0.01 * rng.standard_normal(len(voice))).astype(np.float32)
+    cleaned = denoise(voice + noise, MIX_RATE)
+    assert len(cleaned) == len(voice)
+    rms = lambda x: float(np.sqrt(np.mean(x ** 2)))
+    # Noise alone is pulled down by most of NOISE_REDUCTION_DB
+    assert rms(cleaned[:MIX_RATE // 2]) < rms(noise[:MIX_RATE // 2]) / 3
+    # The sung part keeps its level
+    assert rms(cleaned[2 * MIX_RATE:3 * MIX_RATE]) == pytest.approx(rms(voice[2 * MIX_RATE:3 * MIX_RATE]), rel=0.05)
+
+
+def test_denoise_removes_rumble():
+    rumble = tone(40, 2, 0.3)
+    cleaned = denoise(rumble + tone(440, 2, 0.1), MIX_RATE)
+    spectrum = np.abs(np.fft.rfft(cleaned[MIX_RATE // 2:MIX_RATE // 2 + MIX_RATE]))
+    assert spectrum[40] < spectrum[440] / 10
+
+
+def test_mix_gains_put_the_vocal_above_the_instrumental_at_the_target():
+    instrumental_gain, vocal_gain = mix_gains(-20.0, -30.0, -14.0, 2.0)
+    instrumental = -20.0 + 20 * np.log10(instrumental_gain)
+    vocal = -30.0 + 20 * np.log10(vocal_gain)
+    assert vocal - instrumental == pytest.approx(2.0, abs=1e-6)
+    assert 10 * np.log10(10 ** (instrumental / 10) + 10 ** (vocal / 10)) == pytest.approx(-14.0, abs=1e-6)
+
+
+def test_soft_limit_never_clips():
+    block = np.linspace(-3, 3, 1001, dtype=np.float32)
+    limited = soft_limit(block.copy())
+    assert np.abs(limited).max() <= 0.99
+    assert (np.diff(limited) >= 0).all()
+    quiet = np.abs(block) <= 0.89
+    np.testing.assert_array_equal(limited[quiet], block[quiet])
@@ -0,0 +1,113 @@
+import numpy as np
+import pytest
+
+from scoring import PITCH_RATE, HOP_SECONDS, pitch_contour, dtw_band, score_take
+
+PHRASES = [{'start': 1.0, 'end': 9.0, 'text': 'one'},
+           {'start': 10.0, 'end': 18.0, 'text': 'two'},
+           {'start': 19.0, 'end': 27.0, 'text': 'three'}]
+
+
+def sine(hz, seconds=1.0, rate=PITCH_RATE):
+    t = np.arange(int(seconds * rate)) / rate
+    return (0.3 * np.sin(2 * np.pi * hz * t)).astype(np.float32)
+
+
+def melody(seconds=28.0, shift_phrase=None, shift=0):
+    """
+    A contour on the HOP_SECONDS grid: one note per half second in each
+    phrase, unvoiced between phrases.
+    """
+    rng = np.random.default_rng(0)
+    contour = np.full(int(seconds / HOP_SECONDS), np.nan, dtype=np.float32)
+    for index, phrase in enumerate(PHRASES):
+        for start in np.arange(phrase['start'], phrase['end'], 0.5):
+            note = rng.integers(48, 76) + (shift if index == shift_phrase else 0)
+            contour[int(start / HOP_SECONDS):int((start + 0.45) / HOP_SECONDS)] = note
+    return contour
+
+
+@pytest.mark.parametrize('hz, note', [(110.0, 45.0), (220.0, 57.0), (440.0, 69.0), (523.25, 72.0)])
+def test_pitch_contour_of_sine(hz, note):
+    contour = pitch_contour(sine(hz))
+    assert len(contour) == int(1.0 / HOP_SECONDS)
+    assert np.mean(~np.isnan(contour)) > 0.9
+    assert np.nanmedian(contour) == pytest.approx(note, abs=0.05)
+
+
+def test_pitch_contour_of_silence_is_unvoiced():
+    assert np.isnan(pitch_contour(np.zeros(PITCH_RATE, dtype=np.float32))).all()
+
+
+def test_pitch_contour_of_empty_input():
+    assert len(pitch_contour(np.zeros(10, dtype=np.float32))) == 0
+
+
+def test_dtw_band_identical_contours_follow_the_diagonal():
+    contour = melody()[::2]
+    path = dtw_band(contour, contour, 25)
+    assert (path[:, 0] == path[:, 1]).all()
+    assert len(path) == len(contour)
+
+
+def test_identical_take_scores_full_marks():
+    reference = melody()
+    result = score_take(reference.copy(), reference, PHRASES)
+    assert result['score'] == 100.0
+    assert [p['score'] for p in result['phrases']] == [100.0, 100.0, 100.0]
+
+
+def test_late_take_scores_full_marks_given_its_offset():
+    reference = melody()
+    delay = int(0.3 / HOP_SECONDS)
+    take = np.concatenate([np.full(delay, np.nan, dtype=np.float32), reference])
+    assert score_take(take, reference, PHRASES, offset=0.3)['score'] == 100.0
+
+
+def test_rushing_within_the_band_is_not_penalised():
+    reference = melody()
+    early = int(0.2 / HOP_SECONDS)
+    take = np.concatenate([reference[early:], np.full(early, np.nan, dtype=np.float32)])
+    assert score_take(take, reference, PHRASES)['score'] > 90
+
+
+def test_off_key_phrase_scores_low():
+    reference = melody()
+    result = score_take(melody(shift_phrase=1, shift=3), reference, PHRASES)
+    first, second, third = (p['score'] for p in result['phrases'])
+    assert first == third == 100.0
+    # Only notes that happen to match a neighbour within the band earn anything
+    assert second < 20
+    assert result['score'] < 75
+
+
+def test_octave_is_ignored():
+    reference = melody()
+    assert score_take(reference - 12, reference, PHRASES)['score'] == 100.0
+
+
+def test_take_sung_over_a_shifted_instrumental():
+    reference = melody()
+    assert score_take(reference + 2, reference, PHRASES, semitones=2)['score'] == 100.0
+    assert score_take(reference, reference, PHRASES, semitones=2)['score'] < 50
+
+
+def test_take_sung_slower():
+    reference = melody()
+    # At 0.8x, take frame j is song frame 0.8 j
+    take = reference[np.minimum(np.rint(np.arange(int(len(reference) / 0.8)) * 0.8).astype(int),
+                                len(reference) - 1)]
+    assert score_take(take, reference, PHRASES, tempo=0.8)['score'] > 95
+
+
+def test_phrases_past_the_end_of_the_take_are_not_scored():
+    reference = melody()
+    result = score_take(reference[:int(9.5 / HOP_SECONDS)], reference, PHRASES)
+    assert [p['score'] for p in result['phrases']] == [100.0, None, None]
+
+
+def test_take_outside_the_song_has_no_score():
+    reference = melody()
+    result = score_take(reference, reference, PHRASES, offset=-100.0)
+    assert result['score'] is None
+    assert all(p['score'] is None for p in result['phrases'])
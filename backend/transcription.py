@@ -0,0 +1,278 @@
+import importlib.util
+import threading
+import types
+from bisect import bisect_right
+import numpy as np
+from model_registry import get_whisper_pool, get_faster_whisper_pool
+
+WHISPER_RATE = 16000
+
+# Whisper only reports progress through a tqdm bar. We swap in a tqdm subclass
+# that forwards updates to a per-thread callback, so concurrent transcriptions
+# each see their own progress.
+_whisper_progress = threading.local()
+_whisper_hook_lock = threading.Lock()
+
+
+def _install_whisper_progress_hook():
+    import tqdm
+    import whisper.transcribe as whisper_transcribe
+
+    with _whisper_hook_lock:
+        if getattr(whisper_transcribe, '_progress_hooked', False):
+            return
+
+        class _ProgressBar(tqdm.tqdm):
+            def update(self, n=1):
+                super().update(n)
+                callback = getattr(_whisper_progress, 'callback', None)
+                if callback and self.total:
+                    callback(100 * self.n / self.total)
+
+        whisper_transcribe.tqdm = types.SimpleNamespace(tqdm=_ProgressBar)
+        whisper_transcribe._progress_hooked = True
+
+
+class TranscriptionBackend:
+    """
+    Speech-to-text over 16 kHz mono float32 samples. ``transcribe`` returns
+    segments as dicts with ``start``/``end`` (seconds into the samples) and
+    ``text``, the format stored in ``lyrics_json``, plus with
+    ``word_timestamps`` a ``words`` list of {start, end, word}.
+    """
+
+    name = None
+
+    def __init__(self, app):
+        self.app = app
+        self.model_size = app.config['WHISPER_MODEL']
+
+    def transcribe(self, samples, on_progress=None, initial_prompt=None, word_timestamps=False):
+        raise NotImplementedError
+
+
+class WhisperBackend(TranscriptionBackend):
+    """
+    Reference openai-whisper (PyTorch, FP32 on CPU).
+    """
+
+    name = 'whisper'
+
+    def transcribe(self, samples, on_progress=None, initial_prompt=None, word_timestamps=False):
+        _install_whisper_progress_hook()
+        _whisper_progress.callback = on_progress
+        try:
+            # Whisper models are loaded once per process and shared across jobs
+            with get_whisper_pool(self.app).acquire(self.model_size) as model:
+                # verbose=False enables the progress bar without printing every segment
+                result = model.transcribe(samples, verbose=False if on_progress else None,
+                                          initial_prompt=initial_prompt, word_timestamps=word_timestamps)
+        finally:
+            _whisper_progress.callback = None
+        segments = []
+        for s in result['segments']:
+            segment = {'start': s['start'], 'end': s['end'], 'text': s['text']}
+            if word_timestamps:
+                segment['words'] = [{'start': w['start'], 'end': w['end'], 'word': w['word']}
+                                    for w in s.get('words', ())]
+            segments.append(segment)
+        return segments
+
+
+class FasterWhisperBackend(TranscriptionBackend):
+    """
+    CTranslate2 port of Whisper (faster-whisper) with int8 weights on CPU by
+    default, several times faster than the FP32 PyTorch model for nearly the
+    same transcripts. Selected with TRANSCRIPTION_BACKEND=faster-whisper.
+    """
+
+    name = 'faster-whisper'
+
+    def transcribe(self, samples, on_progress=None, initial_prompt=None, word_timestamps=False):
+        with get_faster_whisper_pool(self.app).acquire(self.model_size) as model:
+            segments, info = model.transcribe(samples, beam_size=5, initial_prompt=initial_prompt,
+                                              word_timestamps=word_timestamps)
+            result = []
+            # Segments are decoded lazily as the generator is consumed
+            for segment in segments:
+                entry = {'start': segment.start, 'end': segment.end, 'text': segment.text}
+                if word_timestamps:
+                    entry['words'] = [{'start': w.start, 'end': w.end, 'word': w.word} for w in segment.words or ()]
+                result.append(entry)
+                if on_progress and info.duration:
+                    on_progress(min(100, 100 * segment.end / info.duration))
+        if on_progress:
+            on_progress(100)
+        return result
+
+
+class BatchedWhisperBackend(TranscriptionBackend):
+    """
+    openai-whisper with 30 s windows decoded independently and batched
+    across songs by the node's transcription service (batch_transcription.py),
+    so concurrent jobs share forward passes. Windows aren't conditioned on
+    the previous window's text, and ``initial_prompt`` is ignored. Selected
+    with TRANSCRIPTION_BACKEND=whisper-batched.
+    """
+
+    name = 'whisper-batched'
+
+    def transcribe(self, samples, on_progress=None, initial_prompt=None, word_timestamps=False):
+        from batch_transcription import transcribe_windows
+
+        return transcribe_windows(self.app, samples, on_progress=on_progress, word_timestamps=word_timestamps)
+
+
+BACKENDS = {b.name: b for b in (WhisperBackend, FasterWhisperBackend, BatchedWhisperBackend)}
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+
+def backend_name(app):
+    """
+    TRANSCRIPTION_BACKEND, with 'auto' picking faster-whisper when it is installed.
+    """
+    name = app.config.get('TRANSCRIPTION_BACKEND', 'auto')
+    if name != 'auto':
+        if name not in BACKENDS:
+            raise ValueError(f"Unknown TRANSCRIPTION_BACKEND {name!r} (expected one of {sorted(BACKENDS)})")
+        return name
+    # find_spec checks it is installed without importing it (and CTranslate2)
+    if importlib.util.find_spec('faster_whisper') is not None:
+        return FasterWhisperBackend.name
+    return WhisperBackend.name
+
+
+def get_transcription_backend(app):
+    """
+    Return this process's transcription backend, creating it on first use.
+    """
+    name = backend_name(app)
+    with _backends_lock:
+        if name not in _backends:
+            _backends[name] = BACKENDS[name](app)
+        return _backends[name]
+
+
+# --- Voice activity detection ---
+
+def speech_regions(samples, rate=WHISPER_RATE, frame_seconds=0.03, floor_db=-50.0, range_db=35.0,
+                   min_silence=1.0, pad=0.25, min_speech=0.2):
+    """
+    Energy-based voice activity detection. Returns [(start, end)] sample
+    ranges that may contain voice: frames within ``range_db`` of the loud
+    parts of the track (and above ``floor_db``), with gaps shorter than
+    ``min_silence`` seconds bridged and ``pad`` seconds kept either side.
+
+    Meant for an isolated vocals stem, where everything between phrases is
+    near silence; on a full mix most of the track counts as active.
+    """
+    frame = max(1, int(rate * frame_seconds))
+    n = len(samples) // frame
+    if n == 0:
+        return [(0, len(samples))] if len(samples) else []
+    frames = np.asarray(samples[:n * frame], dtype=np.float32).reshape(n, frame)
+    energy = np.einsum('ij,ij->i', frames, frames) / frame  # Row-wise mean square without a squared copy
+    level = 10 * np.log10(energy + 1e-12)
+    threshold = max(floor_db, np.percentile(level, 95) - range_db)
+    active = level > threshold
+    if not active.any():
+        return []
+
+    # Runs of active frames as [start, end) frame indexes
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], active.astype(np.int8), [0]))))
+    runs = edges.reshape(-1, 2)
+
+    bridge = int(min_silence / frame_seconds)
+    merged = [list(runs[0])]
+    for start, end in runs[1:]:
+        if start - merged[-1][1] <= bridge:
+            merged[-1][1] = end
+        else:
+            merged.append([start, end])
+
+    pad_frames = int(pad / frame_seconds)
+    regions = []
+    for start, end in merged:
+        if (end - start) * frame_seconds < min_speech:
+            continue
+        lo = max(0, start - pad_frames) * frame
+        hi = min(len(samples), (end + pad_frames) * frame)
+        if regions and lo <= regions[-1][1]:
+            regions[-1] = (regions[-1][0], hi)
+        else:
+            regions.append((lo, hi))
+    return regions
+
+
+class SpeechMap:
+    """
+    The voiced regions of a track packed back to back (with a short silence
+    between them so the model sees a phrase boundary), and the mapping from
+    timestamps in the packed audio back to the original.
+    """
+
+    def __init__(self, samples, regions, rate=WHISPER_RATE, gap=0.3):
+        gap_samples = np.zeros(int(gap * rate), dtype=np.float32)
+        pieces = []
+        self.packed_starts = []
+        self.original_starts = []
+        self.lengths = []
+        position = 0
+        for start, end in regions:
+            if pieces:
+                pieces.append(gap_samples)
+                position += len(gap_samples)
+            self.packed_starts.append(position / rate)
+            self.original_starts.append(start / rate)
+            self.lengths.append((end - start) / rate)
+            pieces.append(np.asarray(samples[start:end], dtype=np.float32))
+            position += end - start
+        self.samples = np.concatenate(pieces) if pieces else np.zeros(0, dtype=np.float32)
+
+    def to_original(self, t):
+        i = max(0, bisect_right(self.packed_starts, t) - 1)
+        # Times in the gap after a region clamp to the region's end
+        return float(self.original_starts[i] + min(max(0.0, t - self.packed_starts[i]), self.lengths[i]))
+
+
+def transcribe(app, samples, on_progress=None, initial_prompt=None, vad=None, word_timestamps=None):
+    """
+    Transcribe 16 kHz mono samples with the configured backend. With VAD
+    (TRANSCRIPTION_VAD, on by default) silent stretches are cut out before
+    decoding and the timestamps mapped back, so Whisper doesn't spend
+    decode passes on instrumental-only passages. Returns stripped
+    ``start``/``end``/``text`` segments, with ``words`` when word timestamps
+    are on (WORD_TIMESTAMPS).
+    """
+    backend = get_transcription_backend(app)
+    if vad is None:
+        vad = app.config.get('TRANSCRIPTION_VAD', True)
+    if word_timestamps is None:
+        word_timestamps = app.config.get('WORD_TIMESTAMPS', True)
+
+    speech = None
+    if vad:
+        regions = speech_regions(samples)
+        if not regions:
+            if on_progress:
+                on_progress(100)
+            return []
+        voiced = sum(end - start for start, end in regions)
+        # Not worth re-packing the audio to skip a few seconds
+        if voiced < 0.9 * len(samples):
+            speech = SpeechMap(samples, regions)
+            samples = speech.samples
+
+    segments = backend.transcribe(samples, on_progress=on_progress,
+                                  initial_prompt=initial_prompt, word_timestamps=word_timestamps)
+    restore = speech.to_original if speech is not None else float
+    result = []
+    for segment in segments:
+        entry = {'start': restore(segment['start']), 'end': restore(segment['end']), 'text': segment['text'].strip()}
+        if 'words' in segment:
+            entry['words'] = [{'start': restore(w['start']), 'end': restore(w['end']), 'word': w['word'].strip()}
+                              for w in segment['words']]
+        result.append(entry)
+    return result
@@ -0,0 +1,378 @@
+import os
+import re
+import math
+import time
+import shutil
+import logging
+import threading
+import subprocess
+from collections import Counter
+from functools import lru_cache
+import metrics
+
+log = logging.getLogger(__name__)
+
+# Key/tempo-shifted instrumentals, rendered on demand into an on-disk LRU
+# cache under UPLOAD_FOLDER/variants/<song id>/. Both containers can be
+# played while still being written, so a request can stream the first
+# seconds of a render that is still running.
+FORMATS = {
+    'opus': {'ext': '.opus', 'mimetype': 'audio/ogg', 'bitrate_key': 'OPUS_BITRATE',
+             # Small Ogg pages so the first audio leaves within ~0.2s
+             'codec': ['-c:a', 'libopus', '-page_duration', '200000', '-f', 'ogg']},
+    'aac': {'ext': '.aac', 'mimetype': 'audio/aac', 'bitrate_key': 'AAC_BITRATE',
+            'codec': ['-c:a', 'aac', '-f', 'adts']},
+}
+NAME = re.compile(r'^([+-]\d+)st_(\d+\.\d+)x\.(\w+)$')
+TEMPO_STEP = 0.05
+# A .part file that hasn't grown for this long belongs to a dead renderer
+STALE_SECONDS = 30
+FOLLOW_POLL_SECONDS = 0.1
+FOLLOW_CHUNK = 64 * 1024
+
+_renders = {}  # final path -> ffmpeg process, for renders started by this process
+_lock = threading.Lock()
+_popular = {'at': None, 'shifts': []}
+
+
+class RenderLimit(Exception):
+    """
+    VARIANT_MAX_RUNNING renders are already running.
+    """
+
+
+def parse_shift(app, args):
+    """
+    (semitones, tempo) from request args, with tempo snapped to TEMPO_STEP.
+    Raises ValueError with a message fit for the client if either is
+    malformed or out of range.
+    """
+    try:
+        semitones = float(args.get('semitones') or 0)
+    except ValueError:
+        semitones = math.nan
+    if not (math.isfinite(semitones) and semitones.is_integer()):
+        raise ValueError("semitones must be a whole number")
+    try:
+        tempo = float(args.get('tempo') or 1)
+    except ValueError:
+        tempo = math.nan
+    if not math.isfinite(tempo):
+        raise ValueError("tempo must be a number")
+    semitones = int(semitones)
+    tempo = round(round(tempo / TEMPO_STEP) * TEMPO_STEP, 2)
+    limit = app.config.get('VARIANT_MAX_SEMITONES', 6)
+    if abs(semitones) > limit:
+        raise ValueError(f"semitones must be between -{limit} and {limit}")
+    low, high = app.config.get('VARIANT_MIN_TEMPO', 0.8), app.config.get('VARIANT_MAX_TEMPO', 1.2)
+    if not low <= tempo <= high:
+        raise ValueError(f"tempo must be between {low} and {high}")
+    return semitones, tempo
+
+
+def is_original(semitones, tempo):
+    return semitones == 0 and tempo == 1.0
+
+
+def variants_dir(app, song_id=None):
+    root = os.path.join(app.config['UPLOAD_FOLDER'], 'variants')
+    return root if song_id is None else os.path.join(root, str(song_id))
+
+
+def variant_path(app, song_id, semitones, tempo, fmt):
+    return os.path.join(variants_dir(app, song_id), f"{semitones:+d}st_{tempo:.2f}x{FORMATS[fmt]['ext']}")
+
+
+@lru_cache(maxsize=None)
+def _has_rubberband():
+    try:
+        out = subprocess.run(["ffmpeg", "-hide_banner", "-filters"], stdout=subprocess.PIPE,
+                             stderr=subprocess.DEVNULL).stdout.decode(errors='replace')
+    except FileNotFoundError:
+        return False
+    return re.search(r'\srubberband\s', out) is not None
+
+
+def _atempo_chain(factor):
+    # Older ffmpeg builds take atempo factors only within [0.5, 2]
+    stages = []
+    while factor > 2.0:
+        stages.append(2.0)
+        factor /= 2.0
+    while factor < 0.5:
+        stages.append(0.5)
+        factor /= 0.5
+    stages.append(factor)
+    return [f"atempo={f:.6f}" for f in stages if abs(f - 1.0) > 1e-6]
+
+
+def shift_filter(app, semitones, tempo, samplerate=44100):
+    """
+    The ffmpeg filter for a shift: rubberband (formant-free phase vocoder,
+    better quality) when the build has it and VARIANT_FILTER allows, else
+    resampling to move the pitch and atempo to put the speed back.
+    """
+    ratio = 2 ** (semitones / 12)
+    engine = app.config.get('VARIANT_FILTER', 'auto')
+    if engine == 'rubberband' or (engine == 'auto' and _has_rubberband()):
+        return f"rubberband=pitch={ratio:.6f}:tempo={tempo:.4f}"
+    stages = [f"aresample={samplerate}", f"asetrate={samplerate * ratio:.3f}", f"aresample={samplerate}"] \
+        if semitones else []
+    stages += _atempo_chain(tempo / ratio)
+    return ','.join(stages) or 'anull'
+
+
+def render_command(app, source, semitones, tempo, fmt):
+    spec = FORMATS[fmt]
+    return ["ffmpeg", "-v", "error", "-i", source, "-af", shift_filter(app, semitones, tempo), "-vn"] \
+        + spec['codec'] + ["-b:a", app.config.get(spec['bitrate_key'], '128k'), "pipe:1"]
+
+
+def cached(path):
+    """
+    True if the finished variant exists; refreshes its place in the LRU.
+    """
+    try:
+        os.utime(path)
+    except OSError:
+        return False
+    return True
+
+
+def rendering(path):
+    return path in _renders or os.path.exists(path + '.part')
+
+
+def running_renders():
+    """
+    Renders this process has running.
+    """
+    return len(_renders)
+
+
+def _stale(part):
+    try:
+        return time.time() - os.path.getmtime(part) >= STALE_SECONDS
+    except OSError:
+        return False
+
+
+def _open_part(part):
+    # O_EXCL makes the .part file a lock shared by every process on the media folder
+    try:
+        return os.open(part, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+    except FileExistsError:
+        if not _stale(part):
+            return None
+        log.warning("Taking over stale variant render %s", part)
+        try:
+            os.remove(part)
+            return os.open(part, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        except OSError:
+            return None
+
+
+def start_render(app, source, path, semitones, tempo, fmt, trigger='request'):
+    """
+    Start rendering a variant into ``path + '.part'`` in the background,
+    renamed to ``path`` when done. No-op if it exists or is being rendered
+    (here or by another process). Returns True if a render was started.
+    Raises RenderLimit if this process runs VARIANT_MAX_RUNNING renders already.
+    """
+    with _lock:
+        if path in _renders or os.path.exists(path):
+            return False
+        if os.path.exists(path + '.part') and not _stale(path + '.part'):
+            return False
+        if len(_renders) >= app.config.get('VARIANT_MAX_RUNNING', 4):
+            raise RenderLimit(f"{app.config.get('VARIANT_MAX_RUNNING', 4)} variant renders are running")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        part = path + '.part'
+        fd = _open_part(part)
+        if fd is None:
+            return False
+        cmd = render_command(app, source, semitones, tempo, fmt)
+        log.debug("Rendering variant: %s", ' '.join(cmd))
+        try:
+            process = subprocess.Popen(cmd, stdout=fd, stderr=subprocess.PIPE)
+        except OSError:
+            os.remove(part)
+            raise
+        finally:
+            os.close(fd)
+        _renders[path] = process
+
+    def wait():
+        started = time.perf_counter()
+        stderr = process.communicate()[1]
+        try:
+            if process.returncode == 0:
+                os.replace(part, path)
+                metrics.observe('ffmpeg_seconds', time.perf_counter() - started, op='variant')
+                log.info("Rendered %s (%+d st, %.2fx) in %.1fs", path, semitones, tempo,
+                         time.perf_counter() - started)
+                evict(app)
+            else:
+                log.error("Rendering %s failed: %s", path, stderr.decode(errors='replace').strip())
+                metrics.inc('errors_total', where='variant')
+                os.remove(part)
+        except OSError as e:
+            # The song was deleted while rendering
+            log.warning("Could not finish variant %s: %s", path, e)
+        finally:
+            metrics.inc('variant_renders_total', trigger=trigger,
+                        status='done' if process.returncode == 0 else 'failed')
+            with _lock:
+                _renders.pop(path, None)
+
+    threading.Thread(target=wait, daemon=True, name='variant-render').start()
+    return True
+
+
+def render(app, source, path, semitones, tempo, fmt, timeout=600):
+    """
+    Render a variant and wait for it, e.g. to mix a take sung over it.
+    Returns ``path``, or None if the render failed or timed out.
+    """
+    deadline = time.monotonic() + timeout
+    while not os.path.exists(path):
+        # Also takes over a render whose process died; waits its turn if too many are running
+        try:
+            start_render(app, source, path, semitones, tempo, fmt)
+        except RenderLimit:
+            if time.monotonic() > deadline:
+                return None
+            time.sleep(FOLLOW_POLL_SECONDS * 5)
+            continue
+        if not rendering(path):
+            return path if os.path.exists(path) else None
+        if time.monotonic() > deadline:
+            return None
+        time.sleep(FOLLOW_POLL_SECONDS * 5)
+    return path
+
+
+def follow(path, idle_timeout=STALE_SECONDS):
+    """
+    Yield the bytes of a variant that is still being rendered, waiting for
+    more as the renderer appends them, until it is finished. Stops early if
+    the render fails or stalls for ``idle_timeout`` seconds.
+    """
+    part = path + '.part'
+    try:
+        source = open(part, 'rb')
+    except FileNotFoundError:
+        # Finished (or failed) between the caller's check and now
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                yield from iter(lambda: f.read(FOLLOW_CHUNK), b'')
+        return
+
+    # The open handle keeps reading the same file after it's renamed into place
+    with source:
+        idle_since = time.monotonic()
+        while True:
+            data = source.read(FOLLOW_CHUNK)
+            if data:
+                idle_since = time.monotonic()
+                yield data
+                continue
+            if not os.path.exists(part):
+                if os.path.exists(path):
+                    yield from iter(lambda: source.read(FOLLOW_CHUNK), b'')
+                else:
+                    log.warning("Variant render of %s failed mid-stream", path)
+                return
+            if time.monotonic() - idle_since > idle_timeout:
+                log.warning("Variant render of %s stalled, ending the stream", path)
+                return
+            time.sleep(FOLLOW_POLL_SECONDS)
+
+
+def _cache_files(app):
+    root = variants_dir(app)
+    for dirpath, _, filenames in os.walk(root):
+        for name in filenames:
+            if NAME.match(name):
+                yield os.path.join(dirpath, name)
+
+
+def evict(app):
+    """
+    Delete least recently played variants until the cache fits in
+    VARIANT_CACHE_BYTES. Returns the number of files removed.
+    """
+    limit = app.config.get('VARIANT_CACHE_BYTES')
+    if not limit:
+        return 0
+    entries = []
+    for path in _cache_files(app):
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        entries.append((st.st_mtime, st.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+    for _, size, path in sorted(entries):
+        if total <= limit:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        removed += 1
+        metrics.inc('storage_reclaimed_bytes_total', size, reason='variant')
+    if removed:
+        log.info("Evicted %s variants from the cache", removed)
+    return removed
+
+
+def popular_shifts(app, max_age=60):
+    """
+    Shifts ordered by how many songs have them cached, i.e. what singers ask
+    for most. Recounted at most every ``max_age`` seconds.
+    """
+    now = time.monotonic()
+    if _popular['at'] is None or now - _popular['at'] > max_age:
+        # A shift counts once per song, whatever formats it was rendered in
+        songs = set()
+        for path in _cache_files(app):
+            semitones, tempo, _ = NAME.match(os.path.basename(path)).groups()
+            songs.add((os.path.dirname(path), int(semitones), float(tempo)))
+        shifts = Counter((semitones, tempo) for _, semitones, tempo in songs)
+        _popular['shifts'] = [shift for shift, _ in shifts.most_common()]
+        _popular['at'] = now
+    return _popular['shifts']
+
+
+def prerender_popular(app, song_id, source, fmt):
+    """
+    Queue renders of the VARIANT_PRERENDER_COUNT most requested shifts this
+    song doesn't have yet, so picking one of them is a cache hit. Run by
+    the worker when a song is ready, never on a request.
+    """
+    count = app.config.get('VARIANT_PRERENDER_COUNT', 2)
+    if not count or fmt not in FORMATS or source is None:
+        return 0
+    # Leave headroom for renders someone is waiting on
+    if running_renders() >= app.config.get('VARIANT_PRERENDER_MAX_RUNNING', 2):
+        return 0
+
+    started = 0
+    for semitones, tempo in popular_shifts(app)[:count]:
+        path = variant_path(app, song_id, semitones, tempo, fmt)
+        try:
+            if start_render(app, source, path, semitones, tempo, fmt, trigger='prerender'):
+                started += 1
+        except RenderLimit:
+            break
+    return started
+
+
+def drop(app, song_id):
+    """
+    Remove every cached variant of a song.
+    """
+    shutil.rmtree(variants_dir(app, song_id), ignore_errors=True)
@@ -0,0 +1,77 @@
+"""
+Standalone processing node: runs a pool of workers that claim jobs from the
+shared database, without serving the API.
+
+    DATABASE_URL=postgresql://db/karaoke_db MEDIA_FOLDER=/mnt/media python worker.py
+
+Web nodes then run with EMBEDDED_WORKERS=0. Jobs are leased (SKIP LOCKED on
+PostgreSQL, compare-and-set on SQLite) and kept alive by heartbeats, so any
+number of worker nodes can share the queue; a job whose node dies is picked
+up by another one once its lease runs out. Media is exchanged through
+MEDIA_FOLDER, which must be the same shared directory on every node.
+"""
+import argparse
+import logging
+import signal
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from app import create_app
+from models import db
+from jobs import WorkerPool
+import metrics
+
+log = logging.getLogger('worker')
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = metrics.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_metrics(port):
+    server = ThreadingHTTPServer(('', port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True, name='metrics-http').start()
+    log.info("Serving metrics on :%s/metrics", port)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--processes', type=int, default=None,
+                        help="worker processes on this node (default: WORKER_COUNT, or sized to the machine)")
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help="serve this node's Prometheus metrics on this port")
+    args = parser.parse_args()
+
+    app = create_app()
+    with app.app_context():
+        db.create_all()
+    if args.metrics_port:
+        serve_metrics(args.metrics_port)
+
+    pool = WorkerPool(app, size=args.processes).start()
+    stopping = threading.Event()
+
+    def shutdown(signum, frame):
+        stopping.set()
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+    while not stopping.wait(1):
+        pass
+    log.info("Stopping workers")
+    pool.stop()
+
+
+if __name__ == '__main__':
+    main()
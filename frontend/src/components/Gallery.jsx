@@ -30,14 +30,20 @@ const Gallery = ({ user, onSongSelect }) => {
 
     setUploading(true);
     try {
-      await axios.post('/api/upload', formData);
-      const poll = setInterval(async () => {
-        const res = await axios.get('/api/songs');
-        setSongs(res.data);
-        const processing = res.data.some(s => s.status === 'processing');
-        if (!processing) clearInterval(poll);
-      }, 3000);
+      const res = await axios.post('/api/upload', formData);
       setTimeout(fetchSongs, 1000);
+      // Follow progress over Server-Sent Events instead of polling the whole list
+      // EventSource can't send headers, so it takes a short-lived token for this song's events only
+      const { data } = await axios.post(`/api/songs/${res.data.song_id}/route-token`, { route: 'events' });
+      const events = new EventSource(`/api/songs/${res.data.song_id}/events?token=${encodeURIComponent(data.token)}`);
+      events.addEventListener('progress', (e) => {
+        const update = JSON.parse(e.data);
+        setSongs(prev => prev.map(s => s.id === update.id ? { ...s, ...update } : s));
+        if (update.status !== 'processing') {
+          events.close();
+          fetchSongs();
+        }
+      });
     } catch (err) {
       console.error("Upload failed", err);
     } finally {
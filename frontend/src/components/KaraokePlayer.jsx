@@ -1,11 +1,31 @@
 import React, { useState, useRef, useEffect } from 'react';
 import { createPortal } from 'react-dom';
-import { Play, Pause, SkipBack, Mic2, Volume2, Save, ArrowLeft, Loader2, RotateCcw } from 'lucide-react';
+import { Play, Pause, SkipBack, Mic2, Volume2, Save, ArrowLeft, Loader2, RotateCcw, Minus, Plus, Music } from 'lucide-react';
 import axios from 'axios';
 import WaveSurfer from 'wavesurfer.js';
 import LyricsDisplay from './LyricsDisplay';
 import { motion, AnimatePresence } from 'framer-motion';
 
+// VARIANT_MIN_TEMPO–VARIANT_MAX_TEMPO on the server, in its 0.05 steps
+const TEMPOS = [0.8, 0.85, 0.9, 0.95, 1, 1.05, 1.1, 1.15, 1.2];
+const MAX_SEMITONES = 6;
+
+// Compressed instrumental; Opus is smallest where the browser can decode it.
+// A key/tempo shift is rendered on the server and starts streaming right away.
+const accompanimentUrl = async (songId, semitones, tempo) => {
+  const canOpus = document.createElement('audio').canPlayType('audio/ogg; codecs=opus') !== '';
+  const params = new URLSearchParams({ format: canOpus ? 'opus' : 'aac' });
+  if (semitones !== 0) params.set('semitones', semitones);
+  if (tempo !== 1) params.set('tempo', tempo);
+  // Shifts are rendered on demand for the song's owner only; <audio> can't send headers,
+  // so it gets a short-lived token good for this song's accompaniment alone
+  if (semitones !== 0 || tempo !== 1) {
+    const res = await axios.post(`/api/songs/${songId}/route-token`, { route: 'accompaniment' });
+    params.set('token', res.data.token);
+  }
+  return `/api/stream/${songId}/accompaniment?${params}`;
+};
+
 const KaraokePlayer = ({ song, user, onBack }) => {
   const containerRef = useRef(null);
   const wavesurferRef = useRef(null);
@@ -21,16 +41,20 @@ const KaraokePlayer = ({ song, user, onBack }) => {
   const [micVolume, setMicVolume] = useState(0);
   const [countdown, setCountdown] = useState(null);
   const [lyrics, setLyrics] = useState([]);
+  const [words, setWords] = useState(null);
   const [saving, setSaving] = useState(false);
+  const [semitones, setSemitones] = useState(0);
+  const [tempo, setTempo] = useState(1);
 
   useEffect(() => {
-    if (song.lyrics) {
-      try {
-        setLyrics(JSON.parse(song.lyrics));
-      } catch (e) {
-        console.error("Failed to parse lyrics", e);
-      }
-    }
+    // Lyrics are no longer inlined in the song list
+    axios.get(`/api/songs/${song.id}/lyrics`)
+      .then(res => setLyrics(res.data))
+      .catch(e => console.error("Failed to load lyrics", e));
+    // Word timings are optional (404 for songs processed without them)
+    axios.get(`/api/songs/${song.id}/lyrics/words`)
+      .then(res => setWords(res.data))
+      .catch(() => setWords(null));
 
     if (containerRef.current && !wavesurferRef.current) {
       wavesurferRef.current = WaveSurfer.create({
@@ -43,10 +67,11 @@ const KaraokePlayer = ({ song, user, onBack }) => {
         barRadius: 3,
         height: 80,
         normalize: true,
-        backend: 'WebAudio',
+        // Media element playback streams the audio with Range requests instead of decoding it all up front
+        backend: 'MediaElement',
       });
 
-      wavesurferRef.current.load(`/api/stream/${song.id}/accompaniment`);
+      accompanimentUrl(song.id, 0, 1).then(url => loadWaveform(url, 1));
       
       wavesurferRef.current.on('ready', () => {
         setDuration(wavesurferRef.current.getDuration());
@@ -74,6 +99,47 @@ const KaraokePlayer = ({ song, user, onBack }) => {
     };
   }, [song]);
 
+  // Draw the waveform from precomputed peaks (audiowaveform .dat) so it renders before the audio downloads
+  // A tempo-shifted variant plays for 1/tempo as long as the original the peaks were computed from
+  const loadWaveform = async (audioUrl, playbackTempo) => {
+    try {
+      const res = await fetch(`/api/songs/${song.id}/peaks?resolution=1024`);
+      if (res.ok) {
+        const buf = await res.arrayBuffer();
+        const view = new DataView(buf);
+        const sampleRate = view.getInt32(8, true);
+        const samplesPerPixel = view.getInt32(12, true);
+        const length = view.getUint32(16, true);
+        const pairs = new Int16Array(buf, 20, length * 2);
+        const peaks = Float32Array.from(pairs, v => v / 32768);
+        if (!wavesurferRef.current) return;
+        wavesurferRef.current.load(audioUrl, [peaks], length * samplesPerPixel / sampleRate / playbackTempo);
+        return;
+      }
+    } catch (err) {
+      console.warn("Peaks unavailable, decoding audio instead", err);
+    }
+    if (wavesurferRef.current) wavesurferRef.current.load(audioUrl);
+  };
+
+  // A take must be sung over one variant from start to finish
+  const takeInProgress = isRecording || (mediaRecorder && mediaRecorder.state !== 'inactive');
+
+  // Switch to another key/tempo variant; playback restarts from the top
+  const changeShift = async (newSemitones, newTempo) => {
+    if (!wavesurferRef.current || takeInProgress) return;
+    wavesurferRef.current.stop();
+    setIsPlaying(false);
+    setCurrentTime(0);
+    setSemitones(newSemitones);
+    setTempo(newTempo);
+    try {
+      loadWaveform(await accompanimentUrl(song.id, newSemitones, newTempo), newTempo);
+    } catch (err) {
+      console.error("Could not load the shifted accompaniment", err);
+    }
+  };
+
   const togglePlay = () => {
     if (wavesurferRef.current) {
       wavesurferRef.current.playPause();
@@ -86,10 +152,16 @@ const KaraokePlayer = ({ song, user, onBack }) => {
       const stream = await navigator.mediaDevices.getUserMedia({ audio: true });
       const recorder = new MediaRecorder(stream);
       const chunks = [];
+      // Our own context to read the output latency from (the player is a plain media element).
+      // Created here, on the click, so it runs; it has settled on its latency by the time the take stops.
+      const latencyContext = window.AudioContext ? new AudioContext() : null;
 
       recorder.ondataavailable = (e) => chunks.push(e.data);
       recorder.onstop = async () => {
-        if (!shouldSaveRef.current) return;
+        if (!shouldSaveRef.current) {
+          latencyContext?.close();
+          return;
+        }
         
         const blob = new Blob(chunks, { type: 'audio/webm' });
         const audioUrl = URL.createObjectURL(blob);
@@ -100,10 +172,27 @@ const KaraokePlayer = ({ song, user, onBack }) => {
         const formData = new FormData();
         formData.append('file', blob, `recording_${song.id}_${Date.now()}.webm`);
         formData.append('song_id', song.id);
+        // The take is mixed over the same shifted instrumental
+        formData.append('semitones', semitones);
+        formData.append('tempo', tempo);
+        // Playback + capture latency, so the server can line the take up if it can't estimate the offset
+        try {
+          const inputLatency = stream.getAudioTracks()[0]?.getSettings().latency || 0;
+          if (latencyContext) {
+            const outputLatency = (latencyContext.baseLatency || 0) + (latencyContext.outputLatency || 0);
+            formData.append('latency_ms', Math.round((outputLatency + inputLatency) * 1000));
+          }
+        } catch (latencyErr) {
+          console.warn("Could not read audio latency:", latencyErr);
+        } finally {
+          latencyContext?.close();
+        }
         
         try {
-          await axios.post('/api/recordings', formData);
-          alert('Recording saved!');
+          const res = await axios.post('/api/recordings', formData);
+          alert(res.data.status === 'processing'
+            ? 'Recording saved! Mixing with the instrumental, it will appear in your gallery shortly.'
+            : 'Recording saved!');
         } catch (err) {
           console.error("Failed to save recording", err);
         } finally {
@@ -115,13 +204,9 @@ const KaraokePlayer = ({ song, user, onBack }) => {
       // setMediaRecorder(recorder);
       // setIsRecording(true);
       
-      // Unlock AudioContext immediately on user interaction
+      // Unlock playback immediately on user interaction
       if (wavesurferRef.current) {
         try {
-            const audioContext = wavesurferRef.current.backend.getAudioContext();
-            if (audioContext.state === 'suspended') {
-              await audioContext.resume();
-            }
             // Hack: Play and immediately pause to "warm up" the engine and bypass autoplay policy
             // This tells the browser "the user wants to play audio"
             console.log("Warming up audio engine...");
@@ -234,7 +319,7 @@ const KaraokePlayer = ({ song, user, onBack }) => {
         {/* Lyrics Display */}
         <div className="w-full max-w-3xl h-[400px] glass-panel relative overflow-hidden flex flex-col items-center justify-center p-8">
           <div className="absolute inset-0 bg-gradient-to-b from-slate-900/90 via-transparent to-slate-900/90 z-10 pointer-events-none" />
-          <LyricsDisplay lyrics={lyrics} currentTime={currentTime} />
+          <LyricsDisplay lyrics={lyrics} words={words} currentTime={currentTime * tempo} />
         </div>
 
         {/* Waveform */}
@@ -366,6 +451,39 @@ const KaraokePlayer = ({ song, user, onBack }) => {
           />
         </div>
 
+        {/* Key / Tempo Controls */}
+        <div className="flex items-center gap-4 glass-panel px-6 py-3 rounded-full">
+          <Music size={18} className="text-slate-400" />
+          <button
+            onClick={() => changeShift(semitones - 1, tempo)}
+            disabled={semitones <= -MAX_SEMITONES || takeInProgress}
+            className="p-1 rounded-full text-slate-400 hover:text-white disabled:opacity-30 transition-all"
+            title="Key down"
+          >
+            <Minus size={16} />
+          </button>
+          <span className="w-16 text-center text-sm font-mono text-slate-300">
+            {semitones > 0 ? `+${semitones}` : semitones} st
+          </span>
+          <button
+            onClick={() => changeShift(semitones + 1, tempo)}
+            disabled={semitones >= MAX_SEMITONES || takeInProgress}
+            className="p-1 rounded-full text-slate-400 hover:text-white disabled:opacity-30 transition-all"
+            title="Key up"
+          >
+            <Plus size={16} />
+          </button>
+          <select
+            value={tempo}
+            onChange={(e) => changeShift(semitones, parseFloat(e.target.value))}
+            disabled={takeInProgress}
+            className="bg-transparent text-sm text-slate-300 font-mono outline-none"
+            title="Tempo"
+          >
+            {TEMPOS.map(t => <option key={t} value={t} className="bg-slate-900">{t.toFixed(2)}x</option>)}
+          </select>
+        </div>
+
       </div>
 
       {/* Countdown Overlay */}
@@ -1,13 +1,32 @@
 import React, { useEffect, useRef } from 'react';
 
-const LyricsDisplay = ({ lyrics, currentTime }) => {
+// Index of the last entry of a sorted array that is <= t, or -1 (binary search)
+const lastAtOrBefore = (sorted, t, key = x => x) => {
+  let lo = 0;
+  let hi = sorted.length - 1;
+  let found = -1;
+  while (lo <= hi) {
+    const mid = (lo + hi) >> 1;
+    if (key(sorted[mid]) <= t) {
+      found = mid;
+      lo = mid + 1;
+    } else {
+      hi = mid - 1;
+    }
+  }
+  return found;
+};
+
+const LyricsDisplay = ({ lyrics, words, currentTime }) => {
   const containerRef = useRef(null);
   const activeLineRef = useRef(null);
 
-  // Find current line index
-  const currentIndex = lyrics.findIndex(
-    (line, i) => currentTime >= line.start && currentTime < line.end
-  );
+  // Current line: the last one started, if it hasn't ended yet
+  const lastStarted = lyrics ? lastAtOrBefore(lyrics, currentTime, line => line.start) : -1;
+  const currentIndex = lastStarted >= 0 && currentTime < lyrics[lastStarted].end ? lastStarted : -1;
+
+  // Current word, from the columnar word timings (starts/ends/token_ids/tokens/line_offsets)
+  const currentWord = words ? lastAtOrBefore(words.starts, currentTime) : -1;
 
   useEffect(() => {
     if (activeLineRef.current) {
@@ -26,6 +45,23 @@ const LyricsDisplay = ({ lyrics, currentTime }) => {
     );
   }
 
+  const renderWords = (index) => {
+    const first = words.line_offsets[index];
+    const last = words.line_offsets[index + 1];
+    const spans = [];
+    for (let i = first; i < last; i++) {
+      spans.push(
+        <span
+          key={i}
+          className={i <= currentWord ? 'text-pink-400' : ''}
+        >
+          {words.tokens[words.token_ids[i]]}{' '}
+        </span>
+      );
+    }
+    return spans;
+  };
+
   return (
     <div 
       ref={containerRef}
@@ -34,6 +70,8 @@ const LyricsDisplay = ({ lyrics, currentTime }) => {
       {lyrics.map((line, index) => {
         const isActive = index === currentIndex;
         const isPast = index < currentIndex;
+        const hasWords = isActive && words && index + 1 < words.line_offsets.length
+          && words.line_offsets[index + 1] > words.line_offsets[index];
 
         return (
           <p
@@ -44,7 +82,7 @@ const LyricsDisplay = ({ lyrics, currentTime }) => {
               ${isPast ? 'opacity-50' : 'opacity-100'}
             `}
           >
-            {line.text}
+            {hasWords ? renderWords(index) : line.text}
           </p>
         );
       })}
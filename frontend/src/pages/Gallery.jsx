@@ -9,6 +9,8 @@ const Gallery = () => {
   const [recordings, setRecordings] = useState([]);
   const [loading, setLoading] = useState(true);
   const [searchQuery, setSearchQuery] = useState('');
+  const [nextCursor, setNextCursor] = useState(null);
+  const [phraseScores, setPhraseScores] = useState({}); // recording id -> per-line scores
 
   useEffect(() => {
     fetchData();
@@ -23,6 +25,7 @@ const Gallery = () => {
       if (activeTab === 'instrumentals') {
         const res = await axios.get('/api/songs', { headers });
         setSongs(res.data);
+        setNextCursor(res.headers['x-next-cursor'] || null);
       } else {
         const res = await axios.get('/api/recordings', { headers });
         setRecordings(res.data);
@@ -34,6 +37,34 @@ const Gallery = () => {
     }
   };
 
+  const togglePhrases = async (recId) => {
+    if (phraseScores[recId]) {
+      setPhraseScores(prev => { const next = { ...prev }; delete next[recId]; return next; });
+      return;
+    }
+    try {
+      const token = localStorage.getItem('token');
+      const res = await axios.get(`/api/recordings/${recId}/score`, { headers: { 'Authorization': `Bearer ${token}` } });
+      setPhraseScores(prev => ({ ...prev, [recId]: res.data.phrases }));
+    } catch (err) {
+      console.error("Fetch score failed", err);
+    }
+  };
+
+  const loadMore = async () => {
+    try {
+      const token = localStorage.getItem('token');
+      const res = await axios.get('/api/songs', {
+        headers: { 'Authorization': `Bearer ${token}` },
+        params: { cursor: nextCursor }
+      });
+      setSongs(prev => [...prev, ...res.data]);
+      setNextCursor(res.headers['x-next-cursor'] || null);
+    } catch (err) {
+      console.error("Fetch failed", err);
+    }
+  };
+
   const handleDelete = async (id, type) => {
     if (!window.confirm("Delete this item?")) return;
     try {
@@ -45,6 +76,16 @@ const Gallery = () => {
     }
   };
 
+  const handleRetry = async (id) => {
+    try {
+      const token = localStorage.getItem('token');
+      await axios.post(`/api/songs/${id}/reprocess`, null, { headers: { 'Authorization': `Bearer ${token}` } });
+      fetchData();
+    } catch (err) {
+      console.error("Retry failed", err);
+    }
+  };
+
   const items = activeTab === 'instrumentals' ? songs : recordings;
   const filteredItems = items.filter(item => 
     item.title.toLowerCase().includes(searchQuery.toLowerCase())
@@ -121,15 +162,41 @@ const Gallery = () => {
                 <div className="flex items-center gap-2 text-xs text-slate-500 mb-4">
                   <Calendar size={12} />
                   {new Date(item.upload_date || item.created_at).toLocaleDateString()}
+                  {activeTab === 'recordings' && item.score != null && (
+                    <button
+                      onClick={() => togglePhrases(item.id)}
+                      className="ml-auto px-2 py-0.5 rounded-full bg-pink-500/10 border border-pink-500/20 text-pink-300 hover:text-white transition-colors"
+                      title="Pitch accuracy against the original vocals"
+                    >
+                      {Math.round(item.score)} / 100
+                    </button>
+                  )}
                 </div>
 
+                {phraseScores[item.id] && (
+                  <div className="mb-4 max-h-32 overflow-y-auto text-xs space-y-1">
+                    {phraseScores[item.id].map((phrase, i) => (
+                      <div key={i} className="flex gap-2">
+                        <span className={`w-8 text-right shrink-0 ${
+                          phrase.score == null ? 'text-slate-600' :
+                          phrase.score >= 70 ? 'text-green-400' : phrase.score >= 40 ? 'text-yellow-400' : 'text-red-400'
+                        }`}>
+                          {phrase.score == null ? '–' : Math.round(phrase.score)}
+                        </span>
+                        <span className="text-slate-400 truncate">{phrase.text}</span>
+                      </div>
+                    ))}
+                  </div>
+                )}
+
                 {/* Audio Player Logic */}
                 <div className="mt-4">
-                  {(activeTab === 'recordings' || (item.status === 'ready' && item.instrumental_url)) ? (
+                  {((activeTab === 'recordings' && item.status !== 'processing') || (item.status === 'ready' && item.instrumental_url)) ? (
                     <div className="flex flex-col gap-2">
                        <audio 
                          controls 
-                         src={activeTab === 'recordings' ? item.url : item.instrumental_url} 
+                         preload="none"
+                         src={activeTab === 'recordings' ? item.url : (item.stream_url || item.instrumental_url)} 
                          className="w-full h-8 opacity-80 hover:opacity-100 transition-opacity" 
                          onPlay={(e) => {
                            // Pause other audios
@@ -160,9 +227,20 @@ const Gallery = () => {
                       }`}>
                         {item.status}
                       </span>
-                      {item.status === 'processing' && item.progress > 0 && (
+                      {item.status === 'processing' && item.queue_position && (
+                        <span className="text-xs text-slate-500">#{item.queue_position} in queue</span>
+                      )}
+                      {item.status === 'processing' && !item.queue_position && item.progress > 0 && (
                         <span className="text-xs text-slate-500">{item.progress}%</span>
                       )}
+                      {item.status === 'processing' && item.eta_seconds > 0 && (
+                        <span className="text-xs text-slate-500">~{Math.max(1, Math.round(item.eta_seconds / 60))} min</span>
+                      )}
+                      {activeTab === 'instrumentals' && item.status === 'error' && (
+                        <button onClick={() => handleRetry(item.id)} className="text-xs text-slate-400 hover:text-white transition-colors">
+                          Retry
+                        </button>
+                      )}
                     </div>
                   )}
                 </div>
@@ -175,6 +253,14 @@ const Gallery = () => {
               <p>No items found.</p>
             </div>
           )}
+
+          {activeTab === 'instrumentals' && nextCursor && (
+            <div className="col-span-full flex justify-center">
+              <button onClick={loadMore} className="btn px-6 py-2 rounded-full text-sm text-slate-300 hover:text-white">
+                Load more
+              </button>
+            </div>
+          )}
         </div>
       )}
     </div>
@@ -19,9 +19,12 @@ const RecordSong = () => {
   const fetchSongs = async () => {
     try {
       const token = localStorage.getItem('token');
-      const res = await axios.get('/api/songs', { headers: { 'Authorization': `Bearer ${token}` } });
-      // Filter only ready songs
-      setSongs(res.data.filter(s => s.status === 'ready'));
+      const res = await axios.get('/api/songs', {
+        headers: { 'Authorization': `Bearer ${token}` },
+        params: { limit: 200, fields: 'id,title,status,partial,instrumental_url,duration' }
+      });
+      // Ready songs, plus long songs whose instrumental is still streaming in
+      setSongs(res.data.filter(s => s.status === 'ready' || s.partial));
     } catch (err) {
       console.error("Fetch failed", err);
     } finally {
@@ -9,6 +9,9 @@ const RemoveVocals = () => {
   const [error, setError] = useState('');
   const [status, setStatus] = useState('idle'); // idle, uploading, processing, success
   const [progress, setProgress] = useState(0);
+  const [queuePosition, setQueuePosition] = useState(null);
+  const [stages, setStages] = useState(null);
+  const [eta, setEta] = useState(null);
   const navigate = useNavigate();
 
   const handleUpload = async (e) => {
@@ -39,37 +42,39 @@ const RemoveVocals = () => {
       const res = await axios.post('/api/upload', formData, config);
       
       setStatus('processing');
+      setEta(res.data.eta_seconds);
       
-      // Poll for completion
-      const poll = setInterval(async () => {
-        try {
-          const songsRes = await axios.get('/api/songs', { headers: { 'Authorization': `Bearer ${token}` } });
-          const uploadedSong = songsRes.data.find(s => s.id === res.data.song_id);
-          
-          if (uploadedSong) {
-             if (uploadedSong.status === 'ready') {
-                clearInterval(poll);
-                setProgress(100);
-                setStatus('success');
-                setTimeout(() => navigate('/gallery'), 2000);
-             } else if (uploadedSong.status === 'error') {
-                clearInterval(poll);
-                setError('Processing failed. Please try again.');
-                setStatus('idle');
-                setUploading(false);
-             } else {
-                setProgress(uploadedSong.progress || 0);
-             }
-          }
-        } catch (err) {
-          console.error("Polling error", err);
-          if (err.response?.status === 401) {
-             clearInterval(poll);
-             setError('Session expired. Please login again.');
-             navigate('/');
-          }
+      // Progress is pushed over Server-Sent Events. EventSource can't send headers, so the URL carries
+      // a short-lived token good for this song's events only, never the session token
+      const { data } = await axios.post(`/api/songs/${res.data.song_id}/route-token`, { route: 'events' }, config);
+      const events = new EventSource(`/api/songs/${res.data.song_id}/events?token=${encodeURIComponent(data.token)}`);
+      events.addEventListener('progress', (e) => {
+        const uploadedSong = JSON.parse(e.data);
+        if (uploadedSong.status === 'ready') {
+          events.close();
+          setProgress(100);
+          setStatus('success');
+          setTimeout(() => navigate('/gallery'), 2000);
+        } else if (uploadedSong.status === 'error') {
+          events.close();
+          setError('Processing failed. Please try again.');
+          setStatus('idle');
+          setUploading(false);
+        } else {
+          setProgress(uploadedSong.progress || 0);
+          setQueuePosition(uploadedSong.queue_position);
+          setStages(uploadedSong.stages);
+          // Only the initial and fallback events carry an estimate
+          if ('eta_seconds' in uploadedSong) setEta(uploadedSong.eta_seconds);
+        }
+      });
+      events.onerror = () => {
+        // The browser reconnects on its own unless the server refused the stream (e.g. expired token)
+        if (events.readyState === EventSource.CLOSED) {
+          console.error("Progress stream closed");
+          setError('Lost connection to the server. Check the gallery for the result.');
         }
-      }, 3000);
+      };
 
     } catch (err) {
       console.error("Upload failed", err);
@@ -131,7 +136,9 @@ const RemoveVocals = () => {
               </div>
               <div className="w-full text-center">
                 <h3 className="text-xl font-semibold text-white mb-2">Processing Audio...</h3>
-                <p className="text-sm text-slate-500 mb-4">Separating vocals from instrumentals.</p>
+                <p className="text-sm text-slate-500 mb-4">
+                  {queuePosition ? `Waiting in queue (position ${queuePosition}).` : 'Separating vocals from instrumentals.'}
+                </p>
                 
                 {/* Progress Bar */}
                 <div className="w-full h-2 bg-slate-700 rounded-full overflow-hidden">
@@ -143,6 +150,14 @@ const RemoveVocals = () => {
                   />
                 </div>
                 <p className="text-xs text-slate-400 mt-2">{progress}% Complete</p>
+                {eta > 0 && (
+                  <p className="text-xs text-slate-500 mt-1">About {Math.max(1, Math.round(eta / 60))} min remaining</p>
+                )}
+                {stages && (
+                  <p className="text-xs text-slate-500 mt-1">
+                    Separation {stages.separate}% · Lyrics {stages.transcribe}%
+                  </p>
+                )}
               </div>
             </div>
           )}